@@ -0,0 +1,3 @@
+"""
+Shared modules of Climate control system daemons
+"""
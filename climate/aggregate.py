@@ -0,0 +1,116 @@
+"""
+Streaming aggregation of readings per upload window
+
+Every published reading is added to window of its name, window keeps count,
+mean, min, max and sum of squared deviations (Welford's algorithm), so memory
+doesn't depend on number of readings and spikes between samples aren't lost.
+Aggregates are named '<reading>.<stat>' (e.g. 'co2.max') and can be mapped to
+fields of channel like other readings. Window without readings (e.g. with
+'mt8057_changed_only' when value is stable) carries the last value forward:
+mean, min and max are the last value, stddev is 0 and count is 0.
+"""
+import math
+import threading
+
+STATS = ('mean', 'min', 'max', 'stddev', 'count')
+PRECISION = 3 # Number of decimal digits of mean and stddev
+
+def is_aggregate(name):
+    """
+    Check that reading name is name of aggregate
+    """
+    return name.rpartition('.')[2] in STATS
+
+class Window(object):
+    """
+    Class for statistics of one reading in one window
+    """
+    __slots__ = ('count', 'mean', 'min', 'max', 'last', '_m2')
+
+    def __init__(self, last=None):
+        self.count = 0
+        self.last = last
+        self.mean = 0.0
+        self.min = None
+        self.max = None
+        self._m2 = 0.0
+
+    def add(self, value):
+        """
+        Add value to window
+        """
+        self.count += 1
+        self.last = value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def stddev(self):
+        """
+        Return population standard deviation
+        """
+        return math.sqrt(self._m2 / self.count) if self.count else None
+
+    def result(self):
+        """
+        Return dictionary of statistics
+        Empty window has the last value of previous windows (None if there wasn't any).
+        """
+        if not self.count:
+            if self.last is None:
+                return {'mean': None, 'min': None, 'max': None, 'stddev': None, 'count': 0}
+            return {'mean': self.last, 'min': self.last, 'max': self.last, 'stddev': 0.0, 'count': 0}
+        return {'mean': round(self.mean, PRECISION), 'min': self.min, 'max': self.max,
+                'stddev': round(self.stddev(), PRECISION), 'count': self.count}
+
+class Aggregator(object):
+    """
+    Class for aggregation of readings of snapshot store
+    'split' maps name of reading with tuple value to names of its items,
+    e.g. {'humidity': ('humidity', 'temp2')} for pair of DHT sensor.
+    """
+    def __init__(self, split=None):
+        """
+        Class initialization
+        """
+        self._lock = threading.Lock()
+        self._split = split or {}
+        self._windows = {}
+
+    def add(self, name, value, timestamp=None):
+        """
+        Add reading (listener of snapshot store, called from sensor threads)
+        """
+        names = self._split.get(name)
+        with self._lock:
+            if names is None:
+                self._add(name, value)
+            elif value is not None:
+                for item_name, item in zip(names, value):
+                    self._add(item_name, item)
+
+    def _add(self, name, value):
+        if value is None:
+            return
+        window = self._windows.get(name)
+        if window is None:
+            window = self._windows[name] = Window()
+        window.add(value)
+
+    def roll(self):
+        """
+        Close current window, return dictionary of aggregates '<reading>.<stat>'
+        Readings which weren't published in window have the last value with count 0.
+        """
+        with self._lock:
+            windows = self._windows
+            self._windows = dict((name, Window(window.last)) for name, window in windows.items())
+        aggregates = {}
+        for name, window in windows.items():
+            for stat, value in window.result().items():
+                aggregates[name + '.' + stat] = value
+        return aggregates
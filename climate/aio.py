@@ -0,0 +1,228 @@
+"""
+Asyncio runtime of daemon (Python 3.7 or newer)
+
+Sensors are polled by tasks of event loop, blocking USB/GPIO calls are done in
+small thread pool. Sampling timer and sending of samples are tasks too, their
+blocking calls (sampling, HTTP requests) are done in the same pool, and all
+tasks are stopped by one event. Threads of services (backlog uploaders, local
+HTTP API, IP address provider) aren't replaced by the runtime.
+Sensors should use bounded read timeouts for prompt stopping: blocking calls
+which are in flight on stop are waited (at most 'stop_timeout' seconds) before
+sensors are closed.
+"""
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import signal
+import time
+import traceback
+
+from climate.uploader import QUEUE_SIZE
+
+RETRY_DELAY = 5     # Delay of polling of sensor after reading error (seconds)
+STOP_TIMEOUT = 5    # Maximal waiting of blocking calls on stop (seconds)
+
+class AsyncUploader(object):
+    """
+    Class for sending of samples by task of event loop
+    It has the same interface for sampling loop as uploader.Uploader.
+    """
+    def __init__(self, runtime, send, spill=None, size=100, name='uploader'):
+        """
+        Class initialization
+        """
+        self._runtime = runtime
+        self._send = send
+        self._spill = spill
+        self._size = size
+        self._queue = None
+        self._alive = True
+        self.error_cnt = 0
+        QUEUE_SIZE.set_function(lambda: self._queue.qsize() if self._queue else 0, (name,))
+
+    def is_alive(self):
+        return self._alive
+
+    def put(self, sample):
+        """
+        Put sample to queue (never blocks, it can be called from any thread)
+        """
+        if not self._runtime.call_soon(self._put, sample):
+            self._spill_sample(sample)
+
+    def _put(self, sample):
+        try:
+            self._queue.put_nowait(sample)
+        except (asyncio.QueueFull, AttributeError):
+            self._spill_sample(sample)
+
+    def _spill_sample(self, sample):
+        if self._spill:
+            self._spill(*sample)
+        else:
+            print('{} Queue is full, sample {} is lost.'.format(str(datetime.datetime.now()), sample.current_time))
+
+    async def run(self):
+        """
+        Loop of samples sending
+        """
+        self._queue = asyncio.Queue(maxsize=self._size)
+        while True:
+            sample = await self._queue.get()
+            try:
+                self.error_cnt = await self._runtime.call(self._send, *sample)
+            except SystemExit: # Sending isn't possible (e.g. wrong configuration)
+                self._alive = False
+                return
+            except Exception as e:
+                self.error_cnt += 1
+                print('{} Sending error: {}'.format(str(datetime.datetime.now()), str(e)))
+
+    def close(self):
+        """
+        Save samples which weren't sent to cache
+        """
+        self._alive = False
+        while self._queue is not None and not self._queue.empty():
+            self._spill_sample(self._queue.get_nowait())
+        print('{} Uploader was stopped.'.format(str(datetime.datetime.now())))
+
+class AsyncRuntime(object):
+    """
+    Class for asyncio runtime
+    """
+    def __init__(self, workers=2, stop_timeout=STOP_TIMEOUT):
+        """
+        Class initialization
+        'workers' - number of threads for blocking calls,
+        'stop_timeout' - maximal waiting of blocking calls on stop (seconds).
+        """
+        self._workers = workers
+        self._stop_timeout = stop_timeout
+        self._executor = None
+        self._calls = set() # Blocking calls in flight (futures of thread pool)
+        self._loop = None
+        self._stop = None
+        self._coroutines = []
+        self._closers = []
+
+    async def call(self, func, *args):
+        """
+        Call blocking function in thread pool
+        """
+        future = self._executor.submit(func, *args)
+        self._calls.add(future)
+        future.add_done_callback(self._calls.discard)
+        return await asyncio.wrap_future(future)
+
+    def call_soon(self, func, *args):
+        """
+        Schedule call of function by event loop (it can be called from any thread)
+        Return False if event loop isn't running.
+        """
+        try:
+            self._loop.call_soon_threadsafe(functools.partial(func, *args))
+            return True
+        except (AttributeError, RuntimeError): # Loop isn't started or it's closed
+            return False
+
+    def add_sensor(self, name, poll, interval=0, close=None):
+        """
+        Add sensor, 'poll' is blocking function which reads data from sensor once
+        """
+        self._coroutines.append(functools.partial(self._sensor, name, poll, interval))
+        if close:
+            self._closers.append(close)
+
+    def add_timer(self, func, period, overrun=None):
+        """
+        Add function which is called with fixed rate, argument is scheduled time of call
+        'overrun' is called when call took longer than period.
+        """
+        self._coroutines.append(functools.partial(self._timer, func, period, overrun))
+
+    def add_uploader(self, send, spill=None, size=100, name='uploader'):
+        """
+        Add uploader of samples, return it
+        """
+        uploader = AsyncUploader(self, send, spill, size, name)
+        self._coroutines.insert(0, uploader.run) # Queue should exist before sampling
+        self._closers.insert(0, uploader.close)
+        return uploader
+
+    def stop(self):
+        """
+        Stop runtime (can be called from any thread)
+        """
+        if self._loop and self._stop:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    def run(self):
+        """
+        Run event loop until stop
+        """
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_event_loop()
+        self._stop = asyncio.Event()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self._loop.add_signal_handler(signum, self._signal, signum)
+        tasks = [self._loop.create_task(coroutine()) for coroutine in self._coroutines]
+        try:
+            await self._stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Sensors aren't closed while their reads are in flight, reads are finished by timeouts
+            if self._calls:
+                done, pending = await asyncio.wait([asyncio.wrap_future(future) for future in list(self._calls)],
+                                                   timeout=self._stop_timeout)
+                if pending:
+                    print('{} {} blocking calls weren\'t finished.'.format(str(datetime.datetime.now()), len(pending)))
+            for close in self._closers:
+                try:
+                    close()
+                except Exception as e:
+                    print('{} Stopping error: {}'.format(str(datetime.datetime.now()), str(e)))
+            self._executor.shutdown(wait=False)
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                self._loop.remove_signal_handler(signum)
+
+    def _signal(self, signum):
+        print('{} Signal {} was received.'.format(str(datetime.datetime.now()), signum))
+        self._stop.set()
+
+    async def _sensor(self, name, poll, interval):
+        while True:
+            try:
+                await self.call(poll)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e: # Sensor is polled again after delay (e.g. device is reconnected)
+                print('{} {} reading error: {}'.format(str(datetime.datetime.now()), name, str(e)))
+                await asyncio.sleep(max(interval, RETRY_DELAY))
+                continue
+            if interval:
+                await asyncio.sleep(interval)
+
+    async def _timer(self, func, period, overrun):
+        tick = time.time()
+        while True:
+            try:
+                await self.call(func, tick)
+            except Exception:
+                print('{} Unknown error in loop.'.format(str(datetime.datetime.now())))
+                traceback.print_exc()
+            # Fixed-rate schedule, clock doesn't depend on duration of call
+            tick += period
+            delay = tick - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                if overrun is not None:
+                    overrun()
+                tick = time.time()
@@ -0,0 +1,139 @@
+"""
+Circuit breaker of uploads
+
+Failures of sending are classified as server faults (HTTP errors like 429 and
+5xx, timeouts, refused or reset connections) and local faults (no IP address,
+DNS failure, unreachable network). Reset of reused connection after request was
+sent (climate.session.LostConnectionError) is neither of them: server could
+close it as idle, the request is released without failure. Server faults open the breaker after
+'threshold' continuous failures: requests aren't sent until exponential delay
+with random jitter is expired (at least 'Retry-After' of server), then one
+trial request is allowed (other requests are refused until it succeeds or
+fails; trial which wasn't sent is returned by release()). Devices of fleet don't retry in lockstep, and
+samples are kept in cache while the breaker is open. Only local faults are
+reasons for recovery actions of device (reboot).
+"""
+import datetime
+import errno
+import random
+import socket
+import threading
+import time
+
+try:
+    from urllib2 import HTTPError
+except ImportError:
+    from urllib.error import HTTPError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+THRESHOLD = 3       # Continuous server faults which open the breaker
+DELAY = 30          # The first delay of open breaker (seconds)
+MAX_DELAY = 1800    # Maximal delay of open breaker (seconds)
+JITTER = 0.5        # Part of delay which is random
+
+LOCAL_ERRNOS = (errno.ENETUNREACH, errno.ENETDOWN, errno.EHOSTUNREACH, errno.EADDRNOTAVAIL)
+
+def is_local_fault(e):
+    """
+    Check that sending error is caused by network of device, not by server
+    """
+    if isinstance(e, HTTPError): # Server has answered
+        return False
+    reason = getattr(e, 'reason', e) # URLError keeps original error
+    if isinstance(reason, socket.gaierror): # Name isn't resolved
+        return True
+    return getattr(reason, 'errno', None) in LOCAL_ERRNOS
+
+def retry_after(e):
+    """
+    Return delay from header 'Retry-After' of HTTP error (seconds) or None
+    """
+    headers = getattr(e, 'hdrs', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    try:
+        return max(0, int(value)) if value else None
+    except ValueError: # HTTP date isn't supported
+        return None
+
+class CircuitBreaker(object):
+    """
+    Class for circuit breaker with exponential backoff and jitter
+    """
+    def __init__(self, name='', threshold=THRESHOLD, delay=DELAY, max_delay=MAX_DELAY, jitter=JITTER):
+        """
+        Class initialization
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self._threshold = max(1, threshold)
+        self._delay = delay
+        self._max_delay = max(delay, max_delay)
+        self._jitter = min(max(jitter, 0), 1)
+        self.state = CLOSED
+        self.failures = 0   # Continuous server faults
+        self.opened = 0     # Continuous openings, delay is doubled on every opening
+        self._retry_time = 0
+        self._trial = False # Trial request of half-open breaker is in flight
+
+    def allow(self):
+        """
+        Check that request can be sent, open breaker becomes half-open when delay is expired
+        Half-open breaker allows only one trial request until success() or failure().
+        """
+        with self._lock:
+            if self.state == OPEN and time.time() >= self._retry_time:
+                self.state = HALF_OPEN
+                self._trial = False
+            if self.state == HALF_OPEN:
+                if self._trial:
+                    return False
+                self._trial = True
+            return self.state != OPEN
+
+    def release(self):
+        """
+        Return allowed request which wasn't sent or failed by local fault (next trial is allowed)
+        """
+        with self._lock:
+            self._trial = False
+
+    def remaining(self):
+        """
+        Return time (seconds) until trial request is allowed
+        """
+        with self._lock:
+            return max(0, self._retry_time - time.time()) if self.state == OPEN else 0
+
+    def success(self):
+        """
+        Register successful request
+        """
+        with self._lock:
+            if self.state != CLOSED:
+                print('{} Breaker {}: server is available, breaker is closed.'.format(str(datetime.datetime.now()), self.name or 'default'))
+            self.state = CLOSED
+            self._trial = False
+            self.failures = 0
+            self.opened = 0
+
+    def failure(self, retry_after=None):
+        """
+        Register server fault, 'retry_after' - minimal delay requested by server (seconds)
+        """
+        with self._lock:
+            self._trial = False
+            self.failures += 1
+            if self.state != HALF_OPEN and self.failures < self._threshold:
+                return
+            delay = min(self._max_delay, self._delay * 2 ** self.opened)
+            delay *= 1 - self._jitter * random.random()
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            self.opened += 1
+            self.state = OPEN
+            self._retry_time = time.time() + delay
+            print('{} Breaker {}: {} continuous server faults, breaker is open for {:.0f} s.'.format(
+                str(datetime.datetime.now()), self.name or 'default', self.failures, delay))
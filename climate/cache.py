@@ -0,0 +1,382 @@
+"""
+Cache of data which wasn't sent to Cloud
+
+Samples are collected in memory ring buffer and written to SQLite DB by one
+transaction every 'flush_size' samples or 'flush_interval' seconds (group commit),
+so at most 'flush_size' samples or 'flush_interval' seconds of data can be lost
+on crash. Samples which were sent before flushing are never written to DB.
+
+Timestamps are stored as integer UTC epoch seconds and they are primary key,
+so sample with the same timestamp is never cached twice. Values are stored by
+fields of thingspeak.com channel (field1...field8).
+
+Cache is drained oldest-first by batches. Batch is created by get_cache() from
+the oldest rows and has state: pending (created), in-flight (sending was
+started) or acked (sent, its rows are deleted by clear_cache()). Batch which
+wasn't acked is returned by get_cache() again with the same rows, so failed
+sending resends exactly the unacked rows and new samples never join it. Rows
+of batch in DB are marked by id of batch, unacked batch is resumed after
+restart. Batch which was in flight on crash is resent as is (the server
+can't be asked whether it was received).
+
+Rows are selected and deleted by column 'batch' (id of their batch), not by
+range of row ids up to high-water mark of the batch: rows have no id (their
+timestamp is the key), and rows which are flushed while batch is in flight
+must stay out of it.
+"""
+import calendar
+import collections
+import datetime
+import sqlite3
+import threading
+import time
+
+from climate import metrics
+
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+SCHEMA_VERSION = 2
+FIELDS = ['field{}'.format(i) for i in range(1, 9)]
+
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+ACKED = 'acked'
+KEEP_ACKED = 100 # Number of kept records of acked batches
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS cache(
+        ts INTEGER PRIMARY KEY,
+        {columns},
+        batch INTEGER);
+    CREATE INDEX IF NOT EXISTS cache_batch ON cache(batch);
+    CREATE TABLE IF NOT EXISTS batches(
+        id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL,
+        first_ts INTEGER,
+        last_ts INTEGER,
+        rows INTEGER,
+        created INTEGER);
+'''.format(columns=',\n        '.join(field + ' REAL' for field in FIELDS))
+
+# Released schema (version 1) stored timestamp as text, so it could be sorted only by datetime(timestamp)
+MIGRATION_V1 = '''
+    BEGIN;
+    ALTER TABLE cache RENAME TO cache_v1;
+    {schema}
+    INSERT OR IGNORE INTO cache(ts, field1, field2, field3, field4)
+        SELECT CAST(strftime('%s', timestamp) AS INTEGER), co2, temp, humidity, temp2 FROM cache_v1
+        WHERE strftime('%s', timestamp) IS NOT NULL ORDER BY datetime(timestamp), id;
+    DROP TABLE cache_v1;
+    PRAGMA user_version = {version};
+    COMMIT;
+'''.format(schema=SCHEMA, version=SCHEMA_VERSION)
+
+INSERT = 'INSERT OR IGNORE INTO cache(ts, {columns}, batch) VALUES(:ts, {values}, :batch)'.format(
+    columns=', '.join(FIELDS), values=', '.join(':' + field for field in FIELDS))
+SELECT_NEW = 'SELECT ts, {columns} FROM cache WHERE batch IS NULL ORDER BY ts LIMIT :limit'.format(columns=', '.join(FIELDS))
+SELECT_BATCH = 'SELECT ts, {columns} FROM cache WHERE batch = :batch ORDER BY ts'.format(columns=', '.join(FIELDS))
+
+ROWS = metrics.gauge('climate_cache_rows', 'Samples in cache', ['cache'])
+COMMIT_SECONDS = metrics.histogram('climate_cache_commit_seconds', 'Latency of commits of cache DB', ['cache'])
+
+def to_epoch(timestamp):
+    """
+    Convert UTC time string to epoch seconds
+    """
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    return calendar.timegm(time.strptime(timestamp, TIME_FORMAT))
+
+def from_epoch(ts):
+    """
+    Convert epoch seconds to UTC time string
+    """
+    return time.strftime(TIME_FORMAT, time.gmtime(ts))
+
+def _row_data(ts, values):
+    data = dict((field, value) for field, value in zip(FIELDS, values) if value is not None)
+    data['created_at'] = from_epoch(ts)
+    return data
+
+class Batch(object):
+    """
+    Class for batch of cached samples
+    """
+    def __init__(self, id, state=PENDING, durable=False):
+        """
+        Class initialization
+        'durable' - batch has rows in DB and its record is written.
+        """
+        self.id = id
+        self.state = state
+        self.durable = durable
+        self.data = []          # Data of samples for bulk-update
+        self.pending_ts = set() # Timestamps of samples of batch from pending buffer (not in DB)
+
+class Cache():
+    """
+    Class for cache
+    """
+    def __init__(self, path, limit=960, flush_size=10, flush_interval=300, synchronous='NORMAL', name=''):
+        """
+        Class initialization, 'name' is label of metrics
+        """
+        self._lock = threading.RLock()
+        self._labels = (name or 'default',)
+        self._db = None
+        self._cursor = None
+        self._cache_data = []
+        self._batch = None        # Batch which isn't acked
+        self._last_batch_id = 0
+        self._limit = limit
+        if not self._limit or self._limit <= 0:
+            self._limit = 960
+        self._flush_size = max(1, flush_size)
+        self._flush_interval = flush_interval
+        self._last_flush = time.time()
+        self._pending = collections.OrderedDict() # Samples which aren't written to DB by timestamp
+        self._max_pending = max(self._limit, self._flush_size)
+        synchronous = str(synchronous).upper()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            print('{} Wrong synchronous level of DB: {}, NORMAL is used.'.format(str(datetime.datetime.now()), synchronous))
+            synchronous = 'NORMAL'
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False) # Sqlite DB initialization
+            if self._db:
+                self._cursor = self._db.cursor()
+                self._cursor.execute('PRAGMA journal_mode=WAL')
+                self._cursor.execute('PRAGMA synchronous={}'.format(synchronous))
+                self._migrate()
+                self._recover()
+                ROWS.set_function(self.count, self._labels)
+                print('{} DB for cache was initialized.'.format(str(datetime.datetime.now())))
+        except BaseException as e:
+            print('{} DB error: {}'.format(str(datetime.datetime.now()), str(e)))
+
+    def _migrate(self):
+        """
+        Create or upgrade DB schema
+        """
+        columns = [row[1] for row in self._cursor.execute('PRAGMA table_info(cache)').fetchall()]
+        migration = None
+        if 'timestamp' in columns:
+            migration = MIGRATION_V1
+        if migration:
+            print('{} DB for cache is migrating...'.format(str(datetime.datetime.now())))
+            self._db.commit()
+            self._cursor.executescript(migration)
+        else:
+            self._cursor.executescript(SCHEMA)
+            self._cursor.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            self._db.commit()
+
+    def _recover(self):
+        """
+        Resume batch which wasn't acked before stopping
+        """
+        self._last_batch_id = self._cursor.execute('SELECT coalesce(max(id), 0) FROM batches').fetchone()[0]
+        # Rows of unknown or acked batches are pending again
+        self._cursor.execute('UPDATE cache SET batch = NULL WHERE batch IS NOT NULL AND batch NOT IN '
+                             '(SELECT id FROM batches WHERE state != :state)', {'state': ACKED})
+        for batch_id, state in self._cursor.execute('SELECT id, state FROM batches WHERE state != :state ORDER BY id',
+                                                    {'state': ACKED}).fetchall():
+            rows = self._cursor.execute(SELECT_BATCH, {'batch': batch_id}).fetchall()
+            if self._batch is not None or not rows: # Only one batch can be unacked
+                self._cursor.execute('UPDATE cache SET batch = NULL WHERE batch = :batch', {'batch': batch_id})
+                self._cursor.execute('DELETE FROM batches WHERE id = :id', {'id': batch_id})
+                continue
+            self._batch = Batch(batch_id, state, durable=True)
+            self._batch.data = [_row_data(row[0], row[1:]) for row in rows]
+            print('{} Batch {} ({} rows, {}) wasn\'t acked, it will be resent.'.format(
+                str(datetime.datetime.now()), batch_id, len(rows), state))
+        self._db.commit()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Write all pending samples to DB and close it
+        """
+        with self._lock:
+            if self._db:
+                self.flush()
+                self._db.close()
+                self._db = None
+                self._cursor = None
+
+    def flush(self):
+        """
+        Write pending samples to DB by one transaction
+        Samples of unacked batch are marked by its id.
+        """
+        with self._lock:
+            self._last_flush = time.time()
+            if self._cursor and self._pending:
+                batch = self._batch
+                try:
+                    items = list(self._pending.values())
+                    for item in items:
+                        item['batch'] = batch.id if batch is not None and item['ts'] in batch.pending_ts else None
+                    if batch is not None and batch.pending_ts and not batch.durable:
+                        self._write_batch(batch)
+                    self._cursor.executemany(INSERT, items)
+                    self._commit()
+                    self._pending.clear()
+                    if batch is not None:
+                        batch.durable = batch.durable or bool(batch.pending_ts)
+                        batch.pending_ts = set()
+                except BaseException as e:
+                    self._rollback(e)
+
+    def count(self):
+        """
+        Return number of cached samples
+        """
+        with self._lock:
+            count = len(self._pending) if self._cursor else len(self._cache_data)
+            if self._cursor:
+                try:
+                    count += self._cursor.execute('SELECT count(*) FROM cache').fetchone()[0]
+                except BaseException as e:
+                    print('{} DB error: {}'.format(str(datetime.datetime.now()), str(e)))
+            return count
+
+    @property
+    def batch_id(self):
+        """
+        Id of batch which isn't acked or None
+        """
+        with self._lock:
+            return self._batch.id if self._batch is not None else None
+
+    def append(self, current_time, fields):
+        """
+        Add sample, 'fields' is dictionary of values by fields of channel
+        Sample with timestamp of cached sample is ignored.
+        """
+        with self._lock:
+            if self._cursor:
+                item = dict((field, fields.get(field)) for field in FIELDS)
+                item['ts'] = to_epoch(current_time)
+                if item['ts'] in self._pending:
+                    return
+                try:
+                    if self._cursor.execute('SELECT 1 FROM cache WHERE ts = :ts', item).fetchone():
+                        return
+                except BaseException as e:
+                    print('{} DB error: {}'.format(str(datetime.datetime.now()), str(e)))
+                if len(self._pending) >= self._max_pending:
+                    print('{} Cache buffer is full, the oldest sample is lost.'.format(str(datetime.datetime.now())))
+                    ts = self._pending.popitem(last=False)[0]
+                    if self._batch is not None and ts in self._batch.pending_ts:
+                        self._batch.pending_ts.discard(ts) # Sample is still sent by batch
+                self._pending[item['ts']] = item
+                if len(self._pending) >= self._flush_size or time.time() - self._last_flush >= self._flush_interval:
+                    self.flush()
+            else:
+                if any(data['created_at'] == current_time for data in self._cache_data):
+                    return
+                data = dict((field, value) for field, value in fields.items() if value is not None)
+                data['created_at'] = current_time
+                data['status'] = ''
+                if len(self._cache_data) >= self._limit:
+                    del self._cache_data[0]
+                self._cache_data.append(data)
+
+    def get_cache(self):
+        """
+        Return data of batch which isn't acked or new batch of the oldest samples
+        Batch is in flight until clear_cache() is called.
+        """
+        with self._lock:
+            if self._batch is None:
+                self._batch = self._new_batch()
+                if self._batch is None:
+                    return []
+            if self._batch.state != IN_FLIGHT:
+                self._batch.state = IN_FLIGHT
+                if self._batch.durable and self._cursor:
+                    try:
+                        self._cursor.execute('UPDATE batches SET state = :state WHERE id = :id',
+                                             {'state': IN_FLIGHT, 'id': self._batch.id})
+                        self._commit()
+                    except BaseException as e:
+                        self._rollback(e)
+            return self._batch.data
+
+    def _new_batch(self):
+        """
+        Create batch of the oldest samples which aren't in batch, return None if cache is empty
+        """
+        batch = Batch(self._last_batch_id + 1)
+        if not self._cursor:
+            batch.data = self._cache_data[:self._limit]
+        else:
+            try:
+                rows = self._cursor.execute(SELECT_NEW, {"limit": self._limit}).fetchall()
+                batch.data = [_row_data(row[0], row[1:]) for row in rows]
+                if rows:
+                    batch.durable = True
+                    self._write_batch(batch, first_ts=rows[0][0], last_ts=rows[-1][0], count=len(rows))
+                    self._cursor.execute('UPDATE cache SET batch = :batch WHERE batch IS NULL AND ts <= :last_ts',
+                                         {'batch': batch.id, 'last_ts': rows[-1][0]})
+                    self._commit()
+            except BaseException as e:
+                self._rollback(e)
+                return None
+            # Pending samples are newer than samples in DB
+            for item in list(self._pending.values())[:self._limit - len(batch.data)]:
+                batch.data.append(_row_data(item['ts'], [item[field] for field in FIELDS]))
+                batch.pending_ts.add(item['ts'])
+        if not batch.data:
+            return None
+        self._last_batch_id = batch.id
+        return batch
+
+    def _write_batch(self, batch, first_ts=None, last_ts=None, count=None):
+        """
+        Write record of batch (without commit)
+        """
+        self._cursor.execute('INSERT OR REPLACE INTO batches(id, state, first_ts, last_ts, rows, created) '
+                             'VALUES(:id, :state, :first_ts, :last_ts, :rows, :created)',
+                             {'id': batch.id, 'state': batch.state, 'first_ts': first_ts, 'last_ts': last_ts,
+                              'rows': len(batch.data) if count is None else count, 'created': int(time.time())})
+
+    def _commit(self):
+        with COMMIT_SECONDS.time(self._labels):
+            self._db.commit()
+
+    def _rollback(self, e):
+        print('{} DB error: {}'.format(str(datetime.datetime.now()), str(e)))
+        try:
+            self._db.rollback()
+        except BaseException:
+            pass
+
+    def clear_cache(self):
+        """
+        Ack batch which was sent, its samples are removed from cache
+        """
+        with self._lock:
+            batch = self._batch
+            if batch is None:
+                return
+            if self._cursor:
+                for ts in batch.pending_ts:
+                    self._pending.pop(ts, None)
+                if batch.durable:
+                    try:
+                        self._cursor.execute('DELETE FROM cache WHERE batch = :batch', {'batch': batch.id})
+                        self._cursor.execute('UPDATE batches SET state = :state WHERE id = :id', {'state': ACKED, 'id': batch.id})
+                        self._cursor.execute('DELETE FROM batches WHERE state = :state AND id <= :id',
+                                             {'state': ACKED, 'id': batch.id - KEEP_ACKED})
+                        self._commit()
+                    except BaseException as e:
+                        self._rollback(e)
+                        return # Batch isn't acked, it's resent
+            else:
+                sent = set(id(data) for data in batch.data)
+                self._cache_data = [data for data in self._cache_data if id(data) not in sent]
+            batch.state = ACKED
+            self._batch = None
@@ -0,0 +1,455 @@
+"""
+Common part of CO2 daemons
+
+Daemon reads MT8057 devices (and sensors of script), samples readings every
+'pause' seconds and sends samples to thingspeak.com channels and other sinks;
+samples are written to local log and history, local HTTP API and metrics are
+served. Everything is configured by config file (see thingspeak_config.ini).
+
+Scripts (Device with DHT sensor, mt8057 with MT8057 only) create Daemon or its
+subclass with own defaults and hooks:
+
+    create_sensors()    - return list of pairs (name, sensor) of other sensors
+                          (thread with poll(), interval, stop())
+    setup()             - initialize processing after sinks are created
+    process(readings)   - update dictionary of named readings of sample
+
+Config file is set by environment variable CLIMATE_CONFIG. Emulator of sensors
+(climate.emulator) should be installed by script before import of this module.
+"""
+import datetime
+import os
+import signal
+import sys
+import time
+import traceback
+
+import configparser
+
+from climate import mt8057
+from climate import snapshot
+from climate import aggregate
+from climate.cache import Cache, to_epoch
+from climate.datalog import DataLog
+from climate.tsstore import TimeSeriesStore
+from climate import httpapi
+from climate import metrics
+from climate import reporting
+from climate import sinks
+from climate import breaker
+from climate import thingspeak
+from climate.session import HttpSession
+from climate import netstatus
+from climate.uploader import Uploader, Sample
+
+LOOP_SECONDS = metrics.histogram('climate_loop_seconds', 'Duration of sampling loop')
+LOOP_PAUSE = metrics.gauge('climate_loop_pause_seconds', 'Pause between samples')
+OVERRUNS = metrics.counter('climate_loop_overruns_total', 'Sampling loops which took longer than pause')
+SEND_ERRORS = metrics.gauge('climate_send_error_count', 'Continuous local faults of sending of critical sinks')
+
+SINK_KINDS = ('influxdb', 'mqtt', 'file')
+
+def load_config(path):
+    """
+    Read config from file of environment variable CLIMATE_CONFIG or from 'path'
+    """
+    config = configparser.ConfigParser()
+    config.read(os.environ.get('CLIMATE_CONFIG') or path)
+    return config
+
+class Daemon(object):
+    """
+    Class for CO2 daemon
+    """
+    def __init__(self, config, directory, default_fields='field1:co2, field2:temp',
+                 default_store_columns='co2, temp', split=None, optional=()):
+        """
+        Class initialization
+        'directory' - default directory of cache (variable 'cache_dir'), 'split' - readings which are pairs of values
+        (e.g. {'humidity': ('humidity', 'temp2')}) for aggregator, 'optional' - readings which can be absent
+        (e.g. 'cq' until its filter is full), fields of other absent readings are None.
+        """
+        self.config = config
+        self.thingspeak_config = config['thingspeak.com']
+        self.debug = self.thingspeak_config.getboolean('debug', False) # Loging data sending to console
+        self.pause = int(self.thingspeak_config.get('pause', 30))      # Pause between data sending (seconds)
+        self.error_limit = int(self.thingspeak_config.get('error_limit', 120)) # Limit of continuous local faults of sending
+        self.snapshots = snapshot.SnapshotStore() # Last readings of all sensors
+        self._directory = directory
+        self._default_fields = default_fields
+        self._default_store_columns = default_store_columns
+        self._split = split
+        self._optional = optional
+        self._runtime_name = self.thingspeak_config.get('runtime', 'threads') # Runtime of daemon: threads or asyncio (Python 3)
+        self.send_error_cnt = 0
+        self.session = None
+        self.ip_provider = None
+        self.t_mt8057 = None
+        self.sensors = []   # Pairs (name, sensor) of other sensors
+        self.channels = []
+        self.all_sinks = [] # ThingSpeak channels and other sinks
+        self.uploaders = [] # Pairs (sink, uploader)
+        self.runtime = None
+        self.aggregator = None
+        self.data_log = None
+        self.ts_store = None
+        self.t_api = None
+        self.t_metrics = None
+
+    def create_sensors(self):
+        """
+        Return list of pairs (name, sensor) of sensors of script
+        """
+        return []
+
+    def setup(self):
+        """
+        Initialize processing of readings (sinks are created)
+        """
+        pass
+
+    def process(self, readings):
+        """
+        Update dictionary of named readings of sample
+        """
+        pass
+
+    def uses_reading(self, reading):
+        """
+        Check that reading is mapped to field of any sink
+        """
+        return any(name == reading for sink in self.all_sinks for field, name in sink.mapping)
+
+    def get_ip_address(self):
+        """
+        Return IP address of device (cached if provider is started)
+        """
+        if self.ip_provider:
+            return self.ip_provider.get()
+        return netstatus.lookup_ip_address()
+
+    def mt8057_devices(self):
+        """
+        Return list of MT8057 from config as tuples (name, port, serial)
+        Any found device is used if devices aren't described.
+        """
+        devices = []
+        for section in self.config.sections():
+            if section.startswith('mt8057:'):
+                device_config = self.config[section]
+                devices.append((section.partition(':')[2].strip(), device_config.get('port', ''), device_config.get('serial', '')))
+        return devices or [('', '', '')]
+
+    def create_channels(self):
+        """
+        Return list of thingspeak.com channels from config, default channel is the first
+        """
+        channels = []
+        sections = [section for section in self.config.sections() if section == 'thingspeak.com' or section.startswith('thingspeak.com:')]
+        for section in sorted(sections, key=lambda section: section != 'thingspeak.com'):
+            channel_config = self.config[section]
+            name = section.partition(':')[2].strip()
+            mapping = thingspeak.parse_fields(channel_config.get('fields', self._default_fields))
+            cache_dir = os.path.expanduser(channel_config.get('cache_dir', '') or self._directory)
+            channel_cache = Cache(os.path.join(cache_dir, 'thingspeak_cache{}.sqlite'.format('_' + name if name else '')),
+                                  limit=int(channel_config.get('max_bulk_size', 960)),
+                                  flush_size=int(channel_config.get('cache_flush_size', 10)),
+                                  flush_interval=int(channel_config.get('cache_flush_interval', 300)),
+                                  synchronous=channel_config.get('cache_synchronous', 'NORMAL'),
+                                  name=name or 'default')
+            channels.append(thingspeak.Channel(name, channel_config.get('key', ''), channel_config.get('url', ''), channel_config.get('bulk_url', ''),
+                                               mapping,
+                                               cache=channel_cache, status=self.get_ip_address,
+                                               bulk_interval=int(channel_config.get('bulk_interval', thingspeak.BULK_INTERVAL)),
+                                               max_bulk_size=int(channel_config.get('max_bulk_size', 960)),
+                                               session=self.session, debug=self.debug,
+                                               policy=reporting.create_policy(channel_config, mapping, name),
+                                               bulk_format=channel_config.get('bulk_format', 'json'), optional=self._optional,
+                                               precision=thingspeak.parse_precision(channel_config.get('bulk_precision', '')),
+                                               breaker=breaker.CircuitBreaker(name, threshold=int(channel_config.get('breaker_threshold', breaker.THRESHOLD)),
+                                                                              delay=float(channel_config.get('breaker_delay', breaker.DELAY)),
+                                                                              max_delay=float(channel_config.get('breaker_max_delay', breaker.MAX_DELAY)))))
+        return channels
+
+    def create_sinks(self):
+        """
+        Return list of other sinks from config (sections 'influxdb:<name>', 'mqtt:<name>' and 'file:<name>')
+        """
+        result = []
+        for section in self.config.sections():
+            kind, _, name = section.partition(':')
+            if kind in SINK_KINDS:
+                result.append(sinks.create_sink(kind, name.strip() or kind, self.config[section], session=self.session, debug=self.debug))
+        return result
+
+    def read_data(self, current_time):
+        """
+        Read data from sensors and put it to sending queues, return number of continuous sending errors
+        """
+        readings = dict((name, reading.value) for name, reading in self.snapshots.snapshot().items()) # Data reading
+        if self.debug:
+            for name, reading in sorted(self.snapshots.snapshot().items()): # Acquisition time of every reading
+                print("{} {}: {} (#{} at {})".format(str(datetime.datetime.now()), name, reading.value, reading.seq, reading.timestamp))
+        if self.aggregator:
+            readings.update(self.aggregator.roll()) # Statistics of readings since previous sample
+        self.process(readings)
+
+        timestamp = to_epoch(current_time)
+        for sink, uploader in self.uploaders:
+            fields = sink.fields(readings)
+            if not fields:
+                continue # Only optional readings are mapped and they are absent
+            if sink.policy and not sink.policy.report(timestamp, fields):
+                continue # Stable readings aren't sent
+            if self.debug:
+                print("{} sendData({},{},{})".format(str(datetime.datetime.now()), sink.name or 'default', current_time, sorted(fields.items())))
+            uploader.put(Sample(current_time, fields)) # Send data to Cloud and other sinks
+
+        if self.data_log:
+            fields = self.channels[0].fields(readings) # Data of default channel
+            self.data_log.write(current_time, [fields.get(field) for field, reading in self.channels[0].mapping])
+
+        if self.ts_store:
+            self.ts_store.append(current_time, [readings.get(name) for name in self.ts_store.columns])
+
+        return max([uploader.error_cnt for sink, uploader in self.uploaders if sink.critical] or [0])
+
+    def uploaders_alive(self):
+        """
+        Check that all uploaders are working
+        """
+        return all(uploader.is_alive() for sink, uploader in self.uploaders)
+
+    def _on_timer(self, tick):
+        """
+        Sampling by timer of asyncio runtime
+        """
+        with LOOP_SECONDS.time():
+            self.send_error_cnt = self.read_data(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(tick)))
+        if self.send_error_cnt >= self.error_limit or not self.uploaders_alive():
+            self.runtime.stop()
+
+    def _start(self):
+        """
+        Initialize and start sensors, sinks and services
+        """
+        config = self.thingspeak_config
+        if config.get('metrics_file', ''):
+            self.t_metrics = metrics.MetricsWriter(config.get('metrics_file', ''),
+                                                   interval=int(config.get('metrics_interval', 60)))
+            self.t_metrics.start()
+            print('{} Metrics writer was started.'.format(str(datetime.datetime.now())))
+
+        self.t_mt8057 = mt8057.DeviceManager(self.snapshots, self.mt8057_devices(), scan_interval=int(config.get('usb_scan_interval', 10)),
+                                             read_timeout=int(config.get('usb_read_timeout', mt8057.READ_TIMEOUT)),
+                                             decimation=int(config.get('mt8057_decimation', 1)),
+                                             changed_only=config.getboolean('mt8057_changed_only', False))
+        if self._runtime_name != 'asyncio':
+            self.t_mt8057.start()
+        print('{} MT8057 manager was initialized.'.format(str(datetime.datetime.now())))
+
+        for name, sensor in self.create_sensors():
+            self.sensors.append((name, sensor))
+            if self._runtime_name != 'asyncio':
+                sensor.start()
+            print('{} {} was initialized.'.format(str(datetime.datetime.now()), name))
+
+        self.ip_provider = netstatus.IpAddressProvider(ttl=int(config.get('ip_ttl', 300)))
+        self.ip_provider.start()
+        print('{} IP address provider was initialized.'.format(str(datetime.datetime.now())))
+
+        if config.getboolean('keep_alive', True):
+            gzip_min_size = int(config.get('gzip_min_size', 0))
+            self.session = HttpSession(timeout=thingspeak.TIMEOUT, gzip_min_size=gzip_min_size if gzip_min_size > 0 else None)
+
+        self.channels = self.create_channels()
+        for channel in self.channels:
+            if channel.backlog:
+                channel.backlog.start()
+        print('{} Channels were initialized: {}.'.format(str(datetime.datetime.now()), ', '.join(channel.name or 'default' for channel in self.channels)))
+        self.all_sinks = self.channels + self.create_sinks()
+        if len(self.all_sinks) > len(self.channels):
+            print('{} Sinks were initialized: {}.'.format(str(datetime.datetime.now()), ', '.join(sink.name for sink in self.all_sinks[len(self.channels):])))
+
+        if any(aggregate.is_aggregate(reading) for sink in self.all_sinks for field, reading in sink.mapping):
+            self.aggregator = aggregate.Aggregator(split=self._split)
+            self.snapshots.subscribe(self.aggregator.add)
+            print('{} Aggregator was initialized.'.format(str(datetime.datetime.now())))
+
+        self.setup()
+
+        if config.get('log', ''):
+            self.data_log = DataLog(config.get('log', ''), [reading for field, reading in self.channels[0].mapping],
+                                    fmt=config.get('log_format', 'csv'),
+                                    max_size=int(config.get('log_max_size', 10485760)),
+                                    rotate_interval=int(config.get('log_rotate_interval', 0)),
+                                    backups=int(config.get('log_backups', 10)),
+                                    compress=config.getboolean('log_compress', True),
+                                    flush_interval=int(config.get('log_flush_interval', 60)))
+            print('{} Log was initialized.'.format(str(datetime.datetime.now())))
+
+        if config.get('store', ''):
+            self.ts_store = TimeSeriesStore(config.get('store', ''),
+                                            [name.strip() for name in config.get('store_columns', self._default_store_columns).split(',')],
+                                            capacity=int(config.get('store_segment_size', 65536)),
+                                            max_segments=int(config.get('store_max_segments', 24)),
+                                            flush_interval=int(config.get('store_flush_interval', 60)))
+            print('{} History store was initialized.'.format(str(datetime.datetime.now())))
+
+        if int(config.get('api_port', 0)):
+            self.t_api = httpapi.ApiServer(self.snapshots, self.ts_store, config.get('api_address', ''),
+                                           int(config.get('api_port', 0)), debug=self.debug)
+            self.t_api.start()
+            print('{} API server was started on port {}.'.format(str(datetime.datetime.now()), self.t_api.port))
+
+    def _run_asyncio(self, queue_size):
+        """
+        Run sensors, sampling and sending by asyncio runtime
+        """
+        from climate import aio
+        # Worker threads for sampling, sending of every sink and reading of every sensor
+        self.runtime = aio.AsyncRuntime(workers=1 + len(self.all_sinks) + len(self.sensors) + len(self.mt8057_devices()))
+        # Devices are opened once, hot-plug is supported by threads runtime only
+        readers = self.t_mt8057.open_devices()
+        if not readers:
+            raise ValueError("Device wasn't found.")
+        for reader in readers:
+            reader.open()
+            self.runtime.add_sensor('MT8057 ' + reader.port, reader.poll, close=reader.release)
+        for name, sensor in self.sensors:
+            self.runtime.add_sensor(name, sensor.poll, interval=sensor.interval)
+        for sink in self.all_sinks:
+            self.uploaders.append((sink, self.runtime.add_uploader(sink.send, spill=sink.spill, size=queue_size,
+                                                                   name='uploader' + ('-' + sink.name if sink.name else ''))))
+        self.runtime.add_timer(self._on_timer, self.pause, overrun=OVERRUNS.inc)
+        print('{} Asyncio runtime was initialized.'.format(str(datetime.datetime.now())))
+        self.runtime.run()
+
+    def _run_threads(self, queue_size):
+        """
+        Run sampling loop, sensors and uploaders are threads
+        """
+        for sink in self.all_sinks:
+            # Samples which don't fit the queue are saved to cache or buffer of sink
+            uploader = Uploader(sink.send, spill=sink.spill, size=queue_size, name='uploader' + ('-' + sink.name if sink.name else ''))
+            uploader.start()
+            self.uploaders.append((sink, uploader))
+        print('{} Uploaders were initialized.'.format(str(datetime.datetime.now())))
+
+        next_loop = time.time()
+        while True: # Infinite loop for data sampling
+            try:
+                current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(next_loop))
+
+                with LOOP_SECONDS.time():
+                    self.send_error_cnt = self.read_data(current_time)
+                if self.send_error_cnt >= self.error_limit or not self.uploaders_alive():
+                    break
+            except SystemExit: # System Exit, leave loop
+                break
+            except KeyboardInterrupt:
+                # Leave loop only when KeyboardInterrupt was caught
+                print('{} KeyboardInterrupt was caught.'.format(str(datetime.datetime.now())))
+                break
+            except IOError as e: # File error, don't leave loop
+                print('{} I/O error: {}'.format(str(datetime.datetime.now()), str(e)))
+            except:
+                print('{} Unknown error in loop.'.format(str(datetime.datetime.now()))) # Don't leave loop
+                traceback.print_exc()
+            # Fixed-rate schedule, sampling clock doesn't depend on duration of loop
+            next_loop += self.pause
+            delay = next_loop - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                OVERRUNS.inc()
+                next_loop = time.time()
+
+    def _stop(self):
+        """
+        Stop sensors, uploaders and services, close sinks
+        """
+        if self.t_mt8057:
+            print('{} MT8057 manager is stopping...'.format(str(datetime.datetime.now())))
+            self.t_mt8057.stop()
+            if self.t_mt8057.is_alive():
+                self.t_mt8057.join()
+
+        for name, sensor in self.sensors:
+            print('{} {} is stopping...'.format(str(datetime.datetime.now()), name))
+            sensor.stop()
+            if sensor.is_alive():
+                sensor.join()
+
+        for sink, uploader in self.uploaders:
+            if isinstance(uploader, Uploader) and uploader.is_alive():
+                print('{} Uploader is stopping...'.format(str(datetime.datetime.now())))
+                uploader.stop()
+                uploader.join()
+
+        for channel in self.channels:
+            if channel.backlog and channel.backlog.is_alive():
+                print('{} Backlog uploader is stopping...'.format(str(datetime.datetime.now())))
+                channel.backlog.stop()
+                channel.backlog.join()
+
+        if self.ip_provider:
+            self.ip_provider.stop()
+            self.ip_provider.join()
+
+        if self.session:
+            self.session.close()
+
+        if self.t_api:
+            self.t_api.stop()
+
+        if self.t_metrics:
+            self.t_metrics.stop()
+            self.t_metrics.join()
+
+        if self.data_log:
+            self.data_log.close()
+
+        if self.ts_store:
+            self.ts_store.close()
+
+        for sink in self.all_sinks:
+            print('{} Sink {} is closing...'.format(str(datetime.datetime.now()), sink.name or 'default'))
+            sink.close()
+
+    def run(self):
+        """
+        Main daemon function, system is rebooted if limit of sending errors is reached
+        """
+        def signal_handler(signum, frame):
+            print('{} Signal SIGTERM was received.'.format(str(datetime.datetime.now())))
+            sys.exit(0)
+
+        print('{} CO2 daemon started.'.format(str(datetime.datetime.now())))
+        LOOP_PAUSE.set(self.pause)
+        SEND_ERRORS.set_function(lambda: self.send_error_cnt)
+        try:
+            signal.signal(signal.SIGTERM, signal_handler)
+            self._start()
+            queue_size = int(self.thingspeak_config.get('queue_size', 100))
+            if self._runtime_name == 'asyncio':
+                self._run_asyncio(queue_size)
+            else:
+                self._run_threads(queue_size)
+        except KeyboardInterrupt:
+            print('{} KeyboardInterrupt was caught.'.format(str(datetime.datetime.now())))
+        except SystemExit: # System Exit
+            pass
+        except BaseException as e:
+            print('{} Unknown error: {}'.format(str(datetime.datetime.now()), str(e)))
+            traceback.print_exc()
+        except:
+            print('{} Unknown error.'.format(str(datetime.datetime.now())))
+            traceback.print_exc()
+        finally:
+            self._stop()
+
+        print('{} CO2 daemon stopped.'.format(str(datetime.datetime.now())))
+        if self.send_error_cnt >= self.error_limit:
+            print('{} System reboot...'.format(str(datetime.datetime.now())))
+            os.system("sudo reboot")
@@ -0,0 +1,188 @@
+"""
+Local log of samples
+
+File is kept open with buffer and flushed every 'flush_interval' seconds
+(it's the maximal loss of log on power failure), so one sample doesn't cost
+open/write/close calls on SD card. File is rotated by size and/or time,
+rotated files are named '<log>.<YYYYmmdd-HHMMSS>' and compressed by gzip in
+background, only the last 'backups' files are kept.
+
+Formats of log:
+* csv - lines 'time,value1,value2,...' (as old log)
+* binary - header line 'CLOG1,column1,column2,...' and fixed-width records:
+  UTC epoch seconds (int32) and values (float32, NaN for unknown value)
+"""
+import datetime
+import glob
+import gzip
+import math
+import os
+import shutil
+import struct
+import threading
+import time
+
+from climate.cache import to_epoch, from_epoch
+
+FORMATS = ('csv', 'binary')
+BINARY_MAGIC = b'CLOG1'
+MAX_SIZE = 10 * 1024 * 1024 # Maximal size of log file (bytes)
+BUFFER_SIZE = 8192          # Size of write buffer (bytes)
+
+def record_struct(count):
+    """
+    Return struct of binary record with 'count' values
+    """
+    return struct.Struct('<i{}f'.format(count))
+
+def open_log(path):
+    """
+    Open log file (rotated file can be compressed) for reading
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def read_records(path):
+    """
+    Read binary log, return list of columns and generator of records (time, values)
+    """
+    f = open_log(path)
+    header = f.readline().decode('utf-8').rstrip('\n').split(',')
+    if header[0].encode('ascii') != BINARY_MAGIC:
+        f.close()
+        raise ValueError('{} is not binary log'.format(path))
+    columns = header[1:]
+    record = record_struct(len(columns))
+
+    def records():
+        try:
+            while True:
+                data = f.read(record.size)
+                if len(data) < record.size: # Incomplete record is written on power failure
+                    break
+                item = record.unpack(data)
+                yield from_epoch(item[0]), [None if math.isnan(value) else value for value in item[1:]]
+        finally:
+            f.close()
+
+    return columns, records()
+
+class DataLog(object):
+    """
+    Class for local log of samples
+    """
+    def __init__(self, path, columns, fmt='csv', max_size=MAX_SIZE, rotate_interval=0, backups=10,
+                 compress=True, flush_interval=60, buffer_size=BUFFER_SIZE):
+        """
+        Class initialization
+        'max_size' (bytes) and 'rotate_interval' (seconds) - limits of log file (0 - unlimited).
+        """
+        if fmt not in FORMATS:
+            raise ValueError('Unknown format of log: {}'.format(fmt))
+        self._path = os.path.expanduser(path)
+        self._columns = list(columns)
+        self._format = fmt
+        self._max_size = max_size
+        self._rotate_interval = rotate_interval
+        self._backups = backups
+        self._compress = compress
+        self._flush_interval = flush_interval
+        self._buffer_size = buffer_size
+        self._record = record_struct(len(self._columns))
+        self._file = None
+        self._size = 0
+        self._opened = 0
+        self._last_flush = 0
+        self._compressor = None
+
+    def _open(self):
+        self._file = open(self._path, 'ab', self._buffer_size)
+        self._size = self._file.tell()
+        self._opened = time.time()
+        self._last_flush = self._opened
+        if self._size == 0 and self._format == 'binary':
+            self._write(b','.join([BINARY_MAGIC] + [column.encode('utf-8') for column in self._columns]) + b'\n')
+
+    def _write(self, data):
+        self._file.write(data)
+        self._size += len(data)
+
+    def write(self, current_time, values):
+        """
+        Write sample to log
+        """
+        if self._file is None:
+            self._open()
+        if self._format == 'binary':
+            self._write(self._record.pack(to_epoch(current_time),
+                                          *[float('nan') if value is None else float(value) for value in values]))
+        else:
+            self._write('{},{}\n'.format(current_time, ','.join(str(value) for value in values)).encode('utf-8'))
+        now = time.time()
+        if now - self._last_flush >= self._flush_interval:
+            self.flush()
+        if (self._max_size and self._size >= self._max_size) or \
+           (self._rotate_interval and now - self._opened >= self._rotate_interval):
+            self.rotate()
+
+    def flush(self):
+        """
+        Write buffer to file
+        """
+        if self._file is not None:
+            self._file.flush()
+            self._last_flush = time.time()
+
+    def rotate(self):
+        """
+        Close current file and start new one
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._wait_compressor()
+        stamp = '{}.{}'.format(self._path, time.strftime('%Y%m%d-%H%M%S'))
+        rotated = stamp
+        number = 0
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'): # Several rotations per second
+            number += 1
+            rotated = '{}-{}'.format(stamp, number)
+        os.rename(self._path, rotated)
+        print('{} Log was rotated to {}.'.format(str(datetime.datetime.now()), rotated))
+        # Compression of rotated file doesn't delay sampling
+        self._compressor = threading.Thread(target=self._finish_rotation, args=(rotated,), name='log-compressor')
+        self._compressor.start()
+
+    def _finish_rotation(self, rotated):
+        try:
+            if self._compress:
+                with open(rotated, 'rb') as src:
+                    dst = gzip.open(rotated + '.gz', 'wb')
+                    try:
+                        shutil.copyfileobj(src, dst)
+                    finally:
+                        dst.close()
+                os.remove(rotated)
+            if self._backups:
+                pattern = (glob.escape(self._path) if hasattr(glob, 'escape') else self._path) + '.*'
+                old_files = sorted(glob.glob(pattern), key=os.path.getmtime)
+                for old_file in old_files[:-self._backups]:
+                    os.remove(old_file)
+        except (IOError, OSError) as e:
+            print('{} Log rotation error: {}'.format(str(datetime.datetime.now()), str(e)))
+
+    def _wait_compressor(self):
+        if self._compressor is not None:
+            self._compressor.join()
+            self._compressor = None
+
+    def close(self):
+        """
+        Flush and close log
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._wait_compressor()
@@ -0,0 +1,277 @@
+"""
+Emulator of MT8057 and DHT sensors
+
+Virtual MT8057 has interface of PyUSB device which is used by climate.mt8057:
+it produces encrypted 8-byte reports (encoded by mt8057_codec.encode_packet)
+with CO2, temperature and other operations of real device at configured rate
+(packets per second, 0 - without limit), part of reports can have wrong
+checksum. Values change by random walk and every value is repeated by several
+reports like real device does.
+
+install() registers modules 'usb' (with virtual devices only) and
+'Adafruit_DHT' (fake sensor with random read failures), so daemon and
+benchmarks run without hardware. Daemons install emulator when environment
+variable CLIMATE_EMULATOR is set, its value is options like
+'devices=2,rate=100,bad_ratio=0.01' (see install()).
+"""
+import array
+import errno
+import random
+import sys
+import threading
+import time
+import types
+
+from climate import mt8057_codec
+
+VID = 0x04d9
+PID = 0xa052
+RATE = 10               # Packets per second (real device sends several packets per second)
+OTHER_OPS = (0x6d, 0x6e, 0x71, 0x41, 0x43, 0x4f, 0x52, 0x56, 0x57) # Operations which aren't used by daemon
+REPEAT = 8              # Reports of operation with the same value
+LIBUSB_ERROR_TIMEOUT = -7
+
+def kelvin16(temperature):
+    """
+    Encode temperature (Celsius) like MT8057
+    """
+    return int(round((temperature + 273.15) / 0.0625)) & 0xffff
+
+class USBError(IOError):
+    """
+    Error of virtual USB (like usb.core.USBError)
+    """
+    def __init__(self, strerror, error_code=None, errno=None):
+        IOError.__init__(self, errno, strerror)
+        self.backend_error_code = error_code
+
+class USBTimeoutError(USBError):
+    pass
+
+class VirtualMT8057(object):
+    """
+    Class for virtual MT8057 with interface of PyUSB device
+    """
+    idVendor = VID
+    idProduct = PID
+
+    def __init__(self, bus=1, port=1, serial='', rate=RATE, bad_ratio=0.0, other_ratio=0.5,
+                 co2=800, temperature=23.0, seed=None):
+        """
+        Class initialization
+        'rate' - packets per second (0 - without limit), 'bad_ratio' - part of packets with wrong
+        checksum, 'other_ratio' - part of packets of other operations.
+        """
+        self.bus = bus
+        self.port_numbers = (port,)
+        self.serial = serial
+        self.iSerialNumber = 3 if serial else 0
+        self._rate = rate
+        self._bad_ratio = bad_ratio
+        self._other_ratio = other_ratio
+        self._random = random.Random(seed)
+        self._co2 = co2
+        self._temperature = temperature
+        self._lock = threading.Lock()
+        self._start = None
+        self._kernel_driver = True
+        self.unplugged = False
+        self.sent = 0           # Number of sent packets
+        self.bad = 0            # Number of packets with wrong checksum
+        self.values = {}        # Operation -> the last sent value
+
+    def is_kernel_driver_active(self, interface):
+        return self._kernel_driver
+
+    def detach_kernel_driver(self, interface):
+        self._kernel_driver = False
+
+    def attach_kernel_driver(self, interface):
+        self._kernel_driver = True
+
+    def set_configuration(self):
+        self._check()
+
+    def __getitem__(self, index):
+        return {(0, 0): [0x81]} # Configuration -> interface -> endpoint
+
+    def ctrl_transfer(self, request_type, request, value, index, data, timeout=None):
+        self._check()
+        with self._lock:
+            self._start = time.time()
+        return len(data)
+
+    def _check(self):
+        if self.unplugged:
+            raise USBError('No such device', -4, errno.ENODEV)
+
+    def read(self, endpoint, size, timeout=None):
+        """
+        Return the next packet, USBTimeoutError is raised if it isn't ready in 'timeout' ms
+        """
+        self._check()
+        with self._lock:
+            if self._start is None:
+                self._start = time.time()
+            due = self._start + float(self.sent) / self._rate if self._rate else 0
+            delay = due - time.time()
+            if timeout and delay > timeout / 1000.0:
+                time.sleep(timeout / 1000.0)
+                raise USBTimeoutError('Operation timed out', LIBUSB_ERROR_TIMEOUT, errno.ETIMEDOUT)
+            if delay > 0:
+                time.sleep(delay)
+            data = self._packet()
+            self.sent += 1
+        return array.array('B', data[:size])
+
+    def _packet(self):
+        """
+        Return encrypted packet of the next operation
+        """
+        number = self.sent // 2
+        if self._random.random() < self._other_ratio:
+            op = OTHER_OPS[number % len(OTHER_OPS)]
+            w = number & 0xffff
+        elif self.sent % 2:
+            op = mt8057_codec.OP_TEMPERATURE
+            if number % REPEAT == 0:
+                self._temperature = min(max(self._temperature + self._random.uniform(-0.2, 0.2), 15), 30)
+            w = kelvin16(self._temperature)
+        else:
+            op = mt8057_codec.OP_CO2
+            if number % REPEAT == 0:
+                self._co2 = int(min(max(self._co2 + self._random.randint(-20, 20), 400), 3000))
+            w = self._co2
+        data = mt8057_codec.encode_packet(op, w)
+        if self._random.random() < self._bad_ratio:
+            data[mt8057_codec.SHUFFLE[3]] ^= 0x08 # Decoded checksum differs
+            self.bad += 1
+        else:
+            self.values[op] = w
+        return data
+
+class VirtualDHT(object):
+    """
+    Class for fake DHT sensor with interface of Adafruit_DHT
+    """
+    DHT11 = 11
+    DHT22 = 22
+    AM2302 = 22
+
+    def __init__(self, humidity=45.0, temperature=23.0, fail_ratio=0.1, spike_ratio=0.01, seed=None):
+        """
+        Class initialization
+        'fail_ratio' - part of failed reads, 'spike_ratio' - part of reads with wrong values.
+        """
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._humidity = humidity
+        self._temperature = temperature
+        self._fail_ratio = fail_ratio
+        self._spike_ratio = spike_ratio
+        self.reads = 0
+        self.failures = 0
+
+    def read(self, sensor, pin):
+        """
+        Read sensor once, return (humidity, temperature) or (None, None)
+        """
+        with self._lock:
+            self.reads += 1
+            if self._random.random() < self._fail_ratio:
+                self.failures += 1
+                return None, None
+            self._humidity = min(max(self._humidity + self._random.uniform(-0.5, 0.5), 20), 80)
+            self._temperature = min(max(self._temperature + self._random.uniform(-0.1, 0.1), 15), 30)
+            humidity, temperature = self._humidity, self._temperature
+            if self._random.random() < self._spike_ratio:
+                humidity += self._random.choice((-1, 1)) * 30
+            if sensor == self.DHT11: # DHT11 has integer readings
+                return float(int(humidity)), float(int(temperature))
+            return round(humidity, 1), round(temperature, 1)
+
+    def read_retry(self, sensor, pin, retries=15, delay_seconds=2):
+        """
+        Read sensor with retries like Adafruit_DHT.read_retry
+        """
+        for i in range(retries):
+            humidity, temperature = self.read(sensor, pin)
+            if humidity is not None and temperature is not None:
+                return humidity, temperature
+            time.sleep(delay_seconds)
+        return None, None
+
+virtual_devices = [] # Virtual MT8057 of installed emulator
+dht = None      # Virtual DHT of installed emulator
+
+def _find(find_all=False, idVendor=None, idProduct=None, **kwargs):
+    found = [dev for dev in virtual_devices if not dev.unplugged and
+             idVendor in (None, dev.idVendor) and idProduct in (None, dev.idProduct)]
+    if find_all:
+        return iter(found)
+    return found[0] if found else None
+
+def _get_string(dev, index):
+    return dev.serial or None
+
+def usb_modules():
+    """
+    Return modules 'usb', 'usb.core' and 'usb.util' with virtual devices
+    """
+    usb = types.ModuleType('usb')
+    core = types.ModuleType('usb.core')
+    util = types.ModuleType('usb.util')
+    core.USBError = USBError
+    core.USBTimeoutError = USBTimeoutError
+    core.find = _find
+    util.CTRL_OUT = 0x00
+    util.CTRL_TYPE_CLASS = 0x20
+    util.CTRL_RECIPIENT_INTERFACE = 0x01
+    util.build_request_type = lambda direction, type, recipient: direction | type | recipient
+    util.get_string = _get_string
+    util.release_interface = lambda dev, interface: None
+    util.dispose_resources = lambda dev: None
+    usb.core = core
+    usb.util = util
+    return {'usb': usb, 'usb.core': core, 'usb.util': util}
+
+def dht_module():
+    """
+    Return module 'Adafruit_DHT' with virtual sensor
+    """
+    module = types.ModuleType('Adafruit_DHT')
+    for name in ('DHT11', 'DHT22', 'AM2302'):
+        setattr(module, name, getattr(VirtualDHT, name))
+    module.read = dht.read
+    module.read_retry = dht.read_retry
+    return module
+
+def parse_options(text):
+    """
+    Parse options like 'devices=2,rate=100', return dictionary
+    """
+    options = {}
+    for item in text.split(','):
+        name, _, value = item.partition('=')
+        if name.strip() and value.strip():
+            try:
+                options[name.strip()] = int(value)
+            except ValueError:
+                options[name.strip()] = float(value)
+    return options
+
+def install(devices=1, rate=RATE, bad_ratio=0.0, other_ratio=0.5, dht_fail_ratio=0.1, dht_spike_ratio=0.01, seed=None):
+    """
+    Register emulated modules 'usb' and 'Adafruit_DHT' with 'devices' virtual MT8057
+    Return list of virtual MT8057. Modules should be installed before import of climate.mt8057.
+    """
+    global dht
+    del virtual_devices[:]
+    for i in range(int(devices)):
+        virtual_devices.append(VirtualMT8057(bus=1, port=i + 1, serial='EMU{:04d}'.format(i), rate=rate,
+                                             bad_ratio=bad_ratio, other_ratio=other_ratio, co2=600 + 100 * i,
+                                             seed=None if seed is None else seed + i))
+    dht = VirtualDHT(fail_ratio=dht_fail_ratio, spike_ratio=dht_spike_ratio, seed=seed)
+    sys.modules.update(usb_modules())
+    sys.modules['Adafruit_DHT'] = dht_module()
+    return list(virtual_devices)
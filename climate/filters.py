@@ -0,0 +1,92 @@
+"""
+Incremental filters of noisy sensor readings
+
+Filters keep fixed window of the last values: sliding window is stored twice,
+in arrival order (to drop the oldest value) and sorted (to find median by
+index), so every update is one binary search plus O(window) list shift.
+Median filter returns median of window. Hampel filter returns value itself,
+but single-sample spikes (farther from median than 'threshold' scaled median
+absolute deviations) are replaced by median.
+"""
+import bisect
+import collections
+
+MAD_SCALE = 1.4826 # Scale of median absolute deviation to standard deviation of normal distribution
+
+class MedianFilter(object):
+    """
+    Class for running median of the last 'window' values
+    """
+    def __init__(self, window=5):
+        """
+        Class initialization
+        """
+        self._window = max(1, int(window))
+        self._values = collections.deque()
+        self._sorted = []
+
+    def median(self):
+        """
+        Return median of window (None for empty window)
+        """
+        count = len(self._sorted)
+        if not count:
+            return None
+        middle = count // 2
+        if count % 2:
+            return self._sorted[middle]
+        return (self._sorted[middle - 1] + self._sorted[middle]) / 2.0
+
+    def _push(self, value):
+        if len(self._values) >= self._window:
+            oldest = self._values.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self._values.append(value)
+        bisect.insort(self._sorted, value)
+
+    def update(self, value):
+        """
+        Add value to window, return filtered value
+        """
+        self._push(value)
+        return self.median()
+
+class HampelFilter(MedianFilter):
+    """
+    Class for Hampel filter (outliers are replaced by median of window)
+    Deviation smaller than 'min_deviation' is never an outlier, so changes of
+    coarse sensors (e.g. DHT11 with integer values and zero MAD) aren't rejected.
+    """
+    def __init__(self, window=5, threshold=3.0, min_deviation=0.0):
+        """
+        Class initialization
+        """
+        MedianFilter.__init__(self, window)
+        self._threshold = threshold
+        self._min_deviation = min_deviation
+        self.outliers = 0
+
+    def update(self, value):
+        """
+        Add value to window, return value or median if value is outlier
+        """
+        self._push(value)
+        median = self.median()
+        mad = sorted(abs(item - median) for item in self._sorted)[len(self._sorted) // 2]
+        if abs(value - median) > max(self._threshold * MAD_SCALE * mad, self._min_deviation):
+            self.outliers += 1
+            return median
+        return value
+
+def create_filter(kind, window=5, threshold=3.0, min_deviation=0.0):
+    """
+    Return filter by kind ('median', 'hampel'), None - without filtering
+    """
+    kind = (kind or 'none').lower()
+    if kind == 'median':
+        return MedianFilter(window)
+    if kind == 'hampel':
+        return HampelFilter(window, threshold, min_deviation)
+    if kind == 'none':
+        return None
+    raise ValueError('Unknown filter: {}'.format(kind))
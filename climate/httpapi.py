@@ -0,0 +1,193 @@
+"""
+Local HTTP read API of daemon
+
+GET /latest - the last readings of all sensors from snapshot store
+GET /range?start=...&end=...&columns=co2,temp&step=300 - samples of local
+    history store (all rows or means by 'step' seconds), response is streamed
+    by chunks, so large ranges aren't kept in memory
+GET /metrics - metrics of daemon (climate.metrics) in Prometheus text format
+
+Times are UTC epoch seconds or 'YYYY-mm-dd HH:MM:SS' ('T' is allowed as
+separator), default range is the last 24 hours. Output is JSON by default or
+CSV with parameter 'format=csv'. Server runs in separate thread and every
+request is handled by own thread, requests don't touch sampling loop or Cloud.
+"""
+import datetime
+import json
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+
+from climate import metrics
+from climate.cache import to_epoch, from_epoch
+
+PORT = 8057
+DEFAULT_RANGE = 24 * 3600   # Default range of history (seconds)
+PRECISION = 3               # Number of decimal digits of values
+CHUNK_ROWS = 500            # Rows per chunk of streamed response
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv; charset=utf-8'
+}
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def parse_time(text):
+    """
+    Parse time as epoch seconds or UTC time string
+    """
+    text = text.strip()
+    if text.isdigit():
+        return int(text)
+    return to_epoch(text.replace('T', ' ')[:19])
+
+def _round(value):
+    if isinstance(value, float):
+        return round(value, PRECISION)
+    if isinstance(value, (tuple, list)):
+        return [_round(item) for item in value]
+    return value
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """
+    Class for handling of API requests
+    """
+    protocol_version = 'HTTP/1.1' # Keep-alive for polling clients, chunks for streaming
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path == '/metrics':
+            return self._send(200, METRICS_CONTENT_TYPE, metrics.REGISTRY.render())
+        fmt = query.get('format', ['json'])[0]
+        if fmt not in CONTENT_TYPES:
+            return self._error(400, 'Unknown format: {}'.format(fmt))
+        if parts.path == '/latest':
+            return self._latest(fmt)
+        if parts.path == '/range':
+            return self._range(query, fmt)
+        return self._error(404, 'Not found')
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, 'application/json', json.dumps({'error': message}))
+
+    def _latest(self, fmt):
+        snapshot = sorted(self.server.snapshots.snapshot().items())
+        if fmt == 'csv':
+            lines = ['name,value,seq,timestamp']
+            for name, reading in snapshot:
+                value = reading.value
+                if isinstance(value, (tuple, list)):
+                    value = ' '.join(str(item) for item in _round(value))
+                lines.append('{},{},{},{}'.format(name, '' if value is None else _round(value), reading.seq,
+                                                  '' if reading.timestamp is None else round(reading.timestamp, PRECISION)))
+            return self._send(200, CONTENT_TYPES[fmt], '\n'.join(lines) + '\n')
+        result = dict((name, {'value': _round(reading.value), 'seq': reading.seq, 'timestamp': reading.timestamp})
+                      for name, reading in snapshot)
+        self._send(200, CONTENT_TYPES[fmt], json.dumps({'time': time.time(), 'readings': result}))
+
+    def _range(self, query, fmt):
+        history = self.server.history
+        if history is None:
+            return self._error(404, 'Local history is disabled')
+        try:
+            end = parse_time(query['end'][0]) if 'end' in query else int(time.time()) + 1
+            start = parse_time(query['start'][0]) if 'start' in query else end - DEFAULT_RANGE
+            step = int(query['step'][0]) if 'step' in query else 0
+            columns = [column for column in query['columns'][0].split(',') if column] if 'columns' in query else history.columns
+        except (ValueError, OverflowError) as e:
+            return self._error(400, str(e))
+        if step < 0 or start > end:
+            return self._error(400, 'Wrong range')
+
+        if step:
+            rows = ((ts, values) for ts, values, count in history.read_downsampled(start, end, step, columns))
+        else:
+            rows = history.read(start, end, columns)
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[fmt])
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        if fmt == 'csv':
+            self._chunk('time,{}\n'.format(','.join(columns)))
+        else:
+            self._chunk('{{"columns": {}, "rows": ['.format(json.dumps(columns)))
+        lines = []
+        first = True
+        for ts, values in rows:
+            values = [_round(value) for value in values]
+            if fmt == 'csv':
+                lines.append('{},{}\n'.format(from_epoch(ts), ','.join('' if value is None else str(value) for value in values)))
+            else:
+                lines.append(('' if first else ',') + json.dumps([from_epoch(ts)] + values))
+                first = False
+            if len(lines) >= CHUNK_ROWS:
+                self._chunk(''.join(lines))
+                lines = []
+        self._chunk(''.join(lines) + ('' if fmt == 'csv' else ']}'))
+        self.wfile.write(b'0\r\n\r\n') # The last chunk
+
+    def _chunk(self, text):
+        if text:
+            data = text.encode('utf-8')
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+class ApiServer(threading.Thread):
+    """
+    Class for HTTP server of API
+    """
+    def __init__(self, snapshots, history=None, address='', port=PORT, debug=False):
+        """
+        Class initialization, port is bound immediately
+        'snapshots' - snapshot store of readings, 'history' - local history store or None.
+        """
+        threading.Thread.__init__(self, name="api")
+        self.daemon = True
+        self._server = ThreadingServer((address, port), ApiHandler)
+        self._server.snapshots = snapshots
+        self._server.history = history
+        self._server.debug = debug
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def run(self):
+        """
+        Serve requests until stop
+        """
+        self._server.serve_forever(poll_interval=0.5)
+
+    def stop(self):
+        """
+        Stop server
+        """
+        if self.is_alive():
+            self._server.shutdown()
+        self._server.server_close()
+        print('{} API server was stopped.'.format(str(datetime.datetime.now())))
@@ -0,0 +1,279 @@
+"""
+In-process metrics of daemon
+
+Counters, gauges and histograms are registered in registry (REGISTRY by
+default) by modules which update them, values can have labels (e.g. name of
+device or channel). Counter or gauge can be calculated by function when
+metrics are exported (e.g. from counter of object or depth of cache), so
+nothing is done on hot paths.
+
+Metrics are exported in Prometheus text format by endpoint '/metrics' of
+local HTTP API and/or written to file every 'interval' seconds by
+MetricsWriter (file is replaced atomically, so it can be read by
+textfile collector of node_exporter).
+"""
+import datetime
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Seconds
+
+def _format_labels(names, values, extra=''):
+    items = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+class Metric(object):
+    """
+    Base class of metrics, values are kept by tuples of label values
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        """
+        Class initialization
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('Metric {} has labels {}'.format(self.name, self.labelnames))
+        return tuple(str(label) for label in labels)
+
+    def remove(self, *labels):
+        """
+        Remove value with labels (e.g. of removed device)
+        """
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def set_function(self, function, labels=()):
+        """
+        Value is returned by function on export (None - value is skipped)
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = function
+
+    def samples(self):
+        """
+        Return list of samples (suffix, label values, extra label, value)
+        """
+        with self._lock:
+            items = sorted(self._values.items())
+        result = []
+        for key, value in items:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception: # Source of value is closed
+                    value = None
+            if value is not None:
+                result.append(('', key, '', value))
+        return result
+
+    def render(self):
+        """
+        Return metric in Prometheus text format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.labelnames, key, extra), _format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """
+    Class for increasing counter, it can be calculated by function (e.g. from
+    counter of object which is updated on hot path)
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, labels=()):
+        with self._lock:
+            value = self._values.get(self._key(labels), 0)
+        return value() if callable(value) else value
+
+class Gauge(Metric):
+    """
+    Class for gauge, value is set or calculated by function on export
+    """
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, labels=()):
+        with self._lock:
+            value = self._values.get(self._key(labels), 0)
+        return value() if callable(value) else value
+
+class Histogram(Metric):
+    """
+    Class for histogram of values (e.g. latencies) with fixed buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * len(self.buckets), 0.0, 0] # Counts of buckets, sum, count
+            counts = item[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            item[1] += value
+            item[2] += 1
+
+    def time(self, labels=()):
+        """
+        Return timer for 'with' statement
+        """
+        return _Timer(self, labels)
+
+    def count(self, labels=()):
+        with self._lock:
+            item = self._values.get(self._key(labels))
+            return item[2] if item else 0
+
+    def samples(self):
+        result = []
+        with self._lock:
+            items = sorted((key, (list(item[0]), item[1], item[2])) for key, item in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                result.append(('_bucket', key, 'le="{}"'.format(_format_value(float(bound))), cumulative))
+            result.append(('_bucket', key, 'le="+Inf"', count))
+            result.append(('_sum', key, '', total))
+            result.append(('_count', key, '', count))
+        return result
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.time() - self._start, self._labels)
+        return False
+
+class Registry(object):
+    """
+    Class for registry of metrics
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        Register metric, metric with the same name is returned if it's registered already
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def get(self, name):
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render(self):
+        """
+        Return all metrics in Prometheus text format
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return ''.join(metric.render() + '\n' for name, metric in metrics)
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+class MetricsWriter(threading.Thread):
+    """
+    Class for periodic writing of metrics to file
+    """
+    def __init__(self, path, interval=60, registry=REGISTRY):
+        """
+        Class initialization
+        """
+        threading.Thread.__init__(self, name="metrics")
+        self.daemon = True
+        self._event_stop = threading.Event()
+        self._path = os.path.expanduser(path)
+        self._interval = interval
+        self._registry = registry
+
+    def stop(self):
+        """
+        Stop writing, metrics are written the last time
+        """
+        self._event_stop.set()
+
+    def write(self):
+        """
+        Write metrics to temporary file and replace file by it
+        """
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(self._registry.render())
+            os.rename(temp_path, self._path)
+        except (IOError, OSError) as e:
+            print('{} Metrics writing error: {}'.format(str(datetime.datetime.now()), str(e)))
+
+    def run(self):
+        """
+        Loop of metrics writing
+        """
+        while not self._event_stop.wait(self._interval):
+            self.write()
+        self.write()
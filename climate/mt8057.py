@@ -0,0 +1,318 @@
+"""
+MT8057 CO2/temperature sensors on USB
+
+Several devices can be used by one process: devices are selected by USB
+bus-port (e.g. '1-1.2') or serial number, every device has its own reader
+thread and publishes readings '<name>.co2' and '<name>.temp' to snapshot store
+(without prefix for device with empty name). Devices are rescanned periodically,
+so unplugged device is reopened when it's plugged again.
+
+USB reads use bounded timeout, so reader notices stop() without new packets.
+Decoding can be rate-limited: only every Nth packet of every operation is
+decoded ('decimation') and/or values which are equal to the previous value
+of the same operation aren't published ('changed_only'). Operation of packet is
+found by 2 table lookups, packets of unused operations are never decoded.
+Decoded values are compared instead of raw packets: packet of the same value
+isn't always the same (e.g. unused bytes of packet).
+"""
+import datetime
+import errno
+import threading
+
+import usb.core
+import usb.util
+
+from climate import metrics
+from climate import mt8057_codec
+
+VID = 0x04d9
+PID = 0xa052
+READ_TIMEOUT = 1000 # Timeout of USB read (ms), it's maximal delay of stopping
+LIBUSB_ERROR_TIMEOUT = -7
+
+PACKETS = metrics.counter('climate_mt8057_packets_total', 'Packets received from MT8057', ['device'])
+BAD_PACKETS = metrics.counter('climate_mt8057_bad_packets_total', 'Packets of MT8057 with wrong checksum or end', ['device'])
+DECODED = metrics.counter('climate_mt8057_decoded_packets_total', 'Decoded packets of MT8057', ['device'])
+
+TIMEOUT_ERRORS = tuple(getattr(usb.core, name) for name in ('USBTimeoutError',) if hasattr(usb.core, name))
+
+def is_timeout(e):
+    """
+    Check that USB error is timeout (old versions of PyUSB don't have USBTimeoutError)
+    """
+    if isinstance(e, TIMEOUT_ERRORS):
+        return True
+    return getattr(e, 'errno', None) == errno.ETIMEDOUT or getattr(e, 'backend_error_code', None) == LIBUSB_ERROR_TIMEOUT
+
+def find_devices():
+    """
+    Return list of all connected MT8057
+    """
+    return list(usb.core.find(find_all=True, idVendor=VID, idProduct=PID))
+
+def device_port(dev):
+    """
+    Return USB bus-port of device (like '1-1.2' in sysfs)
+    """
+    ports = getattr(dev, 'port_numbers', None) or ()
+    return '{}-{}'.format(dev.bus, '.'.join(str(port) for port in ports))
+
+def device_serial(dev):
+    """
+    Return serial number of device or None
+    """
+    try:
+        if dev.iSerialNumber:
+            return usb.util.get_string(dev, dev.iSerialNumber)
+    except (usb.core.USBError, ValueError):
+        pass
+    return None
+
+class mt8057(threading.Thread):
+    """
+    Class for MT8057 control
+    """
+    VID = VID
+    PID = PID
+    RW_TIMEOUT = READ_TIMEOUT
+    OPERATIONS = (mt8057_codec.OP_TEMPERATURE, mt8057_codec.OP_CO2)
+    REQUEST_TYPE_SEND = usb.util.build_request_type(
+        usb.util.CTRL_OUT,
+        usb.util.CTRL_TYPE_CLASS,
+        usb.util.CTRL_RECIPIENT_INTERFACE)
+    REQ_HID_SET_REPORT = 0x09
+    HID_REPORT_TYPE_FEATURE = 0x03 << 8
+
+    magic_buf = list(mt8057_codec.MAGIC_BUF)
+
+    def __init__(self, store, dev=None, name='', read_timeout=READ_TIMEOUT, decimation=1, changed_only=False):
+        """
+        MT8057 initialization
+        The first found device is used if 'dev' isn't set.
+        'read_timeout' - timeout of USB read (ms), 'decimation' - only every Nth packet
+        of operation is decoded, 'changed_only' - repeated values aren't published.
+        """
+        threading.Thread.__init__(self, name="mt" + ('-' + name if name else ''))
+        self._event_stop = threading.Event()
+        self._read_timeout = read_timeout if read_timeout and read_timeout > 0 else self.RW_TIMEOUT
+        self._decimation = max(1, int(decimation))
+        self._changed_only = changed_only
+        self._counts = {}   # Operation -> number of received packets
+        self._last = {}     # Operation -> the last published value
+        self.packets = 0    # Number of received packets
+        self.decoded = 0    # Number of decoded packets
+        self.bad = 0        # Number of packets with wrong checksum or end
+        prefix = name + '.' if name else ''
+        self._concentration = store.channel(prefix + 'co2')
+        self._temperature = store.channel(prefix + 'temp')
+        self._had_driver = False
+        self._dev = dev if dev is not None else usb.core.find(idVendor=self.VID, idProduct=self.PID)
+
+        if self._dev is None:
+            raise ValueError("Device wasn't found.")
+
+        if self._dev.is_kernel_driver_active(0):
+            self._dev.detach_kernel_driver(0)
+            self._had_driver = True
+
+        self._dev.set_configuration()
+        self._ep = self._dev[0][(0, 0)][0]
+        self.port = device_port(self._dev)
+        label = (name or 'default',)
+        PACKETS.set_function(lambda: self.packets, label)
+        BAD_PACKETS.set_function(lambda: self.bad, label)
+        DECODED.set_function(lambda: self.decoded, label)
+
+    def stop(self):
+        """
+        Stop data reading
+        """
+        self._event_stop.set()
+
+    def open(self):
+        """
+        Start data reading
+        """
+        self._dev.ctrl_transfer(
+            self.REQUEST_TYPE_SEND,
+            self.REQ_HID_SET_REPORT,
+            self.HID_REPORT_TYPE_FEATURE,
+            0x00, self.magic_buf,
+            self._read_timeout)
+
+    def poll(self):
+        """
+        Read and parse one packet, return without data if timeout is expired
+        """
+        data = self._read()
+        if data is not None:
+            self._parse(data)
+
+    def run(self):
+        """
+        Loop data reading
+        """
+        self.open()
+        self._event_stop.clear()
+        while not self._event_stop.is_set():
+            try:
+                self.poll()
+            except BaseException as e:
+                print('{} USB reading error: {}'.format(str(datetime.datetime.now()), str(e)))
+                raise SystemExit
+            except:
+                print('{} USB reading error.'.format(str(datetime.datetime.now())))
+                raise SystemExit
+        self.release()
+        print('{} MT8057 was stopped.'.format(str(datetime.datetime.now())))
+
+    def get_data(self):
+        """
+        Return last read data
+        """
+        return (self._concentration.get().value, self._temperature.get().value)
+
+    def _read(self):
+        """
+        Reading data from MT8057, return None if timeout is expired
+        """
+        try:
+            return self._dev.read(self._ep, mt8057_codec.PACKET_SIZE, self._read_timeout)
+        except usb.core.USBError as e:
+            if is_timeout(e):
+                return None
+            raise
+
+    def _parse(self, data):
+        """
+        Packet parsing
+        """
+        self.packets += 1
+        op = mt8057_codec.packet_op(data)
+        if op not in self.OPERATIONS:
+            return
+        if self._decimation > 1:
+            count = self._counts.get(op, 0)
+            self._counts[op] = count + 1
+            if count % self._decimation:
+                return
+        item = mt8057_codec.parse_packet(data)
+        self.decoded += 1
+        if item is None:
+            self.bad += 1
+            return
+        op, w = item
+        if self._changed_only:
+            if self._last.get(op) == w:
+                return
+            self._last[op] = w
+        if (op == mt8057_codec.OP_TEMPERATURE):  # Ambient Temperature
+            self._temperature.publish(w)
+        elif (op == mt8057_codec.OP_CO2):  # Relative Concentration of CO2
+            self._concentration.publish(w)
+        else:
+            pass
+
+    def release(self):
+        """
+        Releasing MT8057
+        """
+        try:
+            usb.util.release_interface(self._dev, 0)
+            if self._had_driver:
+                self._dev.attach_kernel_driver(0)
+        finally:
+            usb.util.dispose_resources(self._dev)
+
+class DeviceManager(threading.Thread):
+    """
+    Class for several MT8057 with hot-plug
+    Devices are described by tuples (name, port, serial), device with empty port
+    and serial matches any MT8057.
+    """
+    def __init__(self, store, devices, scan_interval=10, **options):
+        """
+        Class initialization
+        'options' are passed to readers (read_timeout, decimation, changed_only).
+        """
+        threading.Thread.__init__(self, name="mt-manager")
+        self._event_stop = threading.Event()
+        self._store = store
+        self._devices = list(devices)
+        self._scan_interval = scan_interval
+        self._options = options
+        self._lock = threading.Lock()
+        self._readers = {} # Name of device -> reader
+
+    def stop(self):
+        """
+        Stop all readers
+        """
+        self._event_stop.set()
+
+    def readers(self):
+        """
+        Return list of active readers
+        """
+        with self._lock:
+            return list(self._readers.values())
+
+    def open_devices(self):
+        """
+        Create readers for matched devices which don't have active reader
+        Return list of new readers (they aren't started).
+        """
+        new_readers = []
+        with self._lock:
+            # Readers which were stopped by USB error (e.g. unplugged device) are removed
+            for name, reader in list(self._readers.items()):
+                if reader.ident is not None and not reader.is_alive():
+                    print('{} MT8057 {} was disconnected.'.format(str(datetime.datetime.now()), reader.port))
+                    del self._readers[name]
+                    try:
+                        reader.release()
+                    except BaseException:
+                        pass
+            missing = [device for device in self._devices if device[0] not in self._readers]
+            if not missing:
+                return new_readers
+            busy = set(reader.port for reader in self._readers.values())
+            try:
+                found = find_devices()
+            except BaseException as e:
+                print('{} USB scanning error: {}'.format(str(datetime.datetime.now()), str(e)))
+                return new_readers
+            for name, port, serial in missing:
+                for dev in found:
+                    dev_port = device_port(dev)
+                    if dev_port in busy:
+                        continue
+                    if port and port != dev_port:
+                        continue
+                    if serial and serial != device_serial(dev):
+                        continue
+                    try:
+                        reader = mt8057(self._store, dev, name, **self._options)
+                    except BaseException as e:
+                        print('{} MT8057 {} initialization error: {}'.format(str(datetime.datetime.now()), dev_port, str(e)))
+                        continue
+                    print('{} MT8057 {} was found on port {}.'.format(str(datetime.datetime.now()), name, dev_port))
+                    self._readers[name] = reader
+                    busy.add(dev_port)
+                    new_readers.append(reader)
+                    break
+        return new_readers
+
+    def run(self):
+        """
+        Loop of devices scanning
+        """
+        while not self._event_stop.is_set():
+            for reader in self.open_devices():
+                reader.start()
+            self._event_stop.wait(self._scan_interval)
+        for reader in self.readers():
+            reader.stop()
+            if reader.is_alive():
+                reader.join()
+        print('{} MT8057 manager was stopped.'.format(str(datetime.datetime.now())))
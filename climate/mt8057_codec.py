@@ -0,0 +1,162 @@
+"""
+Table-driven codec for MT8057 HID reports
+
+Every 8-byte report of MT8057 is shuffled, XOR-ed with magic buffer, rotated
+by 3 bits and shifted by 'ctmp' values. All of these stages are folded into
+per-position lookup tables, so decoding of one report is 10 table lookups.
+Only first 5 bytes of report are decoded (operation, value, checksum, end).
+"""
+import itertools
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC_BUF = (0xc4, 0xc6, 0xc0, 0x92, 0x40, 0x23, 0xdc, 0x96)
+CTMP = (0x84, 0x47, 0x56, 0xd6, 0x07, 0x93, 0x93, 0x56)
+SHUFFLE = (2, 4, 0, 7, 1, 6, 5, 3)
+
+PACKET_SIZE = 8
+PACKET_END = 0x0d
+OP_TEMPERATURE = 0x42   # Ambient Temperature
+OP_CO2 = 0x50           # Relative Concentration of CO2
+
+DECODED_SIZE = 5        # Operation, value (2 bytes), checksum, end of packet
+
+_PACKET = struct.Struct('{}B'.format(PACKET_SIZE))
+
+try:
+    _imap = itertools.imap # Python 2
+except AttributeError:
+    _imap = map
+
+def _build_tables():
+    """
+    Build lookup tables for decoded byte 'i':
+    result[i] = (HI[i][data[SHUFFLE[i]]] + LO[i][data[SHUFFLE[i - 1]]]) & 0xff
+    """
+    hi = []
+    lo = []
+    for i in range(PACKET_SIZE):
+        # High and low parts of rotated byte don't overlap, so 'or' may be replaced by sum
+        # and subtraction of 'ctmp' may be moved into the high part table.
+        hi.append(tuple((((b ^ MAGIC_BUF[i]) >> 3) - CTMP[i]) & 0xff for b in range(256)))
+        lo.append(tuple(((b ^ MAGIC_BUF[i - 1]) << 5) & 0xff for b in range(256)))
+    return tuple(hi), tuple(lo)
+
+HI, LO = _build_tables()
+
+_HI0, _HI1, _HI2, _HI3, _HI4 = HI[:DECODED_SIZE]
+_LO0, _LO1, _LO2, _LO3, _LO4 = LO[:DECODED_SIZE]
+
+def packet_op(data):
+    """
+    Decode only operation of packet (2 table lookups, packet isn't validated)
+    """
+    return (_HI0[data[2]] + _LO0[data[3]]) & 0xff
+
+def decode_packet(data):
+    """
+    Decode necessary bytes (first 5) of packet
+    """
+    d0 = data[0]
+    d2 = data[2]
+    d4 = data[4]
+    d7 = data[7]
+    return ((_HI0[d2] + _LO0[data[3]]) & 0xff,
+            (_HI1[d4] + _LO1[d2]) & 0xff,
+            (_HI2[d0] + _LO2[d4]) & 0xff,
+            (_HI3[d7] + _LO3[d0]) & 0xff,
+            (_HI4[data[1]] + _LO4[d7]) & 0xff)
+
+def parse_packet(data):
+    """
+    Packet parsing
+    Return tuple (operation, value) or None for invalid packet.
+    Temperature is converted to Celsius, other values are raw 16-bit words.
+    """
+    d0 = data[0]
+    d7 = data[7]
+    if (_HI4[data[1]] + _LO4[d7]) & 0xff != PACKET_END:
+        return None
+    d2 = data[2]
+    d4 = data[4]
+    r0 = (_HI0[d2] + _LO0[data[3]]) & 0xff
+    r1 = (_HI1[d4] + _LO1[d2]) & 0xff
+    r2 = (_HI2[d0] + _LO2[d4]) & 0xff
+    if (r0 + r1 + r2) & 0xff != (_HI3[d7] + _LO3[d0]) & 0xff:
+        return None
+    w = (r1 << 8) + r2
+    if r0 == OP_TEMPERATURE:
+        return r0, w * 0.0625 - 273.15
+    return r0, w
+
+def parse_buffer(buf):
+    """
+    Parse buffer of concatenated packets
+    Return list of tuples (operation, value) for valid packets.
+    Packets are unpacked by offset in buffer, so they aren't copied by slicing.
+    """
+    buf = bytearray(buf)
+    count = len(buf) // PACKET_SIZE
+    if hasattr(_PACKET, 'iter_unpack'): # Python 3
+        packets = _PACKET.iter_unpack(memoryview(buf)[:count * PACKET_SIZE])
+    else:
+        packets = _imap(_PACKET.unpack_from, itertools.repeat(buf, count), range(0, count * PACKET_SIZE, PACKET_SIZE))
+    result = []
+    append = result.append
+    for d0, d1, d2, d3, d4, d5, d6, d7 in packets:
+        if (_HI4[d1] + _LO4[d7]) & 0xff != PACKET_END:
+            continue
+        r0 = (_HI0[d2] + _LO0[d3]) & 0xff
+        r1 = (_HI1[d4] + _LO1[d2]) & 0xff
+        r2 = (_HI2[d0] + _LO2[d4]) & 0xff
+        if (r0 + r1 + r2) & 0xff != (_HI3[d7] + _LO3[d0]) & 0xff:
+            continue
+        w = (r1 << 8) + r2
+        if r0 == OP_TEMPERATURE:
+            append((r0, w * 0.0625 - 273.15))
+        else:
+            append((r0, w))
+    return result
+
+if numpy is not None:
+    _NP_HI = numpy.array(HI[:DECODED_SIZE], dtype=numpy.uint16)
+    _NP_LO = numpy.array(LO[:DECODED_SIZE], dtype=numpy.uint16)
+
+def parse_buffer_array(buf):
+    """
+    Vectorized parsing of buffer of concatenated packets (requires NumPy)
+    Return tuple of arrays (operations, values) for valid packets,
+    temperature values are converted to Celsius.
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required for vectorized parsing')
+    count = len(buf) // PACKET_SIZE
+    packets = numpy.frombuffer(bytes(bytearray(buf[:count * PACKET_SIZE])), dtype=numpy.uint8)
+    packets = packets.reshape(count, PACKET_SIZE)
+    items = []
+    for i in range(DECODED_SIZE):
+        items.append((_NP_HI[i][packets[:, SHUFFLE[i]]] + _NP_LO[i][packets[:, SHUFFLE[i - 1]]]) & 0xff)
+    r0, r1, r2, r3, r4 = items
+    valid = (r4 == PACKET_END) & (((r0 + r1 + r2) & 0xff) == r3)
+    ops = r0[valid]
+    values = ((r1[valid] << 8) + r2[valid]).astype(numpy.float64)
+    temperature = ops == OP_TEMPERATURE
+    values[temperature] = values[temperature] * 0.0625 - 273.15
+    return ops, values
+
+def encode_packet(op, w, tail=(0, 0, 0)):
+    """
+    Encode packet (inverse of decoding), used by emulators and benchmarks
+    """
+    item = [op & 0xff, (w >> 8) & 0xff, w & 0xff, (op + (w >> 8) + w) & 0xff, PACKET_END]
+    item.extend(tail)
+    phase3 = [(item[i] + CTMP[i]) & 0xff for i in range(PACKET_SIZE)]
+    data = [0] * PACKET_SIZE
+    for i in range(PACKET_SIZE):
+        phase2 = ((phase3[i] << 3) | (phase3[(i + 1) % PACKET_SIZE] >> 5)) & 0xff
+        data[SHUFFLE[i]] = phase2 ^ MAGIC_BUF[i]
+    return data
@@ -0,0 +1,133 @@
+"""
+IP address of device for status of messages
+
+Address is cached and refreshed by separate thread when TTL is expired or
+network is changed (netlink notifications on Linux, otherwise polling of
+routing table), so reading of address doesn't make any system calls.
+"""
+import datetime
+import select
+import socket
+import threading
+import time
+
+ROUTE_FILE = '/proc/net/route'
+
+# Netlink groups of notifications about links, IPv4 addresses and routes
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+def lookup_ip_address():
+    """
+    Return IP address of interface with default route
+    """
+    s = None
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80)) # No packets are sent for UDP socket
+        return s.getsockname()[0]
+    except (SystemExit, KeyboardInterrupt):
+        raise # System Exit or Keyboard Interrupt
+    except BaseException as e:
+        print('{} Error: {}'.format(str(datetime.datetime.now()), str(e)))
+        return ''
+    finally:
+        if s:
+            s.close()
+
+def route_table():
+    """
+    Return content of routing table or None if it's not available
+    """
+    try:
+        with open(ROUTE_FILE) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def netlink_socket():
+    """
+    Return socket for notifications about network changes or None if it's not available
+    """
+    if not hasattr(socket, 'AF_NETLINK'):
+        return None
+    try:
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, getattr(socket, 'NETLINK_ROUTE', 0))
+        s.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+        return s
+    except (IOError, OSError):
+        return None
+
+class IpAddressProvider(threading.Thread):
+    """
+    Class for cached IP address
+    """
+    def __init__(self, ttl=300, poll_interval=5):
+        """
+        Class initialization, address is looked up immediately
+        """
+        threading.Thread.__init__(self, name="ip")
+        self._event_stop = threading.Event()
+        self._ttl = ttl
+        self._poll_interval = poll_interval
+        self._updated = 0
+        self._address = ''
+        self.refresh()
+
+    def stop(self):
+        """
+        Stop refreshing
+        """
+        self._event_stop.set()
+
+    def get(self):
+        """
+        Return cached IP address
+        """
+        return self._address
+
+    def refresh(self):
+        """
+        Look up IP address
+        """
+        address = lookup_ip_address()
+        if address != self._address:
+            print('{} IP address: {}'.format(str(datetime.datetime.now()), address or 'unknown'))
+        self._address = address
+        self._updated = time.time()
+
+    def _expired(self):
+        # Unknown address is refreshed with polling interval
+        ttl = self._ttl if self._address else self._poll_interval
+        return time.time() - self._updated >= ttl
+
+    def run(self):
+        """
+        Loop of address refreshing
+        """
+        netlink = netlink_socket()
+        routes = route_table()
+        try:
+            while not self._event_stop.is_set():
+                changed = False
+                if netlink:
+                    # Wait notification, stop is checked with polling interval
+                    try:
+                        readable = select.select([netlink], [], [], self._poll_interval)[0]
+                    except (select.error, IOError, OSError): # Interrupted by signal
+                        continue
+                    if readable:
+                        netlink.recv(65536)
+                        changed = True
+                else:
+                    self._event_stop.wait(self._poll_interval)
+                    current = route_table()
+                    changed = current != routes
+                    routes = current
+                if changed or self._expired():
+                    self.refresh()
+        finally:
+            if netlink:
+                netlink.close()
+        print('{} IP address provider was stopped.'.format(str(datetime.datetime.now())))
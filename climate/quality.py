@@ -0,0 +1,85 @@
+"""
+Climate quality index (port of 'Cloud/Climate quality.m')
+
+CO2 is clamped to 400...2000 ppm and weighted exponentially, deviations of
+temperature from 23 C and humidity from 50% are weighted linearly (capped by 1):
+
+    CQ = 5 * (1 - (w1 * exp(coef * (CO2 - 400) / 1600) / exp(coef)
+                   + w2 * min(|T - 23| / 10, 1)
+                   + w3 * min(|H - 50| / 10, 1)) / (w1 + w2 + w3))
+
+Index is rounded to 3 digits, filtered by medfilt1(CQ, window) and scaled
+as floor(CQ * 20). MATLAB script needs only the last value of filter; with
+zero padding of medfilt1 it's median of the last window // 2 + 1 indexes and
+zeros, so only these indexes are kept and nothing is read back from Cloud.
+Index isn't known (None) until window // 2 + 1 samples are collected: MATLAB
+script reads hundreds of points and its filter is never short of samples.
+"""
+import collections
+import math
+
+W1 = 1.0    # Weight of CO2
+W2 = 0.1    # Weight of temperature
+W3 = 0.125  # Weight of humidity
+COEF = 3    # Exponential coefficient of CO2
+WINDOW = 11 # Window of median filter
+
+CO2_MIN = 400
+CO2_MAX = 2000
+TEMP_BEST = 23
+HUMIDITY_BEST = 50
+
+def matlab_round(value, digits=0):
+    """
+    Round half away from zero like round() of MATLAB
+    """
+    scale = 10 ** digits
+    return math.copysign(math.floor(abs(value) * scale + 0.5) / scale, value)
+
+def median(values):
+    """
+    Return median of values like median() of MATLAB
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def index(co2, temp, humidity, w1=W1, w2=W2, w3=W3, coef=COEF):
+    """
+    Return climate quality index of one sample (before median filter), rounded to 3 digits
+    """
+    co2 = min(max(co2, CO2_MIN), CO2_MAX)
+    cq_co2 = math.exp(float(co2 - CO2_MIN) / (CO2_MAX - CO2_MIN) * coef) / math.exp(coef)
+    cq_temp = min(abs(temp - TEMP_BEST) / 10.0, 1)
+    cq_humidity = min(abs(humidity - HUMIDITY_BEST) / 10.0, 1)
+    cq = 5 * (1 - (cq_co2 * w1 + cq_temp * w2 + cq_humidity * w3) / (w1 + w2 + w3))
+    return matlab_round(cq, 3)
+
+class ClimateQuality(object):
+    """
+    Class for incremental calculation of climate quality
+    """
+    def __init__(self, w1=W1, w2=W2, w3=W3, coef=COEF, window=WINDOW):
+        """
+        Class initialization
+        """
+        self._weights = (w1, w2, w3)
+        self._coef = coef
+        self._window = max(1, int(window))
+        # medfilt1 window of the last index is window // 2 previous indexes, current one and zeros
+        self._history = collections.deque(maxlen=self._window // 2 + 1)
+
+    def update(self, co2, temp, humidity):
+        """
+        Add sample, return filtered index (None if some value is unknown or filter isn't full yet)
+        """
+        if co2 is None or temp is None or humidity is None:
+            return None
+        w1, w2, w3 = self._weights
+        self._history.append(index(co2, temp, humidity, w1, w2, w3, self._coef))
+        if len(self._history) < self._history.maxlen:
+            return None
+        padding = [0] * (self._window - len(self._history)) # Zero padding of medfilt1
+        return int(math.floor(median(list(self._history) + padding) * 20))
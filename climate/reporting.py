@@ -0,0 +1,95 @@
+"""
+Reporting policy of samples
+
+Policy decides which samples are sent to sink, so stable periods (e.g. empty
+room at night) are compressed into a few points and quota of messages and
+bytes of network aren't wasted, but changes are reported promptly. Sample is
+reported when:
+
+* any field changed more than its deadband since the last reported sample
+  (appearance or loss of value is a change too),
+* or 'heartbeat' seconds passed since the last reported sample (the last
+  value is confirmed, so silence isn't confused with dead device),
+* and 'min_interval' seconds passed since the last reported sample.
+
+Deadbands are set by readings (e.g. 'co2:20, temp:0.2, humidity:1') and are
+the same for all sinks, fields without deadband are reported on any change
+('inf' - changes of reading don't lead to reporting). Values are compared with
+the last reported values, so slow drift is reported when it exceeds deadband.
+Local log and history aren't filtered.
+"""
+from climate import metrics
+
+HEARTBEAT = 900 # Maximal silence of sink (seconds)
+
+REPORTED = metrics.counter('climate_reported_samples_total', 'Samples passed by reporting policy', ['sink'])
+SUPPRESSED = metrics.counter('climate_suppressed_samples_total', 'Samples suppressed by reporting policy', ['sink'])
+
+def parse_deadbands(text):
+    """
+    Parse deadbands like 'co2:20, temp:0.2', return dictionary reading -> deadband
+    """
+    deadbands = {}
+    for item in text.split(','):
+        reading, _, deadband = item.partition(':')
+        if reading.strip():
+            deadbands[reading.strip()] = float(deadband)
+    return deadbands
+
+class ReportingPolicy(object):
+    """
+    Class for deadband, heartbeat and minimal interval of reporting
+    """
+    def __init__(self, deadbands=None, heartbeat=HEARTBEAT, min_interval=0, name=''):
+        """
+        Class initialization
+        'deadbands' - dictionary field -> deadband, 'heartbeat' - maximal interval between
+        reported samples (0 - without heartbeat), 'min_interval' - minimal interval (seconds).
+        """
+        self._deadbands = deadbands or {}
+        self._heartbeat = heartbeat
+        self._min_interval = min_interval
+        self._labels = (name or 'default',)
+        self._last_time = None
+        self._last_fields = {}
+
+    def _changed(self, fields):
+        for field, value in fields.items():
+            last = self._last_fields.get(field)
+            if value is None or last is None:
+                if value is not last:
+                    return True
+            elif isinstance(value, (int, float)) and isinstance(last, (int, float)):
+                if abs(value - last) > self._deadbands.get(field, 0):
+                    return True
+            elif value != last:
+                return True
+        return False
+
+    def report(self, timestamp, fields):
+        """
+        Return True if sample should be reported, 'timestamp' - epoch seconds of sample
+        """
+        if self._last_time is not None:
+            elapsed = timestamp - self._last_time
+            if elapsed < self._min_interval or \
+               not (self._heartbeat and elapsed >= self._heartbeat or self._changed(fields)):
+                SUPPRESSED.inc(1, self._labels)
+                return False
+        self._last_time = timestamp
+        self._last_fields = dict(fields)
+        REPORTED.inc(1, self._labels)
+        return True
+
+def create_policy(section, mapping, name=''):
+    """
+    Create policy of sink from section of config ('mapping' - list of pairs (field, reading) of sink)
+    Return None if reporting isn't filtered (every sample is reported).
+    """
+    deadbands = parse_deadbands(section.get('report_deadbands', ''))
+    min_interval = float(section.get('report_min_interval', 0))
+    if not deadbands and min_interval <= 0:
+        return None
+    return ReportingPolicy(dict((field, deadbands[reading]) for field, reading in mapping if reading in deadbands),
+                           heartbeat=float(section.get('report_heartbeat', HEARTBEAT)),
+                           min_interval=min_interval, name=name)
@@ -0,0 +1,158 @@
+"""
+Persistent HTTP(S) session
+
+Connection to server is kept alive and reused across requests, so TCP and TLS
+handshakes are done only once. Stale connection (closed by server or network)
+is reopened and request is repeated only if connection was closed before
+server got it (timeout isn't retried, POST isn't idempotent). Large request bodies can be sent
+compressed by gzip.
+Errors are raised as HTTPError and URLError like urlopen does. Reset of reused
+connection after request was sent is raised as LostConnectionError.
+"""
+import errno
+import socket
+import threading
+import zlib
+
+try:
+    import httplib
+    from urlparse import urlsplit
+    from urllib2 import HTTPError, URLError
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlsplit
+    from urllib.error import HTTPError, URLError
+
+from climate import metrics
+
+TIMEOUT = 5 # Timeout of HTTP request (seconds)
+
+SENT_BYTES = metrics.counter('climate_http_sent_bytes_total', 'Bytes of bodies of HTTP requests', ['host'])
+
+# Errors of sending to reused connection which was closed by server or network
+STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class LostConnectionError(URLError):
+    """
+    Reused connection was reset after request was sent
+    Server could close idle connection while request was sent, so it isn't fault of server
+    or local network (request could be handled by server, it isn't repeated).
+    """
+    pass
+
+def is_reset(e):
+    """
+    Check that connection was reset or closed by peer
+    """
+    return isinstance(e, socket.error) and getattr(e, 'errno', None) in STALE_ERRNOS
+
+def is_stale(e, sent):
+    """
+    Check that reused connection was closed before server got request, so POST can be repeated
+    Timeout or reset after request was sent isn't stale connection: request could be
+    handled by server, it isn't repeated (caller keeps data for later sending).
+    """
+    if isinstance(e, socket.timeout):
+        return False
+    if not sent:
+        return isinstance(e, httplib.CannotSendRequest) or is_reset(e)
+    return isinstance(e, httplib.BadStatusLine) # Includes RemoteDisconnected: closed without response
+
+def gzip_compress(data):
+    """
+    Compress data by gzip
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class HttpSession(object):
+    """
+    Class for HTTP(S) session with keep-alive connections
+    """
+    def __init__(self, timeout=TIMEOUT, gzip_min_size=None, keep_alive=True):
+        """
+        Class initialization
+        Request body which isn't smaller than 'gzip_min_size' bytes is compressed (None - disabled).
+        """
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._timeout = timeout
+        self._gzip_min_size = gzip_min_size
+        self._keep_alive = keep_alive
+        self.bytes_sent = 0
+
+    def close(self):
+        """
+        Close all connections
+        """
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections = {}
+
+    def _connection(self, scheme, netloc):
+        """
+        Return connection to server, new connection is opened if necessary
+        """
+        key = (scheme, netloc)
+        connection = self._connections.get(key)
+        if connection is not None:
+            return connection, True
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=self._timeout)
+        elif scheme == 'http':
+            connection = httplib.HTTPConnection(netloc, timeout=self._timeout)
+        else:
+            raise URLError('unknown url type: {}'.format(scheme))
+        self._connections[key] = connection
+        return connection, False
+
+    def _drop(self, scheme, netloc):
+        connection = self._connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def post(self, url, postdata, content_type=None, headers=None):
+        """
+        Send POST request, return body of response
+        """
+        if not isinstance(postdata, bytes):
+            postdata = postdata.encode('utf-8')
+        headers = dict(headers or {})
+        headers['Connection'] = 'keep-alive' if self._keep_alive else 'close'
+        if content_type:
+            headers['Content-Type'] = content_type
+        if self._gzip_min_size is not None and len(postdata) >= self._gzip_min_size:
+            postdata = gzip_compress(postdata)
+            headers['Content-Encoding'] = 'gzip'
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        with self._lock:
+            while True:
+                connection, reused = self._connection(parts.scheme, parts.netloc)
+                sent = False
+                try:
+                    connection.request('POST', path, postdata, headers)
+                    sent = True
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except BaseException as e:
+                    self._drop(parts.scheme, parts.netloc)
+                    if not reused or not is_stale(e, sent):
+                        if reused and sent and is_reset(e):
+                            raise LostConnectionError(e)
+                        if isinstance(e, (httplib.HTTPException, socket.error)):
+                            raise URLError(e) # Network error or timeout
+                        raise
+            self.bytes_sent += len(postdata)
+            SENT_BYTES.inc(len(postdata), (parts.netloc,))
+            if not self._keep_alive or response.getheader('connection', '').lower() == 'close':
+                self._drop(parts.scheme, parts.netloc)
+
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.msg, None)
+        return body
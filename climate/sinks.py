@@ -0,0 +1,315 @@
+"""
+Output sinks of samples
+
+Every sink is sent by its own uploader (queue and thread), so sinks don't
+delay sampling loop and each other. Sink has interface of thingspeak.Channel:
+
+    fields(readings)            - values of sample from dictionary of named readings
+    send(current_time, fields)  - send sample, return number of continuous errors
+    spill(current_time, fields) - keep sample which doesn't fit the queue
+    close()                     - send the rest and release resources
+    policy                      - reporting policy of samples (climate.reporting, None - every sample is sent)
+
+BatchSink collects samples in bounded buffer and writes them by batches of
+'batch_size' samples or every 'batch_interval' seconds. Failed batch is
+retried with exponential delay and then kept in buffer for the next batch;
+when buffer is full the oldest samples are lost (backpressure doesn't reach
+sampling loop). Implementations:
+
+* InfluxSink - InfluxDB line protocol by HTTP(S) (v1 '/write' or v2 '/api/v2/write')
+* MqttSink - JSON messages to MQTT broker (paho-mqtt is required)
+* FileSink - local file by climate.datalog (CSV or binary, rotation)
+"""
+import collections
+import datetime
+import json
+import socket
+import threading
+import time
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+from climate import metrics
+from climate import reporting
+from climate import thingspeak
+from climate.cache import to_epoch
+from climate import datalog
+
+WRITE_SECONDS = metrics.histogram('climate_sink_write_seconds', 'Duration of writing of batch to sink', ['sink'])
+WRITE_ERRORS = metrics.counter('climate_sink_errors_total', 'Failed writes of batches to sink', ['sink'])
+LOST = metrics.counter('climate_sink_lost_total', 'Samples lost by full buffer of sink', ['sink'])
+PENDING = metrics.gauge('climate_sink_pending', 'Samples in buffer of sink', ['sink'])
+
+def parse_readings(text):
+    """
+    Parse readings of sink like 'co2, temp, kitchen_co2:kitchen.co2',
+    return list of pairs (name in sink, reading)
+    """
+    mapping = []
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        name, _, reading = item.partition(':')
+        mapping.append((name.strip(), (reading or name).strip()))
+    return mapping
+
+class BatchSink(object):
+    """
+    Base class of sinks with batching and retries
+    """
+    critical = False # Errors of sink don't lead to reboot
+
+    def __init__(self, name, mapping, batch_size=1, batch_interval=0, max_pending=1000,
+                 retries=3, retry_delay=1, policy=None, debug=False):
+        """
+        Class initialization
+        'mapping' - list of pairs (name in sink, reading).
+        """
+        self.name = name
+        self.mapping = mapping
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._max_pending = max(1, max_pending)
+        self._batch_size = max(1, batch_size)
+        self._batch_interval = batch_interval
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._debug = debug
+        self._last_write = time.time()
+        self._send_error_cnt = 0
+        self.lost = 0
+        self._labels = (name,)
+        LOST.set_function(lambda: self.lost, self._labels)
+        PENDING.set_function(lambda: len(self._pending), self._labels)
+
+    def fields(self, readings):
+        """
+        Return values of sample from dictionary of named readings
+        """
+        return dict((name, readings.get(reading)) for name, reading in self.mapping)
+
+    def spill(self, current_time, fields):
+        """
+        Keep sample which doesn't fit the queue
+        """
+        with self._lock:
+            self._keep([(current_time, fields)])
+
+    def _keep(self, samples):
+        self._pending.extend(samples)
+        while len(self._pending) > self._max_pending:
+            self._pending.popleft()
+            self.lost += 1
+            if self.lost == 1 or self.lost % 100 == 0:
+                print('{} Sink {}: buffer is full, {} samples are lost.'.format(str(datetime.datetime.now()), self.name, self.lost))
+
+    def send(self, current_time, fields):
+        """
+        Add sample to batch, write batch if it's ready; return number of continuous errors
+        """
+        with self._lock:
+            self._keep([(current_time, fields)])
+            ready = len(self._pending) >= self._batch_size or \
+                (self._batch_interval and time.time() - self._last_write >= self._batch_interval)
+        if ready:
+            self.flush()
+        return self._send_error_cnt
+
+    def flush(self, retries=None):
+        """
+        Write all pending samples
+        """
+        with self._lock:
+            batch = list(self._pending)
+            self._pending.clear()
+        if not batch:
+            return
+        self._last_write = time.time()
+        retries = self._retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                with WRITE_SECONDS.time(self._labels):
+                    self.write(batch)
+                self._send_error_cnt = 0
+                return
+            except (SystemExit, KeyboardInterrupt):
+                raise # System Exit or Keyboard Interrupt
+            except BaseException as e:
+                WRITE_ERRORS.inc(1, self._labels)
+                print('{} Sink {}: writing error: {}'.format(str(datetime.datetime.now()), self.name, str(e)))
+            if attempt < retries:
+                time.sleep(self._retry_delay * 2 ** attempt)
+        self._send_error_cnt += 1
+        with self._lock: # Failed batch is sent with the next one
+            rest = list(self._pending)
+            self._pending.clear()
+            self._keep(batch + rest)
+
+    def write(self, batch):
+        """
+        Write list of samples (current_time, fields), errors are raised
+        Samples which are written before error are removed from list, so they aren't written again.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Write the rest of samples (without retries)
+        """
+        self.flush(retries=0)
+
+def _escape(text, chars=', ='):
+    for char in '\\' + chars:
+        text = text.replace(char, '\\' + char)
+    return text
+
+class InfluxSink(BatchSink):
+    """
+    Class for InfluxDB sink (line protocol, precision of seconds)
+    """
+    def __init__(self, name, mapping, url, measurement='climate', tags=None, token='',
+                 session=None, timeout=thingspeak.TIMEOUT, **options):
+        """
+        Class initialization
+        'url' - write URL with 'precision=s' (e.g. http://host:8086/write?db=climate&precision=s),
+        'tags' - dictionary of tags of every point, 'token' - API token of InfluxDB 2.
+        """
+        if not url:
+            raise ValueError('URL of InfluxDB sink {} isn\'t set'.format(name))
+        BatchSink.__init__(self, name, mapping, **options)
+        self._url = url
+        self._prefix = _escape(measurement, ', ') + ''.join(
+            ',{}={}'.format(_escape(key), _escape(value)) for key, value in sorted((tags or {}).items()))
+        self._headers = {'Authorization': 'Token ' + token} if token else None
+        self._session = session
+        self._timeout = timeout
+
+    def line(self, current_time, fields):
+        """
+        Return point of line protocol or None if sample doesn't have values
+        """
+        values = ','.join('{}={}'.format(_escape(key), repr(float(value)))
+                          for key, value in sorted(fields.items()) if value is not None)
+        if not values:
+            return None
+        return '{} {} {}'.format(self._prefix, values, to_epoch(current_time))
+
+    def write(self, batch):
+        lines = [line for line in (self.line(current_time, fields) for current_time, fields in batch) if line]
+        if not lines:
+            return
+        postdata = '\n'.join(lines) + '\n'
+        if self._debug:
+            print('{} {}'.format(str(datetime.datetime.now()), postdata))
+        thingspeak.post(self._url, postdata, 'text/plain; charset=utf-8', self._timeout, self._session, self._headers)
+
+class MqttSink(BatchSink):
+    """
+    Class for MQTT sink, every sample is published as JSON message
+    """
+    def __init__(self, name, mapping, host, port=1883, topic='climate', qos=1, username='', password='',
+                 timeout=thingspeak.TIMEOUT, **options):
+        """
+        Class initialization
+        """
+        if mqtt is None:
+            raise ImportError('paho-mqtt is required for MQTT sink')
+        BatchSink.__init__(self, name, mapping, **options)
+        self._topic = topic
+        self._qos = qos
+        self._timeout = timeout
+        if hasattr(mqtt, 'CallbackAPIVersion'): # paho-mqtt 2.x requires version of callbacks
+            self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+        else:
+            self._client = mqtt.Client()
+        if username:
+            self._client.username_pw_set(username, password or None)
+        self._client.connect_async(host, port)
+        self._client.loop_start() # Network loop of client reconnects automatically
+
+    def write(self, batch):
+        messages = []
+        for current_time, fields in batch:
+            payload = dict(fields)
+            payload['time'] = current_time
+            info = self._client.publish(self._topic, json.dumps(payload, sort_keys=True), qos=self._qos)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise IOError('MQTT error: {}'.format(mqtt.error_string(info.rc)))
+            messages.append(info)
+        if not self._qos:
+            return
+        deadline = time.time() + self._timeout
+        for info in messages: # Wait acknowledgement from broker
+            while not info.is_published():
+                if time.time() >= deadline:
+                    raise socket.timeout('MQTT message isn\'t acknowledged')
+                time.sleep(0.05)
+
+    def close(self):
+        BatchSink.close(self)
+        self._client.loop_stop()
+        self._client.disconnect()
+
+class FileSink(BatchSink):
+    """
+    Class for local file sink
+    """
+    def __init__(self, name, mapping, path, fmt='csv', max_size=datalog.MAX_SIZE, rotate_interval=0, backups=10,
+                 compress=True, flush_interval=60, **options):
+        """
+        Class initialization, 'path' and the rest of arguments are arguments of climate.datalog.DataLog
+        """
+        if not path:
+            raise ValueError('Path of file sink {} isn\'t set'.format(name))
+        BatchSink.__init__(self, name, mapping, **options)
+        self._data_log = datalog.DataLog(path, [column for column, reading in mapping], fmt=fmt, max_size=max_size,
+                                         rotate_interval=rotate_interval, backups=backups, compress=compress,
+                                         flush_interval=flush_interval)
+
+    def write(self, batch):
+        written = 0
+        try:
+            for current_time, fields in batch:
+                self._data_log.write(current_time, [fields[name] for name, reading in self.mapping])
+                written += 1
+        finally: # Retry after partial write doesn't duplicate rows
+            del batch[:written]
+
+    def close(self):
+        BatchSink.close(self)
+        self._data_log.close()
+
+def create_sink(kind, name, section, session=None, debug=False):
+    """
+    Create sink from section of config ('kind' is influxdb, mqtt or file)
+    """
+    mapping = parse_readings(section.get('readings', 'co2, temp'))
+    options = {
+        'batch_size': int(section.get('batch_size', 1)),
+        'batch_interval': float(section.get('batch_interval', 0)),
+        'max_pending': int(section.get('max_pending', 1000)),
+        'retries': int(section.get('retries', 3)),
+        'retry_delay': float(section.get('retry_delay', 1)),
+        'policy': reporting.create_policy(section, mapping, name),
+        'debug': debug
+    }
+    if kind == 'influxdb':
+        tags = dict(item.strip().split('=', 1) for item in section.get('tags', '').split(',') if '=' in item)
+        return InfluxSink(name, mapping, section.get('url', ''), section.get('measurement', 'climate'), tags,
+                          section.get('token', ''), session=session, **options)
+    if kind == 'mqtt':
+        return MqttSink(name, mapping, section.get('host', 'localhost'), int(section.get('port', 1883)),
+                        section.get('topic', 'climate'), int(section.get('qos', 1)),
+                        section.get('username', ''), section.get('password', ''), **options)
+    if kind == 'file':
+        return FileSink(name, mapping, section.get('path', ''), fmt=section.get('format', 'csv'),
+                        max_size=int(section.get('max_size', datalog.MAX_SIZE)),
+                        rotate_interval=int(section.get('rotate_interval', 0)),
+                        backups=int(section.get('backups', 10)),
+                        compress=section.getboolean('compress', True),
+                        flush_interval=int(section.get('flush_interval', 60)), **options)
+    raise ValueError('Unknown sink: {}'.format(kind))
@@ -0,0 +1,92 @@
+"""
+Latest-value snapshot store for sensor threads
+
+Every channel keeps its last reading as immutable tuple (value, sequence number,
+capture timestamp). Writer replaces the tuple by single reference assignment, which is
+atomic in Python, so readers never take a lock and never see torn values.
+Each channel must have only one writer thread.
+Listeners (e.g. aggregator) are called by writer thread with every published value.
+Creation of channels and subscribing are serialized by lock, reading never locks.
+"""
+import collections
+import threading
+import time
+
+Reading = collections.namedtuple('Reading', ['value', 'seq', 'timestamp'])
+
+EMPTY_READING = Reading(None, 0, None)
+
+class Channel(object):
+    """
+    Class for one channel of snapshot store
+    """
+    __slots__ = ('name', '_reading', 'listeners')
+
+    def __init__(self, name, listeners=()):
+        self.name = name
+        self._reading = EMPTY_READING
+        self.listeners = listeners
+
+    def publish(self, value, timestamp=None):
+        """
+        Publish new value (called only from writer thread)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self._reading = Reading(value, self._reading.seq + 1, timestamp)
+        for listener in self.listeners:
+            listener(self.name, value, timestamp)
+
+    def get(self):
+        """
+        Return last reading
+        """
+        return self._reading
+
+class SnapshotStore(object):
+    """
+    Class for shared latest-value store
+    """
+    def __init__(self):
+        self._channels = {}
+        self._listeners = ()
+        self._lock = threading.Lock() # Changes of channels and listeners
+
+    def subscribe(self, listener):
+        """
+        Add listener which is called as listener(name, value, timestamp) on every publishing
+        (it can be added while sensor threads are running)
+        """
+        with self._lock: # Channel can't be created between update of listeners and channels
+            self._listeners = self._listeners + (listener,)
+            for channel in self._channels.values():
+                channel.listeners = self._listeners
+
+    def channel(self, name):
+        """
+        Return channel by name, new channel is created if necessary
+        (it can be created while sensor threads are running)
+        """
+        channel = self._channels.get(name)
+        if channel is None:
+            with self._lock:
+                channel = self._channels.get(name)
+                if channel is None:
+                    channel = Channel(name, self._listeners)
+                    channels = dict(self._channels)
+                    channels[name] = channel
+                    self._channels = channels
+        return channel
+
+    def get(self, name):
+        """
+        Return last reading of channel
+        """
+        channel = self._channels.get(name)
+        return channel.get() if channel else EMPTY_READING
+
+    def snapshot(self):
+        """
+        Return dictionary with last readings of all channels
+        """
+        return dict((name, channel.get()) for name, channel in self._channels.items())
@@ -0,0 +1,480 @@
+"""
+Data sending to thingspeak.com
+
+Update - https://www.mathworks.com/help/thingspeak/writedata.html
+Bulk-update - https://www.mathworks.com/help/thingspeak/bulkwritejsondata.html
+CSV bulk-update - https://www.mathworks.com/help/thingspeak/bulkwritecsvdata.html
+
+Every channel has its own key, cache and mapping of named readings (e.g. 'co2'
+or 'kitchen.temp') to fields of channel, so readings of several devices can be
+sent to several channels by one daemon.
+
+Server faults open circuit breaker of channel (see climate.breaker): samples
+are kept in cache while it's open, and only local faults of network are
+counted as continuous sending errors (reasons for reboot).
+
+Bulk is sent as JSON (row is dictionary with 'created_at' and status) or, with
+bulk format 'csv', as compact CSV: rows are ordered from the newest one,
+timestamps are seconds relative to the previous row (the first one - to time
+of request), values are rounded to precision of fields and status is sent
+once per bulk. Relative timestamps don't depend on clock of device, but time
+of row can be shifted by delay of request (about a second).
+"""
+import calendar
+import datetime
+import json
+import math
+import sys
+import threading
+import time
+
+try:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from urllib import urlencode, quote_plus
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode, quote_plus, urlsplit
+
+from climate import metrics
+from climate.breaker import CircuitBreaker, OPEN, is_local_fault, retry_after
+from climate.cache import to_epoch
+from climate.session import SENT_BYTES, LostConnectionError
+
+BULK_INTERVAL = 15  # Minimal time interval between sequential bulk-update calls (seconds)
+TIMEOUT = 5         # Timeout of HTTP request (seconds)
+FIELDS = ['field{}'.format(i) for i in range(1, 9)]
+BULK_FORMATS = ('json', 'csv')
+PRECISION = 3       # Decimal digits of values of CSV bulk if precision of field isn't set
+
+REQUEST_SECONDS = metrics.histogram('climate_http_request_seconds', 'Latency of HTTP requests', ['host'])
+REQUEST_ERRORS = metrics.counter('climate_http_errors_total', 'Failed HTTP requests', ['host'])
+UPLOADED_ROWS = metrics.counter('climate_uploaded_rows_total', 'Samples sent to channel', ['channel'])
+SEND_ERRORS = metrics.gauge('climate_send_errors', 'Continuous local faults of sending of channel', ['channel'])
+BREAKER_OPEN = metrics.gauge('climate_breaker_open', 'Circuit breaker of channel is open', ['channel'])
+BACKLOG_ROWS = metrics.gauge('climate_backlog_rows', 'Rows of cache which are pending for sending', ['channel'])
+BACKLOG_DRAIN = metrics.gauge('climate_backlog_drain_seconds', 'Estimated drain time of backlog', ['channel'])
+BACKLOG_ACTIVE = metrics.gauge('climate_backlog_active', 'Backlog is larger than one bulk and sent back-to-back', ['channel'])
+
+def parse_fields(text):
+    """
+    Parse mapping of fields like 'field1:co2, field2:temp', return list of pairs (field, reading)
+    """
+    mapping = []
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        field, _, reading = item.partition(':')
+        field = field.strip()
+        if field not in FIELDS or not reading.strip():
+            raise ValueError('Wrong mapping of field: {}'.format(item.strip()))
+        mapping.append((field, reading.strip()))
+    return mapping
+
+def post(url, postdata, content_type=None, timeout=TIMEOUT, session=None, headers=None):
+    """
+    Send POST request, return response
+    Request is sent by persistent session if it's set.
+    """
+    labels = (urlsplit(url).netloc,)
+    start = time.time()
+    try:
+        if session is not None:
+            return session.post(url, postdata, content_type, headers)
+        if not isinstance(postdata, bytes):
+            postdata = postdata.encode('utf-8')
+        SENT_BYTES.inc(len(postdata), labels)
+        req = Request(url)
+        if content_type:
+            req.add_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            req.add_header(name, value)
+        response = urlopen(req, postdata, timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+    except BaseException:
+        REQUEST_ERRORS.inc(1, labels)
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.time() - start, labels)
+
+def update_postdata(key, current_time, fields, status):
+    """
+    Data for update request
+    """
+    values = {'api_key' : key, 'created_at' : current_time, 'status' : status}
+    values.update((field, value) for field, value in fields.items() if value is not None)
+    return urlencode(sorted(values.items()))
+
+def bulk_postdata(key, cache_data, status):
+    """
+    Data for bulk-update request
+    """
+    for data in cache_data:
+        data['status'] = status
+    values = {"write_api_key" : key, "updates" : cache_data}
+    return json.dumps(values)
+
+def parse_precision(text):
+    """
+    Parse precision of readings like 'co2:0, temp:2', return dictionary reading -> decimal digits
+    """
+    precision = {}
+    for item in text.split(','):
+        reading, _, digits = item.partition(':')
+        if reading.strip():
+            precision[reading.strip()] = int(digits)
+    return precision
+
+def format_value(value, digits=PRECISION):
+    """
+    Format value with 'digits' decimal digits at most (trailing zeros are removed)
+    """
+    if value.__class__ is not float:
+        return str(value)
+    text = '%.*f' % (digits, value)
+    if digits:
+        text = text.rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+def _epoch(created_at):
+    """
+    Convert time string of cache to epoch seconds (faster than strptime)
+    """
+    try:
+        return calendar.timegm((int(created_at[0:4]), int(created_at[5:7]), int(created_at[8:10]),
+                                int(created_at[11:13]), int(created_at[14:16]), int(created_at[17:19])))
+    except (TypeError, ValueError):
+        return to_epoch(created_at)
+
+def bulk_csv_postdata(key, cache_data, status, precision=None, now=None):
+    """
+    Data for CSV bulk-update request with relative timestamps
+    'precision' - dictionary field -> decimal digits, 'now' - time of request (epoch seconds).
+    """
+    precision = precision or {}
+    now = int(time.time() if now is None else now)
+    status = str(status or '').replace(',', ' ').replace('|', ' ')
+    digits = [(field, precision.get(field, PRECISION)) for field in FIELDS]
+    rows = sorted(((_epoch(data['created_at']), data) for data in cache_data), key=lambda row: row[0], reverse=True)
+    lines = []
+    previous = now
+    for ts, data in rows:
+        values = [str(max(0, previous - ts))]
+        for field, field_digits in digits:
+            value = data.get(field)
+            values.append('' if value is None else format_value(value, field_digits))
+        values.append(',,,' + status if not lines else ',,,') # Latitude, longitude, elevation, status
+        lines.append(','.join(values))
+        previous = ts
+    return 'write_api_key={}&time_format=relative&updates={}'.format(quote_plus(key), quote_plus('|'.join(lines), safe=',|'))
+
+def print_error(e):
+    """
+    Print sending error
+    """
+    if isinstance(e, HTTPError):
+        print('{} Server could not fulfill the request. Error: {}'.format(str(datetime.datetime.now()), str(e)))
+    elif isinstance(e, URLError):
+        print('{} Failed to reach server. Error: {}'.format(str(datetime.datetime.now()), str(e)))
+    else:
+        print('{} Unknown error: {}'.format(str(datetime.datetime.now()), str(e)))
+
+class BulkSender(object):
+    """
+    Class for sending of cache by bulk-update requests
+    Sending is serialized and limited by minimal interval between bulk-update calls.
+    """
+    def __init__(self, cache, key, bulk_url, interval=BULK_INTERVAL, timeout=TIMEOUT, session=None, debug=False, name='',
+                 fmt='json', precision=None):
+        """
+        Class initialization, 'name' is label of metrics
+        'fmt' - format of bulk (json or csv), 'precision' - dictionary field -> decimal digits of CSV.
+        """
+        if fmt not in BULK_FORMATS:
+            raise ValueError('Unknown bulk format: {}'.format(fmt))
+        if fmt == 'csv' and bulk_url.endswith('bulk_update.json'):
+            bulk_url = bulk_url[:-len('json')] + 'csv'
+        self._labels = (name or 'default',)
+        self._lock = threading.Lock()
+        self._cache = cache
+        self._key = key
+        self._bulk_url = bulk_url
+        self._format = fmt
+        self._precision = precision
+        self._interval = interval
+        self._timeout = timeout
+        self._session = session
+        self._debug = debug
+        self._last_send = 0
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def delay(self):
+        """
+        Return time (seconds) until next bulk-update call is allowed
+        """
+        return max(0, self._last_send + self._interval - time.time())
+
+    def send(self, status, blocking=False):
+        """
+        Send the oldest chunk of cache by one bulk-update call
+        Return number of sent rows or None if sending was skipped (other sending is
+        in progress or interval between calls is too short). Sending errors are raised.
+        """
+        if not self._lock.acquire(blocking):
+            return None
+        try:
+            if self.delay() > 0:
+                return None
+            cache_data = self._cache.get_cache()
+            if not cache_data:
+                return 0
+            if self._format == 'csv':
+                postdata = bulk_csv_postdata(self._key, cache_data, status, self._precision)
+                content_type = 'application/x-www-form-urlencoded'
+            else:
+                postdata = bulk_postdata(self._key, cache_data, status)
+                content_type = 'application/json'
+            if self._debug:
+                print('{} {}'.format(str(datetime.datetime.now()), postdata))
+            self._last_send = time.time()
+            html_string = post(self._bulk_url, postdata, content_type, self._timeout, self._session)
+            if self._debug:
+                print('{} Update: {}'.format(str(datetime.datetime.now()), html_string))
+            self._cache.clear_cache()
+            UPLOADED_ROWS.inc(len(cache_data), self._labels)
+            return len(cache_data)
+        finally:
+            self._lock.release()
+
+class BacklogUploader(threading.Thread):
+    """
+    Class for catch-up sending of cache
+    When cache is larger than one bulk, bulks are sent back-to-back with minimal
+    allowed interval, independent of sampling loop.
+    """
+    def __init__(self, sender, cache, status, limit, breaker=None, debug=False, name=''):
+        """
+        Class initialization
+        'breaker' - circuit breaker of channel, backlog isn't sent while it's open,
+        'name' - name of channel (label of metrics).
+        """
+        threading.Thread.__init__(self, name='backlog' + ('-' + name if name else ''))
+        self._event_stop = threading.Event()
+        self._sender = sender
+        self._cache = cache
+        self._status = status   # Function which returns status of device
+        self._limit = limit
+        self._breaker = breaker
+        self._debug = debug
+        self.active = False
+        labels = (name or 'default',)
+        BACKLOG_ROWS.set_function(lambda: self.progress()[0], labels)
+        BACKLOG_DRAIN.set_function(lambda: self.progress()[1], labels)
+        BACKLOG_ACTIVE.set_function(lambda: int(self.active), labels)
+
+    def stop(self):
+        """
+        Stop sending
+        """
+        self._event_stop.set()
+
+    def progress(self):
+        """
+        Return number of pending rows and estimated drain time (seconds)
+        """
+        pending = self._cache.count()
+        return pending, int(math.ceil(float(pending) / self._limit)) * self._sender.interval
+
+    def run(self):
+        """
+        Loop of backlog sending
+        """
+        while not self._event_stop.is_set():
+            pending, drain_time = self.progress()
+            if pending <= self._limit:
+                if self.active:
+                    print('{} Backlog was sent.'.format(str(datetime.datetime.now())))
+                self.active = False
+                self._event_stop.wait(self._sender.interval)
+                continue
+            if not self.active:
+                print('{} Backlog: {} rows are pending, estimated drain time {} s.'.format(str(datetime.datetime.now()), pending, drain_time))
+            self.active = True
+            self._event_stop.wait(self._sender.delay())
+            if self._event_stop.is_set():
+                break
+            if self._breaker and not self._breaker.allow():
+                self._event_stop.wait(self._breaker.remaining() or self._sender.interval) # Trial request is in flight if 0
+                continue
+            try:
+                status = self._status()
+                if not status:
+                    if self._breaker:
+                        self._breaker.release()
+                    self._event_stop.wait(self._sender.interval)
+                    continue
+                sent = self._sender.send(status, blocking=True)
+                if self._breaker:
+                    if sent is not None:
+                        self._breaker.success()
+                    else:
+                        self._breaker.release()
+                if sent:
+                    pending, drain_time = self.progress()
+                    print('{} Backlog: {} rows were sent, {} rows are pending, estimated drain time {} s.'.format(str(datetime.datetime.now()), sent, pending, drain_time))
+            except (SystemExit, KeyboardInterrupt):
+                raise # System Exit or Keyboard Interrupt
+            except BaseException as e:
+                print_error(e)
+                if self._breaker:
+                    if is_local_fault(e) or isinstance(e, LostConnectionError):
+                        self._breaker.release()
+                    else:
+                        self._breaker.failure(retry_after(e))
+        print('{} Backlog uploader was stopped.'.format(str(datetime.datetime.now())))
+
+class Channel(object):
+    """
+    Class for channel of thingspeak.com
+    Data is sent by update requests or, if 'bulk_url' and cache are set, it's
+    cached and sent by bulk-update requests.
+    It's sink of samples like sinks of climate.sinks.
+    """
+    critical = True # Continuous local faults of channel lead to reboot
+
+    def __init__(self, name, key, url, bulk_url, mapping, cache=None, status=None,
+                 bulk_interval=BULK_INTERVAL, max_bulk_size=960, session=None, breaker=None, policy=None,
+                 bulk_format='json', precision=None, optional=(), debug=False):
+        """
+        Class initialization
+        'mapping' - list of pairs (field, reading), 'status' - function which returns status of device,
+        'breaker' - circuit breaker of channel (breaker with default settings if it isn't set),
+        'policy' - reporting policy of samples (climate.reporting, None - every sample is sent),
+        'bulk_format' - json or csv, 'precision' - dictionary reading -> decimal digits of CSV bulk,
+        'optional' - readings which can be absent (their fields aren't sent then).
+        """
+        self.name = name
+        self.mapping = mapping
+        self.optional = frozenset(optional)
+        self.policy = policy
+        self.cache = cache
+        self._key = key
+        self._url = url
+        self._bulk_url = bulk_url if cache is not None else ''
+        self._status = status or (lambda: '')
+        self._session = session
+        self._debug = debug
+        self._send_error_cnt = 0 # Continuous local faults
+        self.breaker = breaker or CircuitBreaker(name)
+        self.bulk_sender = None
+        self.backlog = None
+        if self._bulk_url:
+            self.bulk_sender = BulkSender(cache, key, self._bulk_url, interval=bulk_interval,
+                                          session=session, debug=debug, name=name, fmt=bulk_format,
+                                          precision=dict((field, (precision or {})[reading]) for field, reading in mapping
+                                                         if reading in (precision or {})))
+            self.backlog = BacklogUploader(self.bulk_sender, cache, self._status, max_bulk_size,
+                                           breaker=self.breaker, debug=debug, name=name)
+        labels = (name or 'default',)
+        SEND_ERRORS.set_function(lambda: self._send_error_cnt, labels)
+        BREAKER_OPEN.set_function(lambda: int(self.breaker.state == OPEN), labels)
+
+    def fields(self, readings):
+        """
+        Return values of fields of channel from dictionary of named readings
+        Absent optional readings (e.g. 'cq' before its filter is full) aren't sent, other absent
+        readings are None (sample isn't sent).
+        """
+        return dict((field, readings.get(reading)) for field, reading in self.mapping
+                    if reading in readings or reading not in self.optional)
+
+    def spill(self, current_time, fields):
+        """
+        Save sample which can't be sent now to cache (or lose it without cache)
+        """
+        if self._bulk_url:
+            self.cache.append(current_time, fields)
+        else:
+            print('{} Channel {}: sample {} is lost.'.format(str(datetime.datetime.now()), self.name or 'default', current_time))
+
+    def close(self):
+        """
+        Write cache of channel to DB
+        """
+        if self.cache is not None:
+            self.cache.close()
+
+    def send(self, current_time, fields):
+        """
+        Send data to Cloud, return number of continuous local faults
+        """
+        if not self._key:
+            print('{} Key for thingspeak.com not found.'.format(str(datetime.datetime.now())))
+            sys.exit(0)
+
+        if any(value is None for value in fields.values()):
+            print('{} Found None value, don\'t send.'.format(str(datetime.datetime.now())))
+            return self._send_error_cnt
+
+        allowed = False # Request is allowed by breaker
+        try:
+            if self._bulk_url:
+                self.cache.append(current_time, fields)
+
+                status = self._status()
+                if not status: # Device doesn't have IP address
+                    self._send_error_cnt += 1
+                    return self._send_error_cnt
+
+                if not self.breaker.allow(): # Sample is kept in cache
+                    return self._send_error_cnt
+                allowed = True
+
+                # Send data to Thingspeak (skipped while backlog uploader sends the cache)
+                if self.bulk_sender.send(status) is None:
+                    self.breaker.release()
+                    return self._send_error_cnt
+
+            elif self._url:
+                if not self.breaker.allow():
+                    self.spill(current_time, fields)
+                    return self._send_error_cnt
+                allowed = True
+
+                postdata = update_postdata(self._key, current_time, fields, self._status())
+                if self._debug:
+                    print('{} {}'.format(str(datetime.datetime.now()), postdata))
+
+                # Send data to Thingspeak
+                html_string = post(self._url, postdata, 'application/x-www-form-urlencoded', session=self._session)
+                if self._debug:
+                    print('{} Update: {}'.format(str(datetime.datetime.now()), html_string))
+                UPLOADED_ROWS.inc(1, (self.name or 'default',))
+            else:
+                print('{} Correct url for thingspeak.com not found.'.format(str(datetime.datetime.now())))
+                sys.exit(0)
+            self._send_error_cnt = 0
+            self.breaker.success()
+        except (SystemExit, KeyboardInterrupt):
+            raise # System Exit or Keyboard Interrupt
+        except BaseException as e:
+            print_error(e)
+            if is_local_fault(e):
+                self._send_error_cnt += 1
+                if allowed: # Request of breaker wasn't sent
+                    self.breaker.release()
+            elif isinstance(e, LostConnectionError): # Idle connection was closed by server, it isn't server fault
+                self._send_error_cnt = 0
+                if allowed:
+                    self.breaker.release()
+            else: # Network of device works, server is unavailable
+                self._send_error_cnt = 0
+                self.breaker.failure(retry_after(e))
+        return self._send_error_cnt
@@ -0,0 +1,299 @@
+"""
+Columnar time-series store in memory-mapped segment files
+
+Store is directory of segment files 'seg-<first timestamp>.cts'. Segment is
+preallocated for 'capacity' rows and keeps every column as fixed-width array:
+timestamps (UTC epoch seconds, int64) and values (float32, NaN for unknown
+value). Row is written to its arrays before row counter in header is
+increased, so readers in other threads never see partial rows.
+
+Timestamps are increasing inside segment (new segment is started when clock
+goes back), so range queries find rows by binary search over timestamp array
+and read only necessary pages; downsampled reads aggregate rows by buckets
+without loading of segment into memory. Segments are ordered by their first
+timestamp, but they can overlap after clock jump back, so rows of segments
+are merged by timestamp. The oldest segments are removed when
+number of segments exceeds 'max_segments'.
+"""
+import datetime
+import glob
+import heapq
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from climate.cache import to_epoch
+
+MAGIC = b'CTS1'
+HEADER_SIZE = 256           # Magic, capacity (uint32), count (uint32), columns (uint16), names of columns
+HEADER = struct.Struct('<4sIIH')
+COUNT_OFFSET = 8
+TS = struct.Struct('<q')
+VALUE = struct.Struct('<f')
+CAPACITY = 65536            # Rows per segment (about 22 days with 30 seconds pause)
+SEGMENT_PATTERN = 'seg-*.cts'
+
+def _nan_to_none(value):
+    return None if math.isnan(value) else value
+
+class Segment(object):
+    """
+    Class for one segment file
+    """
+    def __init__(self, path, columns=None, capacity=CAPACITY, writable=False):
+        """
+        Open segment, new segment is created if 'columns' are set
+        """
+        self.path = path
+        if columns is not None:
+            names = ','.join(columns).encode('utf-8')
+            if HEADER.size + len(names) > HEADER_SIZE:
+                raise ValueError('Too many columns for segment')
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, capacity, 0, len(columns)) + names)
+                f.truncate(HEADER_SIZE + capacity * (TS.size + VALUE.size * len(columns)))
+        self._file = open(path, 'r+b' if writable else 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+        magic, self.capacity, count, column_count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('{} is not segment of store'.format(path))
+        names = self._map[HEADER.size:HEADER_SIZE].rstrip(b'\0').decode('utf-8')
+        self.columns = names.split(',') if column_count else []
+        self._ts_offset = HEADER_SIZE
+        self._value_offsets = [HEADER_SIZE + self.capacity * TS.size + self.capacity * VALUE.size * i for i in range(len(self.columns))]
+
+    def close(self):
+        """
+        Close segment
+        """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def count(self):
+        """
+        Return number of rows
+        """
+        return struct.unpack_from('<I', self._map, COUNT_OFFSET)[0]
+
+    def ts(self, row):
+        """
+        Return timestamp of row
+        """
+        return TS.unpack_from(self._map, self._ts_offset + row * TS.size)[0]
+
+    def row(self, row):
+        """
+        Return tuple (timestamp, values) of row
+        """
+        return self.ts(row), [_nan_to_none(VALUE.unpack_from(self._map, offset + row * VALUE.size)[0])
+                              for offset in self._value_offsets]
+
+    def append(self, ts, values):
+        """
+        Write row, return False if segment is full
+        """
+        count = self.count()
+        if count >= self.capacity:
+            return False
+        TS.pack_into(self._map, self._ts_offset + count * TS.size, ts)
+        for offset, value in zip(self._value_offsets, values):
+            VALUE.pack_into(self._map, offset + count * VALUE.size, float('nan') if value is None else float(value))
+        struct.pack_into('<I', self._map, COUNT_OFFSET, count + 1) # Row is visible for readers
+        return True
+
+    def flush(self):
+        """
+        Write changed pages to file
+        """
+        self._map.flush()
+
+    def bisect(self, ts, count=None):
+        """
+        Return index of the first row with timestamp not less than 'ts'
+        """
+        low, high = 0, self.count() if count is None else count
+        while low < high:
+            middle = (low + high) // 2
+            if self.ts(middle) < ts:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+class TimeSeriesStore(object):
+    """
+    Class for append-only store of samples
+    """
+    def __init__(self, path, columns, capacity=CAPACITY, max_segments=0, flush_interval=60):
+        """
+        Class initialization
+        'max_segments' - number of kept segments (0 - unlimited),
+        'flush_interval' - interval of writing of changed pages to SD card (seconds).
+        """
+        self._path = os.path.expanduser(path)
+        self._columns = list(columns)
+        self._capacity = capacity
+        self._max_segments = max_segments
+        self._flush_interval = flush_interval
+        self._last_flush = time.time()
+        self._lock = threading.RLock()
+        self._segment = None
+        self._last_ts = None
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+        segments = self.segments()
+        if segments:
+            try:
+                segment = Segment(segments[-1], writable=True)
+                if segment.columns == self._columns and segment.count() < segment.capacity:
+                    self._segment = segment
+                    self._last_ts = segment.ts(segment.count() - 1) if segment.count() else None
+                else:
+                    segment.close()
+            except (IOError, OSError, ValueError, struct.error) as e:
+                print('{} Store error: {}'.format(str(datetime.datetime.now()), str(e)))
+
+    def segments(self):
+        """
+        Return list of segment files ordered by the first timestamp
+        """
+        return sorted(glob.glob(os.path.join(self._path, SEGMENT_PATTERN)), key=self._segment_key)
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    def append(self, current_time, values):
+        """
+        Add sample, 'values' are in order of columns
+        """
+        ts = to_epoch(current_time)
+        with self._lock:
+            if self._segment is not None and self._last_ts is not None and ts < self._last_ts:
+                self._close_segment() # Clock went back, timestamps of segment should be sorted
+            if self._segment is None or not self._segment.append(ts, values):
+                self._close_segment()
+                self._segment = Segment(self._new_segment_path(ts), self._columns, self._capacity, writable=True)
+                self._segment.append(ts, values)
+                self._remove_old_segments()
+            self._last_ts = ts
+            if time.time() - self._last_flush >= self._flush_interval:
+                self.flush()
+
+    def _new_segment_path(self, ts):
+        path = os.path.join(self._path, 'seg-{:012d}.cts'.format(ts))
+        number = 0
+        while os.path.exists(path): # Segment with the same start after clock jump back
+            number += 1
+            path = os.path.join(self._path, 'seg-{:012d}-{}.cts'.format(ts, number))
+        return path
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.flush()
+            self._segment.close()
+            self._segment = None
+
+    def _remove_old_segments(self):
+        if not self._max_segments:
+            return
+        for path in self.segments()[:-self._max_segments]:
+            if path == self._segment.path: # Segment after clock jump back can be the oldest one
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                print('{} Store error: {}'.format(str(datetime.datetime.now()), str(e)))
+
+    def flush(self):
+        """
+        Write changed pages of current segment to file
+        """
+        with self._lock:
+            self._last_flush = time.time()
+            if self._segment is not None:
+                self._segment.flush()
+
+    def close(self):
+        """
+        Flush and close store
+        """
+        with self._lock:
+            self._close_segment()
+
+    def read(self, start=None, end=None, columns=None):
+        """
+        Return generator of rows (timestamp, values) with start <= timestamp < end
+        'columns' - names of necessary columns (all columns by default).
+        """
+        readers = []
+        for number, path in enumerate(self.segments()):
+            if end is not None and self._segment_start(path) >= end:
+                break # Segments are ordered by the first timestamp
+            readers.append(self._read_segment(number, path, start, end, columns))
+        for ts, number, row, values in heapq.merge(*readers): # Segments can overlap after clock jump back
+            yield ts, values
+
+    def _read_segment(self, number, path, start, end, columns):
+        try:
+            segment = Segment(path)
+        except (IOError, OSError, ValueError, struct.error) as e: # Segment was removed by retention
+            print('{} Store error: {}'.format(str(datetime.datetime.now()), str(e)))
+            return
+        try:
+            indexes = [segment.columns.index(column) if column in segment.columns else None
+                       for column in (columns or self._columns)]
+            count = segment.count()
+            row = segment.bisect(start, count) if start is not None else 0
+            while row < count:
+                ts, values = segment.row(row)
+                if end is not None and ts >= end:
+                    break
+                yield ts, number, row, [values[index] if index is not None else None for index in indexes]
+                row += 1
+        finally:
+            segment.close()
+
+    def read_downsampled(self, start, end, step, columns=None):
+        """
+        Return generator of buckets (timestamp of bucket, means of values, count of rows)
+        Rows are grouped by 'step' seconds, empty buckets are skipped.
+        """
+        bucket = None
+        sums = counts = None
+        rows = 0
+        for ts, values in self.read(start, end, columns):
+            current = ts - (ts - (start or 0)) % step
+            if current != bucket:
+                if bucket is not None:
+                    yield bucket, [s / c if c else None for s, c in zip(sums, counts)], rows
+                bucket = current
+                sums = [0.0] * len(values)
+                counts = [0] * len(values)
+                rows = 0
+            rows += 1
+            for i, value in enumerate(values):
+                if value is not None:
+                    sums[i] += value
+                    counts[i] += 1
+        if bucket is not None:
+            yield bucket, [s / c if c else None for s, c in zip(sums, counts)], rows
+
+    @staticmethod
+    def _segment_start(path):
+        return int(os.path.basename(path)[4:-4].split('-')[0])
+
+    @staticmethod
+    def _segment_key(path):
+        start, _, number = os.path.basename(path)[4:-4].partition('-')
+        return int(start), int(number or 0)
@@ -0,0 +1,83 @@
+"""
+Sending of samples in separate thread
+
+Sampling loop only puts samples to bounded queue, so slow or failed HTTP
+requests don't shift sampling clock. Samples which don't fit the queue are
+spilled to cache.
+"""
+import collections
+import datetime
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from climate import metrics
+
+QUEUE_SIZE = metrics.gauge('climate_queue_size', 'Samples in sending queue of uploader', ['uploader'])
+Sample = collections.namedtuple('Sample', ['current_time', 'fields']) # Values by fields of channel
+
+class Uploader(threading.Thread):
+    """
+    Class for sending of samples from queue
+    """
+    def __init__(self, send, spill=None, size=100, name="uploader"):
+        """
+        Class initialization
+        'send' is called with fields of sample and returns number of continuous errors,
+        'spill' is called with fields of sample which doesn't fit the queue.
+        """
+        threading.Thread.__init__(self, name=name)
+        self._event_stop = threading.Event()
+        self._queue = queue.Queue(maxsize=size)
+        self._send = send
+        self._spill = spill
+        self.error_cnt = 0
+        QUEUE_SIZE.set_function(self._queue.qsize, (name,))
+
+    def stop(self):
+        """
+        Stop sending
+        """
+        self._event_stop.set()
+
+    def put(self, sample):
+        """
+        Put sample to queue (never blocks)
+        """
+        try:
+            self._queue.put_nowait(sample)
+        except queue.Full:
+            self._spill_sample(sample)
+
+    def _spill_sample(self, sample):
+        if self._spill:
+            self._spill(*sample)
+        else:
+            print('{} Queue is full, sample {} is lost.'.format(str(datetime.datetime.now()), sample.current_time))
+
+    def run(self):
+        """
+        Loop of samples sending
+        """
+        while not self._event_stop.is_set():
+            try:
+                sample = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.error_cnt = self._send(*sample)
+            except SystemExit: # Sending isn't possible (e.g. wrong configuration)
+                break
+            except BaseException as e:
+                self.error_cnt += 1
+                print('{} Sending error: {}'.format(str(datetime.datetime.now()), str(e)))
+        # Samples which weren't sent are saved to cache
+        while True:
+            try:
+                self._spill_sample(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        print('{} Uploader was stopped.'.format(str(datetime.datetime.now())))
@@ -0,0 +1,165 @@
+"""
+Tests of keep-alive HTTP session and classification of sending faults
+
+Requests are sent to local stand-in of thingspeak.com (tools/thingspeak_standin.py)
+on ephemeral port.
+"""
+import errno
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+
+try:
+    from urllib2 import HTTPError, URLError
+except ImportError:
+    from urllib.error import HTTPError, URLError
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+from thingspeak_standin import StandInServer, StandInHandler, DOWN
+from climate import thingspeak
+from climate.breaker import CircuitBreaker, CLOSED, is_local_fault
+from climate.session import HttpSession, LostConnectionError
+
+UPDATE = 'api_key=KEY&field1=1'
+
+class ClosingHandler(StandInHandler):
+    """
+    Handler which closes connection after response without 'Connection: close' (idle timeout of server)
+    """
+    def do_POST(self):
+        StandInHandler.do_POST(self)
+        self.close_connection = True
+
+class ResettingHandler(StandInHandler):
+    """
+    Handler which reads request and resets connection instead of response (RST, not FIN)
+    if 'reset' of server is set
+    """
+    def do_POST(self):
+        if not self.server.reset:
+            return StandInHandler.do_POST(self)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+class CountingServer(StandInServer):
+    """
+    Stand-in server which counts accepted connections
+    """
+    def __init__(self, **options):
+        StandInServer.__init__(self, rate_limit=0, **options)
+        self.RequestHandlerClass = ResettingHandler
+        self.connections = 0
+        self.reset = False
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        StandInServer.process_request(self, request, client_address)
+
+class StandInTestCase(unittest.TestCase):
+    """
+    Base class of tests with stand-in server and session
+    """
+    def setUp(self):
+        self.server = CountingServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/update'.format(self.server.port)
+        self.session = HttpSession(timeout=1)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+class SessionTestCase(StandInTestCase):
+    def test_keep_alive_reuses_connection(self):
+        for i in range(3):
+            self.assertEqual(self.session.post(self.url, UPDATE), str(i + 1).encode('utf-8'))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.stats['requests'], 3)
+
+    def test_reconnect_after_server_closes_connection(self):
+        self.server.RequestHandlerClass = ClosingHandler
+        for i in range(3):
+            self.assertEqual(self.session.post(self.url, UPDATE), str(i + 1).encode('utf-8'))
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.server.stats['requests'], 3) # Nothing is sent twice
+
+    def test_timeout_isnt_retried(self):
+        self.session.post(self.url, UPDATE)
+        self.server.latency = 2
+        with self.assertRaises(URLError) as context:
+            self.session.post(self.url, UPDATE)
+        self.assertIsInstance(context.exception.reason, socket.timeout)
+        self.assertNotIsInstance(context.exception, LostConnectionError)
+        self.assertFalse(is_local_fault(context.exception)) # Server is slow
+        self.assertEqual(self.server.stats['requests'], 2)
+
+    def test_reset_after_sending(self):
+        self.session.post(self.url, UPDATE)
+        self.server.reset = True
+        # Reused connection: server could close it as idle
+        with self.assertRaises(LostConnectionError) as context:
+            self.session.post(self.url, UPDATE)
+        self.assertEqual(getattr(context.exception.reason, 'errno', None), errno.ECONNRESET)
+        self.assertFalse(is_local_fault(context.exception))
+        # New connection: server fault
+        with self.assertRaises(URLError) as context:
+            self.session.post(self.url, UPDATE)
+        self.assertNotIsInstance(context.exception, LostConnectionError)
+        self.assertEqual(self.server.stats['requests'], 3) # Request isn't repeated
+
+    def test_http_error_is_server_fault(self):
+        self.server.mode = DOWN
+        with self.assertRaises(HTTPError) as context:
+            self.session.post(self.url, UPDATE)
+        self.assertEqual(context.exception.code, 503)
+        self.assertFalse(is_local_fault(context.exception))
+
+    def test_refused_connection_is_server_fault(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close() # Port isn't listened
+        with self.assertRaises(URLError) as context:
+            self.session.post('http://127.0.0.1:{}/update'.format(port), UPDATE)
+        self.assertFalse(is_local_fault(context.exception))
+
+    def test_local_faults(self):
+        self.assertTrue(is_local_fault(URLError(socket.gaierror(socket.EAI_NONAME, 'Name or service not known'))))
+        self.assertTrue(is_local_fault(URLError(socket.error(errno.ENETUNREACH, 'Network is unreachable'))))
+        self.assertTrue(is_local_fault(URLError(socket.error(errno.EHOSTUNREACH, 'No route to host'))))
+        self.assertFalse(is_local_fault(URLError(socket.error(errno.ECONNREFUSED, 'Connection refused'))))
+        self.assertFalse(is_local_fault(URLError(socket.timeout('timed out'))))
+
+class ChannelFaultsTestCase(StandInTestCase):
+    def channel(self):
+        return thingspeak.Channel('test', 'KEY', self.url, '', [('field1', 'co2')], session=self.session,
+                                  breaker=CircuitBreaker('test', threshold=1))
+
+    def test_lost_connection_doesnt_open_breaker(self):
+        channel = self.channel()
+        self.assertEqual(channel.send('2026-01-01 00:00:00', {'field1': 400}), 0)
+        self.server.reset = True
+        self.assertEqual(channel.send('2026-01-01 00:00:01', {'field1': 401}), 0)
+        self.assertEqual(channel.breaker.state, CLOSED)
+        self.assertEqual(channel.breaker.failures, 0)
+        # Reset of new connection is server fault
+        self.assertEqual(channel.send('2026-01-01 00:00:02', {'field1': 402}), 0)
+        self.assertEqual(channel.breaker.failures, 1)
+        self.assertNotEqual(channel.breaker.state, CLOSED)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+"""
+Tests of output sinks: batching, retries and buffer of BatchSink, InfluxSink and FileSink
+
+InfluxDB is replaced by local HTTP stand-in on ephemeral port.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+from thingspeak_standin import StandInServer, StandInHandler, DOWN, UP
+from climate import sinks
+from climate.session import HttpSession
+
+SAMPLES = [('2026-01-01 00:00:0{}'.format(i), {'co2': 400 + i, 'temp': 20.5}) for i in range(5)]
+MAPPING = [('co2', 'co2'), ('temp', 'temp')]
+
+class FailingSink(sinks.BatchSink):
+    """
+    Sink which fails 'failures' first writes
+    """
+    def __init__(self, failures=0, **options):
+        options.setdefault('retry_delay', 0)
+        sinks.BatchSink.__init__(self, 'test', MAPPING, **options)
+        self.failures = failures
+        self.attempts = 0
+        self.written = []
+
+    def write(self, batch):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise IOError('write error')
+        self.written.extend(batch)
+
+class BatchSinkTestCase(unittest.TestCase):
+    def test_batch_is_written_by_size(self):
+        sink = FailingSink(batch_size=3)
+        for sample in SAMPLES[:2]:
+            sink.send(*sample)
+        self.assertEqual(sink.attempts, 0)
+        sink.send(*SAMPLES[2])
+        self.assertEqual(sink.written, SAMPLES[:3])
+
+    def test_retry(self):
+        sink = FailingSink(failures=2, retries=3)
+        self.assertEqual(sink.send(*SAMPLES[0]), 0)
+        self.assertEqual(sink.attempts, 3)
+        self.assertEqual(sink.written, SAMPLES[:1]) # Written once
+
+    def test_failed_batch_is_requeued(self):
+        sink = FailingSink(failures=2, retries=1)
+        self.assertEqual(sink.send(*SAMPLES[0]), 1)
+        self.assertEqual(list(sink._pending), SAMPLES[:1])
+        # Failed batch is written with the next one in order
+        self.assertEqual(sink.send(*SAMPLES[1]), 0)
+        self.assertEqual(sink.written, SAMPLES[:2])
+        self.assertEqual(len(sink._pending), 0)
+
+    def test_overflow_loses_oldest_samples(self):
+        sink = FailingSink(batch_size=10, max_pending=3)
+        for sample in SAMPLES:
+            sink.send(*sample)
+        self.assertEqual(sink.lost, 2)
+        self.assertEqual(list(sink._pending), SAMPLES[2:])
+
+    def test_overflow_of_requeued_batch(self):
+        sink = FailingSink(failures=1, retries=0, batch_size=3, max_pending=3)
+        for sample in SAMPLES[:3]:
+            sink.send(*sample)
+        self.assertEqual(sink.lost, 0)
+        self.assertEqual(list(sink._pending), SAMPLES[:3])
+        sink.spill(*SAMPLES[3]) # Sample which doesn't fit the queue of uploader
+        self.assertEqual(sink.lost, 1)
+        sink.close()
+        self.assertEqual(sink.written, SAMPLES[1:4])
+
+class InfluxHandler(StandInHandler):
+    """
+    Handler of InfluxDB write requests, lines and tokens are kept by server
+    """
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+        if self.server.mode == DOWN:
+            return self._reply(503, '{"error": "Service Unavailable"}')
+        with self.server.lock:
+            self.server.lines.extend(raw.decode('utf-8').splitlines())
+            self.server.tokens.append(self.headers.get('Authorization'))
+        self._reply(204, '')
+
+class InfluxSinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.RequestHandlerClass = InfluxHandler
+        self.server.lines = []
+        self.server.tokens = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/write?db=climate&precision=s'.format(self.server.port)
+        self.session = HttpSession(timeout=1)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def sink(self, **options):
+        options.setdefault('retry_delay', 0)
+        return sinks.InfluxSink('influx', MAPPING, self.url, 'climate', {'room': 'living room'}, 'TOKEN',
+                                session=self.session, **options)
+
+    def test_batch_is_one_request(self):
+        sink = self.sink(batch_size=2)
+        sink.send(*SAMPLES[0])
+        sink.send('2026-01-01 00:00:01', {'co2': 401, 'temp': None}) # Unknown values aren't written
+        sink.send('2026-01-01 00:00:02', {'co2': None, 'temp': None})
+        sink.close()
+        self.assertEqual(self.server.stats['requests'], 1) # Sample without values isn't sent
+        self.assertEqual(self.server.lines, ['climate,room=living\\ room co2=400.0,temp=20.5 1767225600',
+                                             'climate,room=living\\ room co2=401.0 1767225601'])
+        self.assertEqual(self.server.tokens, ['Token TOKEN'])
+
+    def test_server_error_is_retried_with_next_batch(self):
+        sink = self.sink(retries=1)
+        self.server.mode = DOWN
+        self.assertEqual(sink.send(*SAMPLES[0]), 1)
+        self.assertEqual(self.server.stats['requests'], 2)
+        self.server.mode = UP
+        self.assertEqual(sink.send(*SAMPLES[1]), 0)
+        self.assertEqual(len(self.server.lines), 2)
+
+    def test_url_is_required(self):
+        with self.assertRaises(ValueError):
+            sinks.InfluxSink('influx', MAPPING, '')
+
+class FileSinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sink.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def lines(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def test_samples_are_written(self):
+        sink = sinks.FileSink('file', MAPPING, self.path, batch_size=2)
+        for sample in SAMPLES[:3]:
+            sink.send(*sample)
+        sink.close()
+        self.assertEqual(self.lines(), ['{},{},20.5'.format(current_time, fields['co2'])
+                                        for current_time, fields in SAMPLES[:3]])
+
+    def test_partial_write_isnt_duplicated(self):
+        sink = sinks.FileSink('file', MAPPING, self.path, batch_size=3, retries=1, retry_delay=0)
+        write = sink._data_log.write
+        calls = []
+
+        def failing_write(current_time, values):
+            calls.append(current_time)
+            if len(calls) == 2: # The second sample of batch fails once
+                raise IOError('No space left on device')
+            write(current_time, values)
+
+        sink._data_log.write = failing_write
+        for sample in SAMPLES[:3]:
+            sink.send(*sample)
+        sink.close()
+        self.assertEqual([line.split(',')[0] for line in self.lines()],
+                         [current_time for current_time, fields in SAMPLES[:3]])
+
+    def test_path_is_required(self):
+        with self.assertRaises(ValueError):
+            sinks.FileSink('file', MAPPING, '')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+"""
+Tests of mapping of readings to fields of thingspeak.com channel
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from climate import thingspeak
+
+class ChannelFieldsTestCase(unittest.TestCase):
+    def channel(self, fields):
+        return thingspeak.Channel('test', 'KEY', 'http://127.0.0.1/update', '', thingspeak.parse_fields(fields),
+                                  optional=('cq',))
+
+    def test_all_readings(self):
+        channel = self.channel('field1:co2, field2:temp, field5:cq')
+        self.assertEqual(channel.fields({'co2': 400, 'temp': 21.5, 'cq': 0.8, 'humidity': 40}),
+                         {'field1': 400, 'field2': 21.5, 'field5': 0.8})
+
+    def test_absent_optional_reading_isnt_sent(self):
+        channel = self.channel('field1:co2, field2:temp, field5:cq')
+        self.assertEqual(channel.fields({'co2': 400, 'temp': 21.5}), {'field1': 400, 'field2': 21.5})
+
+    def test_absent_primary_reading_is_none(self):
+        channel = self.channel('field1:co2, field2:temp, field5:cq')
+        fields = channel.fields({'temp': 21.5, 'cq': 0.8})
+        self.assertIsNone(fields['field1'])
+        # No devices: sample isn't sent instead of row with status only
+        self.assertEqual(channel.fields({}), {'field1': None, 'field2': None})
+
+    def test_only_optional_readings(self):
+        self.assertEqual(self.channel('field5:cq').fields({'co2': 400}), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Benchmark of bulk-update payload encoding
+
+Compares JSON bulk (row is dictionary with 'created_at' and status) with CSV
+bulk (relative timestamps, rounded values, status once per bulk) for bulk of
+960 samples like Device channel: CO2, temperature of MT8057 (w * 0.0625 -
+273.15), humidity and temperature of DHT, statistics and climate quality.
+Payload bytes (raw and compressed by gzip like HttpSession) and encoding time
+are reported, CSV rows are checked against source samples.
+
+Usage: python tools/bench_bulk_encoding.py [number of rows]
+"""
+from __future__ import print_function
+import os
+import random
+import sys
+import timeit
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from climate import thingspeak
+from climate.cache import from_epoch, to_epoch
+from climate.session import gzip_compress
+
+KEY = 'ABCDEFGHIJKLMNOP'
+STATUS = '192.168.100.123'
+PAUSE = 30
+PRECISION = {'field1': 0, 'field2': 2, 'field3': 1, 'field4': 1, 'field5': 0, 'field6': 2} # Resolution of sensors
+
+def make_rows(count, seed=1):
+    """
+    Samples of cache like Device channel with default fields
+    """
+    generator = random.Random(seed)
+    start = to_epoch('2020-01-01 00:00:00')
+    co2, w, humidity = 800, 4750, 45.0
+    rows = []
+    for i in range(count):
+        co2 = min(max(co2 + generator.randint(-20, 20), 400), 3000)
+        w = min(max(w + generator.randint(-2, 2), 4600), 4900)
+        humidity = min(max(humidity + generator.uniform(-0.5, 0.5), 20), 80)
+        rows.append({
+            'created_at': from_epoch(start + PAUSE * i),
+            'field1': co2,
+            'field2': w * 0.0625 - 273.15,
+            'field3': round(humidity, 1),
+            'field4': round(w * 0.0625 - 273.15 + generator.uniform(-0.5, 0.5), 1),
+            'field5': co2 + generator.randint(0, 30),
+            'field6': 1 + co2 / 1000.0 + abs(w * 0.0625 - 295.15) / 10.0
+        })
+    return rows
+
+def check_csv(postdata, rows, now):
+    """
+    Check that CSV bulk has the same timestamps and values (with precision) as source rows
+    """
+    updates = parse_qs(postdata)['updates'][0].split('|')
+    assert len(updates) == len(rows)
+    ts = now
+    for line, row in zip(updates, sorted(rows, key=lambda row: row['created_at'], reverse=True)):
+        columns = line.split(',')
+        ts -= int(columns[0])
+        assert from_epoch(ts) == row['created_at']
+        for field, value in zip(thingspeak.FIELDS, columns[1:9]):
+            if field in row:
+                assert abs(float(value) - row[field]) <= 0.5 * 10 ** -PRECISION[field] + 1e-9, (field, value, row[field])
+
+def bench(name, func, count, repeat=5):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    payload = func()
+    compressed = gzip_compress(payload.encode('utf-8'))
+    print('{:<18} {:>8} bytes {:>7.1f} bytes/row {:>8} gzip bytes {:>8.2f} ms/bulk {:>6.2f} us/row'.format(
+        name, len(payload), len(payload) / float(count), len(compressed), best * 1e3, best * 1e6 / count))
+    return len(payload), len(compressed), best
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 960
+    rows = make_rows(count)
+    now = to_epoch(rows[-1]['created_at']) + 5
+
+    check_csv(thingspeak.bulk_csv_postdata(KEY, rows, STATUS, PRECISION, now), rows, now)
+
+    # JSON encoder adds status to rows of cache, so it gets copies like rows from cache DB
+    json_size, json_gzip, json_time = bench('json', lambda: thingspeak.bulk_postdata(KEY, [dict(row) for row in rows], STATUS), count)
+    bench('csv (3 digits)', lambda: thingspeak.bulk_csv_postdata(KEY, rows, STATUS, None, now), count)
+    csv_size, csv_gzip, csv_time = bench('csv (precision)', lambda: thingspeak.bulk_csv_postdata(KEY, rows, STATUS, PRECISION, now), count)
+    print('CSV payload is {:.1f}x smaller ({:.1f}x with gzip), encoding is {:.1f}x {}'.format(
+        float(json_size) / csv_size, float(json_gzip) / csv_gzip,
+        max(json_time, csv_time) / min(json_time, csv_time), 'faster' if csv_time < json_time else 'slower'))
+
+if __name__ == "__main__":
+    main()
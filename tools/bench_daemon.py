@@ -0,0 +1,212 @@
+"""
+End-to-end benchmark of daemon with emulated sensors
+
+Daemon ('Device' or 'mt8057' script) is run in child process with emulated
+MT8057 and DHT (climate.emulator) and accelerated time: clock of child goes
+'scale' times faster (time.time, time.sleep and timeouts of Event.wait are
+scaled by warp_clock of thingspeak_standin), so pause between samples, DHT
+reads, scans of devices and bulk-update interval are shorter. Timeouts of
+queues and conditions and clock of asyncio loop aren't scaled. Samples are
+sent to stand-in of thingspeak.com (tools/thingspeak_standin.py without rate
+limit and faults) on localhost; cache, log and local history are written to
+temporary directory. Child is stopped by SIGTERM.
+
+Report: packets decoded per second, CPU time per packet, samples, cache
+flush latency, rows received by server (with duplicates) and memory growth (RSS).
+
+Usage: python3 tools/bench_daemon.py [--script Device|mt8057] [--duration 20] [--scale 100]
+       [--rate 1000] [--devices 1] [--bad-ratio 0.01] [--changed-only]
+"""
+import argparse
+import json
+import os
+import resource
+import runpy
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from thingspeak_standin import StandInServer, warp_clock
+
+SCRIPTS = {
+    'Device': os.path.join(ROOT, 'Device', 'thingspeak_raspi-co2.py'),
+    'mt8057': os.path.join(ROOT, 'mt8057', 'thingspeak_mt8057.py')
+}
+
+CONFIG = '''[DEFAULT]
+log = {dir}/log.csv
+store = {dir}/history
+cache_dir = {dir}
+pause = 30
+queue_size = 100
+error_limit = 1000000000
+mt8057_changed_only = {changed_only}
+usb_read_timeout = 1000
+api_port = 0
+
+[thingspeak.com]
+url = http://127.0.0.1:{port}/update
+bulk_url = http://127.0.0.1:{port}/channels/1/bulk_update.json
+bulk_interval = 15
+key = BENCHMARK
+sensor = 22
+dht_interval = 2
+fields = {fields}
+'''
+
+FIELDS = {
+    'Device': 'field1:co2, field2:temp, field3:humidity, field4:temp2, field5:co2.max, field6:cq',
+    'mt8057': 'field1:co2, field2:temp, field3:co2.mean, field4:co2.max'
+}
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def rss():
+    """
+    Return resident memory of process (bytes)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def child(args):
+    """
+    Run daemon with emulated sensors and write statistics
+    """
+    from climate import emulator
+    devices = emulator.install(devices=args.devices, rate=args.rate, bad_ratio=args.bad_ratio, seed=1)
+    from climate import cache
+    latencies = []
+    flush = cache.Cache.flush
+
+    def timed_flush(self):
+        started = time.perf_counter()
+        flush(self)
+        latencies.append(time.perf_counter() - started)
+
+    cache.Cache.flush = timed_flush
+
+    memory = []
+    stop = threading.Event()
+
+    def sample_memory():
+        while not stop.wait(0.5 * args.scale): # Timeout of event is scaled by warp_clock
+            memory.append(rss())
+
+    warp_clock(args.scale)
+    threading.Thread(target=sample_memory, daemon=True).start()
+    memory.append(rss())
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+    result = runpy.run_path(SCRIPTS[args.script], run_name='__main__')
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_start
+    stop.set()
+    memory.append(rss())
+
+    daemon = result.get('co2_daemon')
+    manager = daemon.t_mt8057 if daemon else None
+    readers = manager.readers() if manager else []
+    stats = {
+        'elapsed': elapsed,
+        'cpu': cpu,
+        'sent': sum(device.sent for device in devices),
+        'bad': sum(device.bad for device in devices),
+        'packets': sum(reader.packets for reader in readers),
+        'decoded': sum(reader.decoded for reader in readers),
+        'dht_reads': emulator.dht.reads,
+        'flushes': len(latencies),
+        'flush_mean': sum(latencies) / len(latencies) if latencies else 0,
+        'flush_p50': percentile(latencies, 50),
+        'flush_p95': percentile(latencies, 95),
+        'flush_max': max(latencies) if latencies else 0,
+        'rss_start': memory[0],
+        'rss_peak': max(memory),
+        'rss_end': memory[-1],
+        'rss_middle': memory[len(memory) // 2]
+    }
+    with open(os.path.join(args.dir, 'stats.json'), 'w') as f:
+        json.dump(stats, f)
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of daemon with emulated sensors')
+    parser.add_argument('--script', choices=sorted(SCRIPTS), default='Device')
+    parser.add_argument('--duration', type=float, default=20, help='real seconds')
+    parser.add_argument('--scale', type=float, default=100, help='speed of clock of daemon')
+    parser.add_argument('--rate', type=float, default=1000, help='packets per second of every MT8057 (by clock of daemon, 0 - without limit)')
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--bad-ratio', type=float, default=0.01)
+    parser.add_argument('--changed-only', action='store_true')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    server = StandInServer(rate_limit=0) # Clock of server isn't accelerated
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    directory = tempfile.mkdtemp(prefix='bench-daemon-')
+    try:
+        config = os.path.join(directory, 'config.ini')
+        with open(config, 'w') as f:
+            f.write(CONFIG.format(dir=directory, port=server.port, changed_only=args.changed_only,
+                                  fields=FIELDS[args.script]))
+        env = dict(os.environ, CLIMATE_CONFIG=config)
+        command = [sys.executable, os.path.abspath(__file__), '--child', '--dir', directory, '--script', args.script,
+                   '--scale', str(args.scale), '--rate', str(args.rate), '--devices', str(args.devices),
+                   '--bad-ratio', str(args.bad_ratio)]
+        with open(os.path.join(directory, 'daemon.log'), 'w') as log:
+            process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+            time.sleep(args.duration)
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+        try:
+            with open(os.path.join(directory, 'stats.json')) as f:
+                stats = json.load(f)
+        except (IOError, OSError, ValueError):
+            with open(os.path.join(directory, 'daemon.log')) as f:
+                sys.stdout.write(f.read()[-3000:])
+            print('Daemon failed (exit code {}).'.format(process.returncode))
+            return 1
+        samples = 0
+        if os.path.exists(os.path.join(directory, 'log.csv')):
+            with open(os.path.join(directory, 'log.csv')) as f:
+                samples = sum(1 for line in f)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory)
+
+    elapsed = stats['elapsed']
+    print('Script: {}, {:.1f} s ({:.0f} s of daemon clock), {} MT8057 at {:g} packets/s'.format(
+        args.script, elapsed, elapsed * args.scale, args.devices, args.rate))
+    print('Packets: {} sent ({} with wrong checksum), {} received, {} decoded ({:.0f} decoded/s)'.format(
+        stats['sent'], stats['bad'], stats['packets'], stats['decoded'], stats['decoded'] / elapsed))
+    print('CPU: {:.2f} s ({:.0f}% of one core), {:.1f} us per received packet'.format(
+        stats['cpu'], 100 * stats['cpu'] / elapsed, 1e6 * stats['cpu'] / max(1, stats['packets'])))
+    print('Samples: {} logged, {} DHT reads, {} rows in {} requests received by server ({} duplicates)'.format(
+        samples, stats['dht_reads'], server.stats['rows'], server.stats['requests'], server.duplicates()))
+    print('Cache flushes: {}, latency mean {:.2f} ms, p50 {:.2f} ms, p95 {:.2f} ms, max {:.2f} ms'.format(
+        stats['flushes'], 1e3 * stats['flush_mean'], 1e3 * stats['flush_p50'], 1e3 * stats['flush_p95'], 1e3 * stats['flush_max']))
+    print('Memory (RSS): start {:.1f} MB, middle {:.1f} MB, end {:.1f} MB, peak {:.1f} MB, growth of 2nd half {:+.1f} KB'.format(
+        stats['rss_start'] / 1048576.0, stats['rss_middle'] / 1048576.0, stats['rss_end'] / 1048576.0,
+        stats['rss_peak'] / 1048576.0, (stats['rss_end'] - stats['rss_middle']) / 1024.0))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Microbenchmark of MT8057 packet decoding
+
+Compares original per-byte decoding (lists and modulo arithmetic) with
+table-driven decoding and batch decoding of concatenated packets (packets are
+unpacked by offset in buffer instead of slicing).
+
+Usage: python tools/bench_mt8057_codec.py [number of packets]
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from climate import mt8057_codec
+
+def legacy_decode(data):
+    """
+    Original decoding from mt8057._decode
+    """
+    shuffle = [2, 4, 0, 7, 1, 6, 5, 3]
+    phase1 = []
+    phase2 = []
+    phase3 = []
+    result = []
+
+    for i in range(8):
+        phase1.append(data[shuffle[i]])
+        phase2.append(phase1[i] ^ mt8057_codec.MAGIC_BUF[i])
+    for i in range(8):
+        phase3.append(((phase2[i] >> 3) | (phase2[(i - 1 + 8) % 8] << 5)) & 0xff)
+        result.append((0x100 + phase3[i] - mt8057_codec.CTMP[i]) & 0xff)
+
+    return result
+
+def legacy_parse(data):
+    """
+    Original parsing from mt8057._parse
+    """
+    item = legacy_decode(data)
+    r0 = item[0]
+    r1 = item[1]
+    r2 = item[2]
+    r3 = item[3]
+    checksum = (r0 + r1 + r2) & 0xff
+    if (checksum == r3 and item[4] == 0x0d):
+        w = (r1 << 8) + r2
+        if (r0 == 0x42):
+            return r0, w * 0.0625 - 273.15
+        return r0, w
+    return None
+
+def make_packets(count):
+    """
+    Packets like MT8057 stream: CO2, temperature and some other operations
+    """
+    packets = []
+    for i in range(count):
+        if i % 3 == 0:
+            packets.append(bytearray(mt8057_codec.encode_packet(mt8057_codec.OP_CO2, 400 + i % 1600)))
+        elif i % 3 == 1:
+            packets.append(bytearray(mt8057_codec.encode_packet(mt8057_codec.OP_TEMPERATURE, 4750 + i % 100)))
+        else:
+            packets.append(bytearray(mt8057_codec.encode_packet(0x6d, i & 0xffff)))
+    return packets
+
+def bench(name, func, count, repeat=5):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print('{:<28} {:>10.3f} us/packet {:>12.0f} packets/s'.format(name, best * 1e6 / count, count / best))
+    return best
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    packets = make_packets(count)
+    buf = bytearray().join(packets)
+
+    for packet in packets:
+        assert legacy_parse(packet) == mt8057_codec.parse_packet(packet)
+    sliced = [mt8057_codec.parse_packet(buf[offset:offset + mt8057_codec.PACKET_SIZE])
+              for offset in range(0, len(buf), mt8057_codec.PACKET_SIZE)]
+    assert mt8057_codec.parse_buffer(buf) == [item for item in sliced if item is not None]
+
+    legacy = bench('legacy _decode/_parse', lambda: [legacy_parse(p) for p in packets], count)
+    table = bench('table parse_packet', lambda: [mt8057_codec.parse_packet(p) for p in packets], count)
+    size = mt8057_codec.PACKET_SIZE
+    sliced = bench('table parse_packet of slices', lambda: [mt8057_codec.parse_packet(buf[offset:offset + size])
+                                                            for offset in range(0, len(buf), size)], count)
+    batch = bench('table parse_buffer', lambda: mt8057_codec.parse_buffer(buf), count)
+    if mt8057_codec.numpy is not None:
+        bench('numpy parse_buffer_array', lambda: mt8057_codec.parse_buffer_array(buf), count)
+    else:
+        print('NumPy is not installed, vectorized parsing is skipped.')
+    print('Speed-up of per-packet parsing: {:.1f}x'.format(legacy / table))
+    print('Speed-up of buffer parsing by offsets: {:.1f}x'.format(sliced / batch))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Crash-recovery harness of cache batches
+
+Scenario of daemon (samples, bulk-update sending with failures, acks) is run
+in child process which is killed (os._exit) before N-th SQL statement or
+around sending to the stand-in server, for every N until scenario finishes.
+Then cache is drained by new process and received batches are checked:
+
+* no row which was in DB or received by server on crash is lost,
+* every row is received in one batch (batch can be resent only as a whole
+  with the same rows, if it was in flight on crash),
+* duplicated timestamps are never sent.
+
+Samples of pending buffer which weren't written to DB are lost on crash by
+design (see 'flush_size' of cache), their number is reported.
+
+Usage: python tools/cache_crash_test.py (Python 3)
+"""
+import itertools
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from climate import cache
+
+SAMPLES = 24
+START = 1700000000
+LIMIT = 4
+FLUSH_SIZE = 3
+
+class Crash(object):
+    """
+    Class for counting of steps and killing of process on the chosen step
+    """
+    def __init__(self, crash_at):
+        self.crash_at = crash_at
+        self.steps = 0
+
+    def step(self, *args):
+        self.steps += 1
+        if self.steps == self.crash_at:
+            os._exit(9)
+
+def post(path, batch_id, data, crash):
+    """
+    Stand-in of bulk-update request, received batch is written to server log
+    """
+    crash.step()
+    with open(path, 'a') as f:
+        f.write('{} {}\n'.format(batch_id, ','.join(str(cache.to_epoch(item['created_at'])) for item in data)))
+        f.flush()
+        os.fsync(f.fileno())
+    crash.step() # Batch is received, but it isn't acked
+
+def child(directory, crash_at):
+    """
+    Scenario of daemon, it's killed on step 'crash_at' (0 - never, -1 - only drain of cache)
+    """
+    crash = Crash(crash_at)
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        db = connect(*args, **kwargs)
+        db.set_trace_callback(crash.step)
+        return db
+
+    sqlite3.connect = traced_connect
+    c = cache.Cache(os.path.join(directory, 'cache.sqlite'), limit=LIMIT, flush_size=FLUSH_SIZE)
+    server = os.path.join(directory, 'server.log')
+    journal = open(os.path.join(directory, 'samples.log'), 'a')
+    sends = 0
+    for i in range(SAMPLES if crash_at >= 0 else 0):
+        c.append(cache.from_epoch(START + i), {'field1': i})
+        journal.write('{}\n'.format(START + i))
+        journal.flush() # Kept by OS when process is killed
+        if i % 7 == 0:
+            c.append(cache.from_epoch(START + i), {'field1': -i}) # Duplicate of timestamp
+        if i % 2:
+            continue
+        data = c.get_cache()
+        if not data:
+            continue
+        sends += 1
+        if sends % 3 == 0: # Failed request, batch is resent by the next call
+            crash.step()
+            continue
+        post(server, c.batch_id, data, crash)
+        c.clear_cache()
+    while True: # Drain
+        data = c.get_cache()
+        if not data:
+            break
+        post(server, c.batch_id, data, crash)
+        c.clear_cache()
+    c.close()
+
+def durable_rows(directory):
+    """
+    Return timestamps of rows in DB
+    """
+    path = os.path.join(directory, 'cache.sqlite')
+    if not os.path.exists(path):
+        return set()
+    db = sqlite3.connect(path)
+    try:
+        return set(row[0] for row in db.execute('SELECT ts FROM cache'))
+    except sqlite3.OperationalError: # Schema wasn't created
+        return set()
+    finally:
+        db.close()
+
+def received(directory):
+    """
+    Return list of received batches (id, timestamps)
+    """
+    path = os.path.join(directory, 'server.log')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [(int(line.split()[0]), tuple(int(ts) for ts in line.split()[1].split(','))) for line in f if line.strip()]
+
+def appended(directory):
+    """
+    Return timestamps of appended samples
+    """
+    with open(os.path.join(directory, 'samples.log')) as f:
+        return set(int(line) for line in f if line.strip())
+
+def run(directory, crash_at):
+    return subprocess.call([sys.executable, os.path.abspath(__file__), '--child', directory, str(crash_at)],
+                           stdout=subprocess.DEVNULL)
+
+def check(directory):
+    """
+    Check received batches, return (errors, number of resent batches, rows in the whole run)
+    """
+    errors = []
+    batches = {}
+    owner = {}
+    resent = 0
+    for batch_id, rows in received(directory):
+        if batch_id in batches:
+            resent += 1
+            if batches[batch_id] != rows:
+                errors.append('batch {} was resent with other rows'.format(batch_id))
+            continue
+        batches[batch_id] = rows
+        for ts in rows:
+            if ts in owner:
+                errors.append('row {} was sent by batches {} and {}'.format(ts, owner[ts], batch_id))
+            owner[ts] = batch_id
+    return errors, resent, set(owner)
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]))
+        return 0
+
+    failures = 0
+    lost = 0
+    for crash_at in itertools.count(1): # Until scenario is finished before the crash point
+        directory = tempfile.mkdtemp(prefix='cache-crash-')
+        try:
+            code = run(directory, crash_at)
+            if code == 0: # Scenario was finished before the step
+                break
+            expected = durable_rows(directory) | set(ts for batch_id, rows in received(directory) for ts in rows)
+            if run(directory, -1) != 0:
+                print('step {}: recovery failed'.format(crash_at))
+                failures += 1
+                continue
+            errors, resent, delivered = check(directory)
+            missing = expected - delivered
+            if missing:
+                errors.append('rows {} were lost'.format(sorted(ts - START for ts in missing)))
+            lost += len(appended(directory) - delivered) # Samples of pending buffer
+            for error in errors:
+                print('step {}: {}'.format(crash_at, error))
+            failures += bool(errors)
+        finally:
+            shutil.rmtree(directory)
+
+    directory = tempfile.mkdtemp(prefix='cache-crash-')
+    try:
+        run(directory, 0)
+        errors, resent, delivered = check(directory)
+        if resent or delivered != set(range(START, START + SAMPLES)):
+            errors.append('run without crash: {} rows of {}, {} resent batches'.format(len(delivered), SAMPLES, resent))
+        for error in errors:
+            print(error)
+        failures += bool(errors)
+    finally:
+        shutil.rmtree(directory)
+
+    print('{} crash points, {} failures, {} samples of pending buffers were lost'.format(crash_at - 1, failures, lost))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
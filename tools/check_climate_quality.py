@@ -0,0 +1,71 @@
+"""
+Check of incremental climate quality index against direct port of MATLAB script
+
+The whole window is processed like 'Cloud/Climate quality.m' does (vector
+formula and medfilt1 with zero padding), the last value is compared with
+result of climate.quality.ClimateQuality after every sample (index is None
+until window // 2 + 1 samples are collected).
+"""
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from climate import quality
+
+NUM_POINTS = 600 # Number of points read by MATLAB script
+
+def medfilt1(x, n):
+    """
+    medfilt1(x, n) of MATLAB with default zero padding
+    """
+    padded = [0] * n + list(x) + [0] * n
+    if n % 2:
+        before, after = (n - 1) // 2, (n - 1) // 2
+    else:
+        before, after = n // 2, n // 2 - 1
+    return [quality.median(padded[n + k - before:n + k + after + 1]) for k in range(len(x))]
+
+def matlab_cq(co2, temp, humidity, w1=quality.W1, w2=quality.W2, w3=quality.W3, coef=3, window=quality.WINDOW):
+    """
+    Line-by-line port of processing of 'Cloud/Climate quality.m'
+    """
+    co2 = [min(max(value, 400), 2000) for value in co2]
+    cq_co2 = [(value - 400) / 1600.0 for value in co2]
+    cq_co2 = [math.exp(value * coef) / math.exp(coef) for value in cq_co2]
+    cq_temp = [min(abs(value - 23) / 10.0, 1) for value in temp]
+    cq_hum = [min(abs(value - 50) / 10.0, 1) for value in humidity]
+    cq = [5 * (1 - (c * w1 + t * w2 + h * w3) / (w1 + w2 + w3)) for c, t, h in zip(cq_co2, cq_temp, cq_hum)]
+    cq = [quality.matlab_round(value, 3) for value in cq]
+    return [int(math.floor(value * 20)) for value in medfilt1(cq, window)]
+
+def main():
+    random.seed(8057)
+    for window in (11, 5, 4):
+        calculator = quality.ClimateQuality(window=window)
+        co2, temp, humidity = [], [], []
+        for i in range(1000):
+            co2.append(random.choice([350, 400, 2100]) if i % 97 == 0 else random.randint(380, 2100))
+            temp.append(round(random.uniform(10, 35), 2))
+            humidity.append(random.randint(20, 80))
+            result = calculator.update(co2[-1], temp[-1], humidity[-1])
+            expected = matlab_cq(co2[-NUM_POINTS:], temp[-NUM_POINTS:], humidity[-NUM_POINTS:], window=window)[-1] \
+                if i >= window // 2 else None
+            if result != expected:
+                print('Mismatch at sample {} (window {}): {} != {}'.format(i, window, result, expected))
+                return 1
+        print('Window {}: 1000 samples match'.format(window))
+    # Golden values of MATLAB formula for constant climate (median of 6 values and 5 zeros)
+    golden = ((400, 23, 50, 95), (2000, 23, 50, 18), (1200, 28, 40, 67), (2000, 13, 30, 0), (800, 25, 55, 84))
+    for co2, temp, humidity, expected in golden:
+        calculator = quality.ClimateQuality()
+        results = [calculator.update(co2, temp, humidity) for i in range(6)]
+        if results[-1] != expected or any(result is not None for result in results[:5]):
+            print('Golden value mismatch for {}: {} != {}'.format((co2, temp, humidity), results, expected))
+            return 1
+    print('Golden values match')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,31 @@
+"""
+Conversion of binary log of daemon to CSV
+
+Usage: python tools/datalog_to_csv.py LOG [LOG ...] > log.csv
+Rotated logs (including compressed '.gz' files) are accepted, files are
+converted in the given order.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from climate import datalog
+
+def main(paths):
+    if not paths:
+        print(__doc__.strip())
+        return 1
+    header = None
+    for path in paths:
+        columns, records = datalog.read_records(path)
+        if header is None:
+            header = columns
+            sys.stdout.write('time,{}\n'.format(','.join(columns)))
+        elif columns != header:
+            sys.stderr.write('{}: columns {} differ from {}\n'.format(path, columns, header))
+        for current_time, values in records:
+            sys.stdout.write('{},{}\n'.format(current_time, ','.join('' if value is None else '{:g}'.format(value) for value in values)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
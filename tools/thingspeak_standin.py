@@ -0,0 +1,436 @@
+"""
+Local stand-in of thingspeak.com with fault injection and load scenarios
+
+Server implements endpoints 'update', 'channels/<id>/bulk_update.json' and
+'channels/<id>/bulk_update.csv' (absolute or relative timestamps) with validation of payload (key, fields, timestamps, bulk size), rate
+limiting (HTTP 429 with Retry-After), latency, random errors (HTTP 500/503)
+and modes: up, down (every request fails with HTTP 503) and drop
+(connection is closed without response, like broken link).
+
+Command 'serve' runs server for manual tests of daemon (set 'url' and
+'bulk_url' of config to http://127.0.0.1:<port>/...). Command 'scenario'
+runs channel of daemon (climate.thingspeak.Channel with cache, backlog
+uploader and circuit breaker) against the server at accelerated time and
+reports drain time of backlog, bytes sent and rows lost or duplicated:
+
+* outage - server is down for one hour
+* flapping - link is down for 2 minutes and up for 1 minute during one hour
+* bulk960 - cache with 2880 rows is drained by bulks of 960 rows
+
+Usage: python3 tools/thingspeak_standin.py serve [--port 8080] [--latency 0.2] [--error-rate 0.05]
+       python3 tools/thingspeak_standin.py scenario [outage|flapping|bulk960|all] [--scale 120] [--bulk-format csv]
+"""
+import argparse
+import collections
+import contextlib
+import gzip
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from climate import thingspeak
+from climate.cache import Cache, from_epoch
+from climate.session import HttpSession
+from climate.uploader import Uploader, Sample
+
+UP = 'up'
+DOWN = 'down'
+DROP = 'drop'
+
+RATE_LIMIT = 15     # Minimal interval between writes of channel (seconds)
+MAX_BULK = 960      # Maximal number of updates of bulk-update (free account)
+BULK_PATH = re.compile(r'^/channels/(\d+)/bulk_update\.json$')
+BULK_CSV_PATH = re.compile(r'^/channels/(\d+)/bulk_update\.csv$')
+CSV_COLUMNS = ['timestamp'] + thingspeak.FIELDS + ['latitude', 'longitude', 'elevation', 'status']
+RELATIVE_TOLERANCE = 2 # Shift of relative timestamp by delay of request (seconds)
+TIME_PATTERN = re.compile(r'^\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d')
+UPDATE_KEYS = set(thingspeak.FIELDS) | set(['created_at', 'status', 'delta_t', 'latitude', 'longitude', 'elevation'])
+
+class ValidationError(ValueError):
+    pass
+
+def validate_update(update):
+    """
+    Check fields and timestamp of one update, return its timestamp
+    """
+    unknown = set(update) - UPDATE_KEYS
+    if unknown:
+        raise ValidationError('Unknown parameters: {}'.format(', '.join(sorted(unknown))))
+    for field in thingspeak.FIELDS:
+        if field in update:
+            try:
+                float(update[field])
+            except (TypeError, ValueError):
+                raise ValidationError('Wrong value of {}: {}'.format(field, update[field]))
+    created_at = update.get('created_at')
+    if created_at is not None and not TIME_PATTERN.match(str(created_at)):
+        raise ValidationError('Wrong created_at: {}'.format(created_at))
+    if created_at is None and 'delta_t' not in update and len(update) > 1:
+        return None
+    return created_at if created_at is not None else update.get('delta_t')
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Class for stand-in server of thingspeak.com
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0, rate_limit=RATE_LIMIT,
+                 max_bulk=MAX_BULK, keys=None, seed=None):
+        """
+        Class initialization
+        'latency' - delay of response (seconds), 'error_rate' - part of requests with HTTP 500/503,
+        'rate_limit' - minimal interval between writes of key (0 - disabled), 'keys' - valid keys (any key by default).
+        """
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.max_bulk = max_bulk
+        self.keys = keys
+        self.mode = UP
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()  # Requests, statuses and bytes
+        self.entries = collections.Counter() # (key, created_at) -> number of writes
+        self._last_write = {}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def accept(self, key, timestamps, tolerance=0):
+        """
+        Check rate limit of key and save entries, return delay until next write is allowed or 0
+        Epoch timestamps match existing entries within 'tolerance' seconds.
+        """
+        with self.lock:
+            now = time.time()
+            last = self._last_write.get(key)
+            if self.rate_limit and last is not None and now - last < self.rate_limit:
+                return self.rate_limit - (now - last)
+            self._last_write[key] = now
+            for timestamp in timestamps:
+                if tolerance:
+                    for shift in sorted(range(-tolerance, tolerance + 1), key=abs):
+                        if (key, from_epoch(timestamp + shift)) in self.entries:
+                            timestamp += shift
+                            break
+                    timestamp = from_epoch(timestamp)
+                self.entries[(key, timestamp)] += 1
+            self.stats['rows'] += len(timestamps)
+            return 0
+
+    def unique_rows(self):
+        return len(self.entries)
+
+    def duplicates(self):
+        return sum(count - 1 for count in self.entries.values())
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Class for handling of requests of stand-in server
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, content_type='application/json', headers=None):
+        body = body.encode('utf-8')
+        with self.server.lock:
+            self.server.stats['status {}'.format(status)] += 1
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        received = time.time()
+        with server.lock:
+            server.stats['requests'] += 1
+            server.stats['bytes'] += len(raw)
+        if server.mode == DROP: # Broken link, response isn't sent
+            self.close_connection = True
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        if server.mode == DOWN:
+            return self._reply(503, '{"error": "Service Unavailable"}')
+        if server.error_rate and server.random.random() < server.error_rate:
+            return self._reply(server.random.choice((500, 503)), '{"error": "Internal Server Error"}')
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                raw = gzip.GzipFile(fileobj=io.BytesIO(raw)).read()
+            body = raw.decode('utf-8')
+            path = self.path.split('?')[0]
+            if path == '/update':
+                return self._update(dict((name, values[0]) for name, values in parse_qs(body).items()))
+            if BULK_PATH.match(path):
+                return self._bulk_update(json.loads(body))
+            if BULK_CSV_PATH.match(path):
+                return self._bulk_update_csv(dict((name, values[0]) for name, values in parse_qs(body).items()), received)
+            return self._reply(404, '{"error": "Not Found"}')
+        except ValidationError as e:
+            return self._reply(400, json.dumps({'error': str(e)}))
+        except (ValueError, TypeError, AttributeError, IOError) as e:
+            return self._reply(400, json.dumps({'error': 'Wrong payload: {}'.format(e)}))
+
+    def _check_key(self, key):
+        if not key or (self.server.keys is not None and key not in self.server.keys):
+            self._reply(401, '{"error": "Unauthorized"}')
+            return False
+        return True
+
+    def _limited(self, key, timestamps, tolerance=0):
+        delay = self.server.accept(key, timestamps, tolerance)
+        if delay:
+            self._reply(429, '{"error": "Too Many Requests"}', headers={'Retry-After': str(int(math.ceil(delay)))})
+            return True
+        return False
+
+    def _update(self, values):
+        key = values.pop('api_key', None)
+        if not self._check_key(key):
+            return
+        if not any(field in values for field in thingspeak.FIELDS):
+            raise ValidationError('No fields')
+        timestamp = validate_update(values) or from_epoch(time.time())
+        if self._limited(key, [timestamp]):
+            return
+        self._reply(200, str(self.server.stats['rows']), 'text/plain')
+
+    def _bulk_update(self, data):
+        key = data.get('write_api_key')
+        if not self._check_key(key):
+            return
+        updates = data.get('updates')
+        if not isinstance(updates, list) or not updates:
+            raise ValidationError('No updates')
+        if len(updates) > self.server.max_bulk:
+            raise ValidationError('Too many updates: {} (maximum {})'.format(len(updates), self.server.max_bulk))
+        timestamps = []
+        for update in updates:
+            if not isinstance(update, dict):
+                raise ValidationError('Wrong update: {}'.format(update))
+            timestamp = validate_update(update)
+            if timestamp is None:
+                raise ValidationError('Update without created_at or delta_t')
+            timestamps.append(timestamp)
+        if self._limited(key, timestamps):
+            return
+        self._reply(202, '{"success": true}')
+
+    def _bulk_update_csv(self, values, received):
+        key = values.get('write_api_key')
+        if not self._check_key(key):
+            return
+        time_format = values.get('time_format')
+        if time_format not in ('absolute', 'relative'):
+            raise ValidationError('Wrong time_format: {}'.format(time_format))
+        updates = values.get('updates', '').split('|')
+        if not updates[0]:
+            raise ValidationError('No updates')
+        if len(updates) > self.server.max_bulk:
+            raise ValidationError('Too many updates: {} (maximum {})'.format(len(updates), self.server.max_bulk))
+        timestamps = []
+        gaps = []
+        previous = int(round(received))
+        for line in updates:
+            columns = line.split(',')
+            if len(columns) != len(CSV_COLUMNS):
+                raise ValidationError('Wrong number of columns: {}'.format(line))
+            update = dict((name, value) for name, value in zip(CSV_COLUMNS[1:], columns[1:]) if value)
+            validate_update(update)
+            if time_format == 'relative':
+                if not columns[0].isdigit():
+                    raise ValidationError('Wrong relative timestamp: {}'.format(columns[0]))
+                previous -= int(columns[0]) # Seconds before previous entry
+                if timestamps:
+                    gaps.append(int(columns[0]))
+                timestamps.append(previous)
+            else:
+                timestamps.append(validate_update({'created_at': columns[0]}))
+        # Shifted entries are matched to written ones, but neighbours of entry aren't
+        tolerance = min([RELATIVE_TOLERANCE] + [gap // 2 for gap in gaps]) if time_format == 'relative' else 0
+        if self._limited(key, timestamps, tolerance):
+            return
+        self._reply(202, '{"success": true}')
+
+def serve(args):
+    server = StandInServer((args.address, args.port), latency=args.latency, error_rate=args.error_rate,
+                           rate_limit=args.rate_limit, max_bulk=args.max_bulk)
+    print('Stand-in of thingspeak.com is listening on port {} (Ctrl+C for stop).'.format(server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print('{} requests, {} rows ({} duplicates), statuses: {}'.format(
+        server.stats['requests'], server.stats['rows'], server.duplicates(),
+        ', '.join('{} x{}'.format(name[7:], count) for name, count in sorted(server.stats.items()) if name.startswith('status'))))
+
+def warp_clock(scale):
+    """
+    Make clock of process 'scale' times faster (time.time, time.sleep and timeouts of events)
+    """
+    real_time = time.time
+    real_sleep = time.sleep
+    real_wait = threading.Event.wait
+    start = real_time()
+    time.time = lambda: start + (real_time() - start) * scale
+    time.sleep = lambda seconds: real_sleep(max(0, seconds) / scale)
+    threading.Event.wait = lambda self, timeout=None: real_wait(self, None if timeout is None else max(0, timeout) / scale)
+
+SCENARIOS = collections.OrderedDict([
+    # Phases (duration, mode) after 10 minutes of normal work, rows in cache before start
+    ('outage', {'phases': [(3600, DOWN)], 'prefill': 0}),
+    ('flapping', {'phases': [(120, DROP), (60, UP)] * 20, 'prefill': 0}),
+    ('bulk960', {'phases': [], 'prefill': 2880}),
+])
+
+PAUSE = 30          # Pause between samples (seconds)
+WARMUP = 600        # Normal work before phases (seconds)
+MAX_DRAIN = 7200    # Maximal time of draining after phases (seconds)
+
+def run_scenario(name, args):
+    """
+    Run channel against stand-in server, return report
+    """
+    scenario = SCENARIOS[name]
+    server = StandInServer(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit,
+                           max_bulk=args.max_bulk, seed=1)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    directory = tempfile.mkdtemp(prefix='standin-')
+    session = HttpSession()
+    cache = Cache(os.path.join(directory, 'cache.sqlite'), limit=args.max_bulk)
+    channel = thingspeak.Channel(name, 'STANDIN', '', 'http://127.0.0.1:{}/channels/1/bulk_update.json'.format(server.port),
+                                 [('field1', 'co2'), ('field2', 'temp')], cache=cache, status=lambda: '192.0.2.1',
+                                 max_bulk_size=args.max_bulk, session=session, bulk_format=args.bulk_format)
+    generated = 0
+    now = time.time()
+    for i in range(scenario['prefill']): # Samples which were cached offline
+        cache.append(from_epoch(now - PAUSE * (scenario['prefill'] - i)), {'field1': 400 + i % 100, 'field2': 23})
+        generated += 1
+    cache.flush()
+
+    uploader = Uploader(channel.send, spill=channel.spill, name='uploader')
+    uploader.start()
+    channel.backlog.start()
+    schedule = [(WARMUP, UP)] if scenario['phases'] else []
+    schedule += scenario['phases']
+    start = next_sample = time.time()
+    phase_end = start
+    phases = []
+    for duration, mode in schedule:
+        phase_end += duration
+        phases.append((phase_end, mode))
+    faults_end = phase_end
+    drained = None
+    peak = 0
+    while True:
+        now = time.time()
+        while phases and now >= phases[0][0]:
+            phases.pop(0)
+        server.mode = phases[0][1] if phases else UP
+        if now >= next_sample:
+            uploader.put(Sample(from_epoch(next_sample), {'field1': 400 + generated % 100, 'field2': 23.5}))
+            generated += 1
+            next_sample += PAUSE
+        pending = cache.count()
+        peak = max(peak, pending)
+        if not phases and drained is None and pending <= 1:
+            drained = now - faults_end
+        if drained is not None and now - faults_end >= drained + 2 * PAUSE or now - faults_end > MAX_DRAIN:
+            break
+        time.sleep(1)
+    uploader.stop()
+    uploader.join()
+    channel.backlog.stop()
+    channel.backlog.join()
+    lost = generated - server.unique_rows() - cache.count()
+    channel.close()
+    session.close()
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(directory)
+    return {
+        'name': name,
+        'rows': generated,
+        'received': server.unique_rows(),
+        'duplicates': server.duplicates(),
+        'lost': lost,
+        'peak': peak,
+        'drain': drained,
+        'requests': server.stats['requests'],
+        'bytes_sent': session.bytes_sent,
+        'statuses': dict((key[7:], count) for key, count in server.stats.items() if key.startswith('status')),
+    }
+
+def scenario(args):
+    warp_clock(args.scale)
+    names = list(SCENARIOS) if args.name == 'all' else [args.name]
+    for name in names:
+        if args.verbose:
+            report = run_scenario(name, args)
+        else: # Messages of channel are hidden
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                report = run_scenario(name, args)
+        print('{name}: {rows} rows, {received} received, {lost} lost, {duplicates} duplicates, peak backlog {peak} rows'.format(**report))
+        print('    drain time {}, {} requests, {} bytes sent, statuses: {}'.format(
+            '{:.0f} s'.format(report['drain']) if report['drain'] is not None else 'not drained',
+            report['requests'], report['bytes_sent'],
+            ', '.join('{} x{}'.format(status, count) for status, count in sorted(report['statuses'].items()))))
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of thingspeak.com')
+    parser.add_argument('--latency', type=float, default=0.1, help='delay of response (seconds)')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='part of requests with HTTP 500/503')
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT, help='minimal interval between writes (seconds)')
+    parser.add_argument('--max-bulk', type=int, default=MAX_BULK, help='maximal number of updates of bulk-update')
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser('serve', help='run server')
+    serve_parser.add_argument('--address', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    scenario_parser = commands.add_parser('scenario', help='run load scenario')
+    scenario_parser.add_argument('name', nargs='?', default='all', choices=list(SCENARIOS) + ['all'])
+    scenario_parser.add_argument('--scale', type=float, default=120, help='speed of clock')
+    scenario_parser.add_argument('--bulk-format', choices=thingspeak.BULK_FORMATS, default='json', help='format of bulk-update')
+    scenario_parser.add_argument('--verbose', action='store_true', help='show messages of channel')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args)
+    elif args.command == 'scenario':
+        scenario(args)
+    else:
+        parser.print_help()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())